@@ -11,6 +11,7 @@ import tempfile
 import datetime
 import collections
 import traceback
+import multiprocessing.pool
 
 import json
 import yaml
@@ -40,10 +41,11 @@ import std_srvs.srv
 import flycave.srv
 import flyvr.srv
 
-import flyvr.calib.kdtree
+from flyvr.calib.pointindex import PointIndex
 from flyvr.calib.imgproc import add_crosshairs_to_nparr
-from flyvr.calib.acquire import CameraHandler, SimultaneousCameraRunner, SequentialCameraRunner
+from flyvr.calib.acquire import CameraHandler, SimultaneousCameraRunner, SequentialCameraRunner, AcquisitionDiagnostics, AcquisitionTimeout
 from flyvr.calib.imgproc import DotBGFeatureDetector, load_mask_image, add_crosshairs_to_nparr
+from flyvr.calib.imgwriter import get_image_writer
 from flyvr.calib.sampling import gen_horiz_snake, gen_vert_snake, gen_spiral_snake
 from flyvr.calib.calibrationconstants import *
 
@@ -136,7 +138,7 @@ class DataIO:
         self.num_points = 0
         
         self._display_tree = {}
-        self._position_tree = flyvr.calib.kdtree.create(dimensions=3, check_dimensions=False)
+        self._position_tree = PointIndex(dimensions=3)
         
         self._pub_num_pts = rospy.Publisher('~num_points', UInt32)
         self._pub_mapping = rospy.Publisher('~mapping', CalibMapping)
@@ -165,6 +167,9 @@ class DataIO:
         if calibration_except is None:
             calibration_except = set()
 
+        #index the stored points in bulk, rather than one at a time
+        pcorrs = []
+        dcorrs = {}
         with rosbag.Bag(name, 'r') as bag:
             for topic, msg, t in bag.read_messages(topics=[CALIB_MAPPING_TOPIC]):
 
@@ -173,7 +178,10 @@ class DataIO:
                 if (viewport_desc) in calibration_except or (viewport_desc_all in calibration_except):
                     continue
 
-                self._add_mapping(msg)
+                dcorr, pcorr = self._get_correspondences(msg)
+                pcorrs.append(pcorr)
+                dcorrs.setdefault(msg.display_server, []).append(dcorr)
+                self._record_mapping(msg)
 
                 if vis_callback_2d:
                     vis_callback_2d(ds=msg.display_server, 
@@ -182,11 +190,21 @@ class DataIO:
                                     pan=msg.pan,
                                     tilt=msg.tilt)
 
-#        self._position_tree = self._position_tree.rebalance()
-#        for tree in self._display_tree.values():
-#            tree.rebalance()
+        self._position_tree.extend(pcorrs)
+        self._position_tree.rebuild()
+        for ds in dcorrs:
+            self._get_display_tree(ds).extend(dcorrs[ds])
+        for tree in self._display_tree.values():
+            tree.rebuild()
 
-    def _add_mapping(self, c):
+    def _get_display_tree(self, ds):
+        try:
+            return self._display_tree[ds]
+        except KeyError:
+            self._display_tree[ds] = PointIndex(dimensions=2)
+            return self._display_tree[ds]
+
+    def _get_correspondences(self, c):
         dcorr = DisplayCorrespondence(
                     col=c.pixel_projector.x,
                     row=c.pixel_projector.y,
@@ -205,16 +223,15 @@ class DataIO:
                     vdisp=c.vdisp,
                     pan=c.pan,
                     tilt=c.tilt)
-                    
+        return dcorr, pcorr
+
+    def _add_mapping(self, c):
+        dcorr, pcorr = self._get_correspondences(c)
         self._position_tree.add(pcorr)
+        self._get_display_tree(c.display_server).add(dcorr)
+        self._record_mapping(c)
 
-        try:
-            self._display_tree[c.display_server]
-        except KeyError:
-            self._display_tree[c.display_server] = flyvr.calib.kdtree.create(dimensions=2, check_dimensions=False)
-        finally:
-            self._display_tree[c.display_server].add(dcorr)
-        
+    def _record_mapping(self, c):
         self._bag.write(CALIB_MAPPING_TOPIC,c)
         self.num_points += 1
         self._pub_mapping.publish(c)
@@ -225,15 +242,38 @@ class DataIO:
                     col=col,row=row,
                     vdisp="",pan=0,tilt=0,x=0,y=0,z=0)
         try:
-            return self._display_tree[ds].search_nn(dcorr).data
+            return self._display_tree[ds].search_nn(dcorr)
         except KeyError:
             #OK, no data for display server yet
             return None
         except Exception:
             rospy.logwarn(
-                "Unknown error getting correspondence for %r\n%s\nTree:\n\n" %(
+                "Unknown error getting correspondence for %r\n%s" %(
                     dcorr,traceback.format_exc()))
-            flyvr.calib.kdtree.visualize(self._display_tree[ds])
+
+    def get_display_correspondences(self, ds, colrows, k=1):
+        """return the k nearest DisplayCorrespondences of each (col,row)
+
+        colrows is a Nx2 array. Returns a list of N lists, nearest
+        first. They are empty if there is no data for ds yet.
+        """
+        if ds not in self._display_tree:
+            return [ [] for cr in colrows ]
+        return self._display_tree[ds].search_knn(np.asarray(colrows,dtype=float), k)
+
+    def get_display_correspondences_within(self, ds, colrows, radius):
+        """return the DisplayCorrespondences within radius pixels of each (col,row)"""
+        if ds not in self._display_tree:
+            return [ [] for cr in colrows ]
+        return self._display_tree[ds].search_radius(np.asarray(colrows,dtype=float), radius)
+
+    def get_position_correspondences(self, xyzs, k=1):
+        """return the k nearest PositionCorrespondences of each 3D position (Nx3 array)"""
+        return self._position_tree.search_knn(np.asarray(xyzs,dtype=float), k)
+
+    def get_position_correspondences_within(self, xyzs, radius):
+        """return the PositionCorrespondences within radius of each 3D position"""
+        return self._position_tree.search_radius(np.asarray(xyzs,dtype=float), radius)
 
 
     def add_mapping(self, **kwargs):
@@ -287,10 +327,22 @@ class Calib:
         self.laser_range_tilt = config["laser_range_tilt"]
         self.laser_expected_detect_location = config["laser_expected_detect_location"]
         self.laser_expected_detect_hist = config["laser_expected_detect_hist"]
+        self.laser_detect_window = int(config.get("laser_detect_window", 40))
         self.visible_thresh = int(config["bg_thresh_visible"])
         self.laser_thresh = int(config["bg_thresh_laser"])
         self.laser_search_size = config["laser_search_size"]
         self.laser_per_point_repeat_n_times = int(config["laser_per_point_repeat_n_times"])
+        #with a running background, the initial background needs fewer frames
+        self.bg_running_alpha = config.get("bg_running_alpha")
+        self.bg_num_frames = int(config.get("bg_num_frames", 20))
+        self.detect_backend = config.get("detect_backend", "scipy")
+        #images of one trigger have the same stamp, those of the next are
+        #1/5s later, so e.g. 0.05 groups the images by trigger. None (the
+        #default) disables the synchronization
+        self.camera_sync_tolerance = config.get("camera_sync_tolerance")
+        #seconds to wait for camera images (enough for the background images
+        #at 5 fps) before the current step is retried, None waits forever
+        self.camera_timeout = config.get("camera_timeout", 10.0 + self.bg_num_frames/5.0)
         
         self.flydra = flydra.reconstruct.Reconstructor(
                         cal_source=decode_url(config["tracking_calibration"]))
@@ -383,6 +435,7 @@ class Calib:
             fd = DotBGFeatureDetector(
                     cam,
                     method="med",
+                    backend=self.detect_backend,
                     show=show_type if (show_cameras[0] == "all" or cam in show_cameras) else "")
             if "detection" in debug:
                 fd.enable_debug_detection()
@@ -390,17 +443,24 @@ class Calib:
                 fd.enable_debug_images("/mnt/ssd/CALIB/")
             if "benchmark" in debug:
                 fd.enable_benchmark()
+            if self.bg_running_alpha:
+                fd.enable_running_bg(self.bg_running_alpha)
             self.tracking_cameras[cam] = fd
             cam_handlers.append(CameraHandler(cam,debug="acquisition" in debug))
             rospy.loginfo("Connecting to cam %s" % cam)
             self._set_bg_mask(cam, fd)
-        self.runner = SimultaneousCameraRunner(cam_handlers)
+        self.runner = SimultaneousCameraRunner(cam_handlers,
+                                               sync_tolerance=self.camera_sync_tolerance,
+                                               timeout=self.camera_timeout)
+        self._detect_pool = multiprocessing.pool.ThreadPool(max(1,len(tracking_cameras)))
+        self.detect_timings = {}
         
         #laser camera acquisition
         self.laser_camera = laser_camera
         fd = DotBGFeatureDetector(
                     laser_camera,
                     method="morphbinary",
+                    backend=self.detect_backend,
                     show=show_type if (show_cameras[0] == "all" or laser_camera in show_cameras) else "")
         if "detection" in debug:
             fd.enable_debug_detection()
@@ -415,9 +475,14 @@ class Calib:
         )
         self.laser_runner = SequentialCameraRunner(
                                 (self.laser_handler,),
-                                queue_depth=1)
+                                queue_depth=1,
+                                timeout=self.camera_timeout)
         rospy.loginfo("Connecting to cam %s" % laser_camera)
         self.laser_detector = fd
+
+        self.acquisition_diagnostics = AcquisitionDiagnostics(
+                                            (self.runner, self.laser_runner),
+                                            period=config.get("diagnostics_period", 5.0))
         try:
             self.laser_mask = load_mask_image(decode_url(config["laser_camera_mask"]))
         except IOError:
@@ -494,7 +559,7 @@ class Calib:
     def _calculate_background(self):
         rospy.loginfo("Collecting backgrounds")
         #collect bg images
-        self.runner.get_images(20, self.trigger_proxy_rate, [5], self.trigger_proxy_rate, [0])
+        self.runner.get_images(self.bg_num_frames, self.trigger_proxy_rate, [5], self.trigger_proxy_rate, [0])
         imgs = self.runner.result_as_nparray
         for cam in imgs:
             #collect the background model
@@ -543,7 +608,7 @@ class Calib:
                         sz=-1,  fill=255, chan=1)
             cv2.imshow(handle, img)
             if self.__l_fmt:
-                cv2.imwrite(self.__l_fmt%{"time":time.time()},img)
+                get_image_writer().write(self.__l_fmt%{"time":time.time()},img)
         
         return pan,tilt
 
@@ -583,22 +648,47 @@ class Calib:
                 add_crosshairs_to_nparr(arr=img, row=row, col=col, sz=-1, fill=255, chan=1)
             cv2.imshow(handle, img)
             if self.__ds_fmt:
-                cv2.imwrite(self.__ds_fmt%{"time":time.time()},img)
+                get_image_writer().write(self.__ds_fmt%{"time":time.time()},img)
 
         rospy.logdebug("lighting projector %s col:%s row:%s" % (ds,col,row))
         self._light_proj_cache[ds] = target
 
         rospy.sleep(0.5)
 
+    def _detect_one(self, cam, img, thresh):
+        t0 = time.time()
+        features,dmax = self.tracking_cameras[cam].detect(img, thresh)
+        return features,dmax,time.time()-t0
+
     def _detect_points(self, runner, thresh, restrict={}):
-        runner.get_images(1, self.trigger_proxy_rate, [5], self.trigger_proxy_rate, [0])
-        imgs = runner.result_as_nparray
-        detected = {}
-        visible = 0
-        for cam in imgs:
+        #detect in each camera as soon as its image arrives, while the others
+        #are still acquired. The detectors do not share state, and OpenCV and
+        #scipy.ndimage release the GIL for the heavy lifting. Cameras with
+        #debug windows are handled here once all images arrived, as the GUI
+        #is not threadsafe.
+        pending = {}
+        deferred = {}
+        for cam,img,stamp in runner.iter_images(1, self.trigger_proxy_rate, [5], self.trigger_proxy_rate, [0]):
             if restrict and cam not in restrict:
                 continue
-            features,dmax = self.tracking_cameras[cam].detect(imgs[cam][:,:,0], thresh)
+            if self.tracking_cameras[cam].has_windows:
+                deferred[cam] = img
+            else:
+                pending[cam] = self._detect_pool.apply_async(
+                        self._detect_one, (cam, img, thresh))
+        results = {}
+        for cam in deferred:
+            results[cam] = self._detect_one(cam, deferred[cam], thresh)
+        for cam in pending:
+            results[cam] = pending[cam].get()
+        cams = sorted(results)
+
+        detected = {}
+        visible = 0
+        for cam in cams:
+            features,dmax,dt = results[cam]
+            self.detect_timings[cam] = dt
+            rospy.logdebug("detect: %s took %.1fms" % (cam,dt*1000))
             if features:
                 if len(features) > 1:
                     rospy.logerr("multiple features not supported, taking the first one")
@@ -615,7 +705,9 @@ class Calib:
 
         return detected,visible
 
-    def _detect_laser_camera_2d_point(self, thresh, msgprefix=""):
+    def _detect_laser_camera_2d_point(self, thresh, msgprefix="", predicted=None):
+        """predicted (col,row), if given, restricts the search to laser_detect_window
+        pixels around it (falling back to the full frame)"""
         if thresh == self.laser_thresh:
             self.laser_handler.reconfigure(shutter=2000)
         else:
@@ -627,11 +719,25 @@ class Calib:
         if thresh == self.laser_thresh:
             self.laser_detector.set_mask(self.laser_mask, copy=False)
 
+        if thresh == self.laser_thresh:
+            #detections further than this are rejected below anyway
+            col,row = self.laser_expected_detect_location
+            predicted = (row,col)
+            window = self.laser_expected_detect_hist
+        elif predicted is not None:
+            col,row = predicted
+            predicted = (row,col)
+            window = self.laser_detect_window
+        else:
+            window = None
+
         img = imgs[self.laser_camera][:,:,0]
         features,dmax = self.laser_detector.detect(
                         img,
                         thresh,
-                        exact_luminance=thresh != self.laser_thresh)
+                        exact_luminance=thresh != self.laser_thresh,
+                        predicted=predicted,
+                        window=window)
 
         if thresh == self.laser_thresh:
             self.laser_detector.clear_mask()
@@ -733,7 +839,7 @@ class Calib:
                 sz=1, fill=255, chan=0)
             cv2.imshow(handle, img)
             if self.__ds_fmt:
-                cv2.imwrite(self.__ds_fmt%{"time":time.time()},img)
+                get_image_writer().write(self.__ds_fmt%{"time":time.time()},img)
 
 
         if show_laser_scatter:
@@ -747,9 +853,21 @@ class Calib:
                 rospy.logerr("could not plot pan/tilt: tilt:%s pan:%s" % (tilt,pan))
             cv2.imshow(handle, img)
             if self.__l_fmt:
-                cv2.imwrite(self.__l_fmt%{"time":time.time()},img)
+                get_image_writer().write(self.__l_fmt%{"time":time.time()},img)
 
     def run(self):
+        try:
+            while True:
+                try:
+                    self._run()
+                    break
+                except AcquisitionTimeout as e:
+                    #the mode is unchanged, so running again retries the point
+                    rospy.logwarn("%s, retrying" % e)
+        finally:
+            self._shutdown()
+
+    def _run(self):
         while not rospy.is_shutdown():
             with self.mode_lock:
                 mode = self.mode
@@ -948,7 +1066,12 @@ class Calib:
                                                                 newpan,newtilt,
                                                                 oldpan,oldtilt))
 
-                                _col,_row,_lum = self._detect_laser_camera_2d_point(self.visible_thresh)
+                                #the dot moves only a few pixels per iteration
+                                _col,_row,_lum = self._detect_laser_camera_2d_point(
+                                                                self.visible_thresh,
+                                                                predicted=(col,row))
+                                if self.debug_control:
+                                    rospy.loginfo("CTRL:MPTC:SRCH %s" % self.laser_detector.last_search)
                                 if _col is None:
                                     #we lost the pixel
                                     tries -= 1
@@ -1230,6 +1353,7 @@ class Calib:
 
             rospy.sleep(0.1)
 
+    def _shutdown(self):
         #clean up all state
         if self.laser_proxy_power:
             self.laser_proxy_power(False)
@@ -1237,6 +1361,19 @@ class Calib:
         if self.show_cameras or self.show_display_servers:
             cv2.destroyAllWindows()
 
+        writer = get_image_writer()
+        writer.flush(timeout=10)
+        rospy.loginfo("debug images: %(written)d written, %(dropped)d dropped, %(errors)d failed" % writer.stats)
+
+        self.acquisition_diagnostics.shutdown()
+        self._detect_pool.close()
+        self._detect_pool.join()
+        for runner in (self.runner, self.laser_runner):
+            for cam,s in runner.get_stats().items():
+                rospy.loginfo("%s: %d/%d frames used, %d dropped, latency p50 %.1fms p99 %.1fms, queue depth p99 %.0f" % (
+                    cam, s["used"], s["received"], s["dropped"],
+                    s["latency_p50"]*1000, s["latency_p99"]*1000, s["queue_depth_p99"]))
+
         self.data.close()
 
 if __name__ == '__main__':
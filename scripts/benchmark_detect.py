@@ -0,0 +1,109 @@
+"""micro-benchmark of DotBGFeatureDetector.detect() memory use
+
+Compares detect() against the previous implementation, which
+allocated new arrays for every frame. Besides the time per frame, the
+number of minor page faults per frame is reported. With a fixed glibc
+mmap threshold, every large NumPy array is mmap()ed afresh, so
+touching a newly allocated image-sized array causes page faults,
+while reused buffers do not. Zero page faults per frame therefore
+means no image-sized allocations.
+"""
+import argparse
+import ctypes
+import resource
+import time
+import numpy as np
+import scipy.ndimage
+
+import roslib
+roslib.load_manifest('flyvr')
+from flyvr.calib.imgproc import DotBGFeatureDetector, blob_statistics
+
+def legacy_detect(bg, imarr, thresh, method):
+    # previous DotBGFeatureDetector.detect() without masks or display
+    diff = imarr.astype(np.int16) - bg
+    diff = diff.clip(0,255).astype(np.uint8)
+    dmax = diff.max()
+    if dmax < thresh:
+        return [],dmax
+    if method == "morphbinary":
+        valid = diff > thresh
+        scipy.ndimage.binary_opening(valid, output=valid)
+        vis = (valid*255).astype(np.uint8)
+        diff = valid
+    else:
+        scipy.ndimage.median_filter(diff,3,output=diff)
+        valid = diff > thresh
+    diff[~valid] = 0
+    lbls,maxlabel = scipy.ndimage.measurements.label(diff)
+    return blob_statistics(imarr, diff, lbls, maxlabel),dmax
+
+def get_frames(n, shape, noise):
+    # a dot moving over a noisy background
+    rng = np.random.RandomState(4)
+    bg = rng.randint(0,50,size=shape).astype(np.uint8)
+    frames = []
+    for i in range(n):
+        frame = bg + rng.randint(0,noise+1,size=shape).astype(np.uint8)
+        row = 20 + (i*7) % (shape[0]-40)
+        col = 20 + (i*11) % (shape[1]-40)
+        frame[row-3:row+4,col-3:col+4] = 250
+        frames.append(frame)
+    return bg, frames
+
+def fix_mmap_threshold(nbytes=128*1024):
+    # Setting the threshold disables glibc's dynamic threshold, which
+    # would otherwise move freed large blocks to the reusable heap.
+    M_MMAP_THRESHOLD = -3
+    try:
+        libc = ctypes.CDLL('libc.so.6')
+    except OSError:
+        return False
+    return bool(libc.mallopt(M_MMAP_THRESHOLD, nbytes))
+
+def get_minor_faults():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_minflt
+
+def measure(func, frames):
+    """return (msec per frame, minor page faults per frame, results)"""
+    func(frames[0]) # warm up (first call may allocate buffers)
+    results = []
+    t0 = time.time()
+    f0 = get_minor_faults()
+    for frame in frames:
+        results.append(func(frame))
+    faults = get_minor_faults()-f0
+    dt = time.time()-t0
+    return dt*1000.0/len(frames), faults/float(len(frames)), results
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n', type=int, default=200,
+                        help='number of frames')
+    parser.add_argument('--width', type=int, default=659)
+    parser.add_argument('--height', type=int, default=494)
+    parser.add_argument('--noise', type=int, default=10)
+    parser.add_argument('--thresh', type=int, default=100)
+    args = parser.parse_args()
+
+    shape = (args.height, args.width)
+    bg, frames = get_frames(args.n, shape, args.noise)
+
+    print '%d frames of %dx%d'%(args.n, args.width, args.height)
+    if not fix_mmap_threshold():
+        print 'could not set the glibc mmap threshold, page faults undercount allocations'
+    for method in DotBGFeatureDetector.DETECT_METHODS:
+        fd = DotBGFeatureDetector("benchmark", method=method, show="")
+        fd.compute_bg(bg[:,:,np.newaxis])
+
+        t_legacy, f_legacy, r_legacy = measure(
+            lambda frame: legacy_detect(bg, frame, args.thresh, method), frames)
+        t_new, f_new, r_new = measure(
+            lambda frame: fd.detect(frame, args.thresh), frames)
+
+        agree = sum(list(a[0]) == list(b[0]) for a,b in zip(r_legacy,r_new))
+        print '%s: legacy %.2f msec %.1f faults/frame, new %.2f msec %.1f faults/frame, %d/%d frames agree'%(
+            method, t_legacy, f_legacy, t_new, f_new, agree, args.n)
+
+if __name__=='__main__':
+    main()
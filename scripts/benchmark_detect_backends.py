@@ -0,0 +1,135 @@
+"""benchmark of the DotBGFeatureDetector backends and methods
+
+Replays frames through every combination of backend ("scipy",
+"opencv") and method ("med", "morphbinary"), and reports the
+percentiles of the detect() latency and how well the detections of
+each backend agree with those of the scipy backend.
+
+The frames are either stored camera images (--frames, a glob of image
+files, the background is the minimum of the first --bg-frames of them
+unless --bg is given), or synthetic dots moving over a noisy
+background, at each of the --noise levels.
+"""
+import argparse
+import glob
+import time
+import numpy as np
+import cv2
+
+import roslib
+roslib.load_manifest('flyvr')
+from flyvr.calib.imgproc import DotBGFeatureDetector
+
+PERCENTILES = (50, 90, 99, 100)
+
+def get_synthetic_frames(n, shape, noise):
+    # dots moving over a noisy background
+    rng = np.random.RandomState(4)
+    bg = rng.randint(0,50,size=shape).astype(np.uint8)
+    frames = []
+    for i in range(n):
+        frame = bg + rng.randint(0,noise+1,size=shape).astype(np.uint8)
+        for j in range(1 + i%3):
+            row = 20 + (i*7 + j*53) % (shape[0]-40)
+            col = 20 + (i*11 + j*97) % (shape[1]-40)
+            frame[row-3:row+4,col-3:col+4] = 250
+        frames.append(frame)
+    return bg, frames
+
+def get_stored_frames(pattern, n, bg_fname, bg_frames):
+    fnames = sorted(glob.glob(pattern))
+    if not fnames:
+        raise ValueError("no frames match %s" % pattern)
+    frames = [ cv2.imread(f, 0) for f in fnames[:n] ]
+    if bg_fname:
+        bg = cv2.imread(bg_fname, 0)
+    else:
+        bg = np.min(np.dstack(frames[:bg_frames]), 2)
+    return bg, frames
+
+def run(fd, frames, thresh):
+    """return (msec per frame array, features of each frame)"""
+    fd.detect(frames[0], thresh) # warm up (first call may allocate buffers)
+    times = []
+    results = []
+    for frame in frames:
+        t0 = time.time()
+        features,dmax = fd.detect(frame, thresh)
+        times.append( (time.time()-t0)*1000.0 )
+        results.append( sorted((int(r),int(c)) for r,c,lum in features) )
+    return np.array(times), results
+
+def agreement(reference, results, tol):
+    """
+    return (frames with the same detections, mean position error in px)
+
+    detections are the same if there are as many, and each is within
+    tol pixels of the reference.
+    """
+    agree = 0
+    errors = []
+    for a,b in zip(reference, results):
+        if len(a) != len(b):
+            continue
+        err = [ np.hypot(ra-rb,ca-cb) for (ra,ca),(rb,cb) in zip(a,b) ]
+        errors.extend(err)
+        if all(e <= tol for e in err):
+            agree += 1
+    return agree, np.mean(errors) if errors else np.nan
+
+def benchmark(name, bg, frames, args):
+    print '%s: %d frames of %dx%d' % (name, len(frames), frames[0].shape[1], frames[0].shape[0])
+    print '  %-12s %-7s %s %11s %s' % ('method', 'backend',
+            ' '.join('%6s' % ('p%d' % p) for p in PERCENTILES), 'agree', 'err px')
+    for method in args.methods:
+        reference = None
+        for backend in args.backends:
+            try:
+                fd = DotBGFeatureDetector("benchmark", method=method, show="", backend=backend)
+            except ValueError, e:
+                print '  %-12s %-7s %s' % (method, backend, e)
+                continue
+            fd.compute_bg(bg[:,:,np.newaxis])
+            times, results = run(fd, frames, args.thresh)
+            if reference is None:
+                reference = results
+            agree, err = agreement(reference, results, args.tol)
+            print '  %-12s %-7s %s %5d/%-5d %6.2f' % (method, backend,
+                    ' '.join('%6.2f' % np.percentile(times, p) for p in PERCENTILES),
+                    agree, len(frames), err)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--frames', type=str, default=None,
+                        help='glob of stored camera images to replay')
+    parser.add_argument('--bg', type=str, default=None,
+                        help='background image for --frames')
+    parser.add_argument('--bg-frames', type=int, default=20,
+                        help='number of --frames to compute the background from')
+    parser.add_argument('--n', type=int, default=200,
+                        help='(maximum) number of frames')
+    parser.add_argument('--width', type=int, default=659)
+    parser.add_argument('--height', type=int, default=494)
+    parser.add_argument('--noise', type=str, default='0,10,30',
+                        help='comma separated noise levels of the synthetic frames')
+    parser.add_argument('--thresh', type=int, default=100)
+    parser.add_argument('--tol', type=float, default=1.0,
+                        help='maximum distance (px) of agreeing detections')
+    parser.add_argument('--methods', type=str, default=','.join(sorted(DotBGFeatureDetector.DETECT_METHODS)))
+    parser.add_argument('--backends', type=str, default='scipy,opencv',
+                        help='comma separated, the first is the reference for agreement')
+    args = parser.parse_args()
+    args.methods = args.methods.split(',')
+    args.backends = args.backends.split(',')
+
+    print 'latency percentiles in msec, agreement with the %s backend' % args.backends[0]
+    if args.frames:
+        bg, frames = get_stored_frames(args.frames, args.n, args.bg, args.bg_frames)
+        benchmark(args.frames, bg, frames, args)
+    else:
+        for noise in map(int, args.noise.split(',')):
+            bg, frames = get_synthetic_frames(args.n, (args.height, args.width), noise)
+            benchmark('noise %d' % noise, bg, frames, args)
+
+if __name__=='__main__':
+    main()
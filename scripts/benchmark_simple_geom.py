@@ -0,0 +1,110 @@
+"""micro-benchmark of the ray/quadric intersection kernels in simple_geom
+
+Compares the current Cylinder and Sphere kernels against the previous
+implementation (which evaluated the sympy-generated expressions) and
+checks that both give the same results.
+"""
+import argparse
+import time
+import numpy as np
+
+import roslib
+roslib.load_manifest('flyvr')
+from flyvr.simple_geom import Cylinder, Sphere
+
+def vec3(a,b,c):
+    return dict(x=a, y=b, z=c)
+
+def legacy_cylinder_first_surface(cyl, a, b):
+    # previous Cylinder.get_relative_distance_to_first_surface() and
+    # get_first_surface(), with the base at the origin
+    a = a.T
+    b = b.T
+    ax, ay, az = a
+    sx, sy, sz = b-a
+    r = cyl.radius
+
+    old_settings = np.seterr(invalid='ignore')
+    t0 = (-ax*sx - ay*sy + (-ax**2*sy**2 + 2*ax*ay*sx*sy - ay**2*sx**2 + r**2*sx**2 + r**2*sy**2)**(0.5))/(sx**2 + sy**2)
+    t1 = (ax*sx + ay*sy + (-ax**2*sy**2 + 2*ax*ay*sx*sy - ay**2*sx**2 + r**2*sx**2 + r**2*sy**2)**(0.5))/(-sx**2 - sy**2)
+    tt = np.vstack((t0,t1))
+    np.seterr(**old_settings)
+
+    tt[tt <= 0] = np.nan
+    zz = az+sz*tt
+    tt[zz < 0] = np.nan
+    tt[zz > cyl.axis.z] = np.nan
+    tmin = np.nanmin(tt, axis=0)
+
+    result = np.vstack((ax+sx*tmin,ay+sy*tmin,az+sz*tmin)).T
+    return result, tmin
+
+def legacy_sphere_first_surface(sphere, a, b):
+    # previous Sphere.get_relative_distance_to_first_surface() and
+    # get_first_surface(), with the center at the origin
+    a = a.T
+    b = b.T
+    ax, ay, az = a
+    sx, sy, sz = b-a
+    r = sphere.radius
+
+    old_settings = np.seterr(invalid='ignore')
+    t0,t1 = [(ax*sx + ay*sy + az*sz + (-ax**2*sy**2 - ax**2*sz**2 + 2*ax*ay*sx*sy + 2*ax*az*sx*sz - ay**2*sx**2 - ay**2*sz**2 + 2*ay*az*sy*sz - az**2*sx**2 - az**2*sy**2 + r**2*sx**2 + r**2*sy**2 + r**2*sz**2)**(0.5))/(-sx**2 - sy**2 - sz**2), (-ax*sx - ay*sy - az*sz + (-ax**2*sy**2 - ax**2*sz**2 + 2*ax*ay*sx*sy + 2*ax*az*sx*sz - ay**2*sx**2 - ay**2*sz**2 + 2*ay*az*sy*sz - az**2*sx**2 - az**2*sy**2 + r**2*sx**2 + r**2*sy**2 + r**2*sz**2)**(0.5))/(sx**2 + sy**2 + sz**2)]
+    np.seterr(**old_settings)
+    tt = np.vstack((t0,t1))
+
+    tt[tt <= 0] = np.nan
+    tmin = np.nanmin(tt, axis=0)
+
+    result = np.vstack((ax+sx*tmin,ay+sy*tmin,az+sz*tmin)).T
+    return result, tmin
+
+def get_rays(n, dtype):
+    # rays from a camera inside the surface in random directions
+    rng = np.random.RandomState(3)
+    a = np.zeros( (n,3) ) + (0.2, 0.1, 0.5)
+    b = a + rng.normal(size=(n,3))
+    return a.astype(dtype), b.astype(dtype)
+
+def best_time(func, repeat):
+    best = np.inf
+    for i in range(repeat):
+        t0 = time.time()
+        result = func()
+        best = min(best, time.time()-t0)
+    return best, result
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n', type=int, default=1000000,
+                        help='number of rays')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--float32', action='store_true', default=False)
+    args = parser.parse_args()
+
+    dtype = np.float32 if args.float32 else np.float64
+    a, b = get_rays(args.n, dtype)
+
+    models = [(Cylinder(base=vec3(0,0,0), axis=vec3(0,0,1), radius=1.0, dtype=dtype),
+               legacy_cylinder_first_surface),
+              (Sphere(center=vec3(0,0,0), radius=1.0, dtype=dtype),
+               legacy_sphere_first_surface),
+              ]
+
+    print '%d rays, %s'%(args.n, np.dtype(dtype).name)
+    for model, legacy in models:
+        t_legacy, (pt_legacy, d_legacy) = best_time(
+            lambda: legacy(model, a, b), args.repeat)
+        t_new, (pt_new, d_new) = best_time(
+            lambda: model.get_first_surface_and_relative_distance(a, b), args.repeat)
+
+        good = ~np.isnan(d_legacy)
+        assert np.all( good == ~np.isnan(d_new) )
+        max_err = np.max(np.abs(pt_new[good]-pt_legacy[good]))
+
+        print '%s: legacy %.1f msec, new %.1f msec (%.1fx faster), max difference %.2g'%(
+            model.__class__.__name__, t_legacy*1000.0, t_new*1000.0,
+            t_legacy/t_new, max_err)
+
+if __name__=='__main__':
+    main()
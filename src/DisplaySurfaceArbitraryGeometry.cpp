@@ -3,6 +3,7 @@
 #include <limits>
 #include <sstream>
 
+#include <osg/BoundingBox>
 #include <osg/TriangleFunctor>
 #include <osg/TriangleIndexFunctor>
 #include <osg/io_utils>
@@ -77,6 +78,12 @@ DisplaySurfaceArbitraryGeometry::DisplaySurfaceArbitraryGeometry(std::string fil
   _lineseg_starters = new osg::Vec3Array;
   _lineseg_starters->push_back( osg::Vec3(0.0, 0.0, _precision) );
   _lineseg_starters->push_back( osg::Vec3(_precision, 0.0, 0.0) );
+
+  // Bounding volumes are computed lazily on first use. Compute them now,
+  // so that the intersection methods below only read the scene graph and
+  // may be called from several threads at once.
+  _geom_with_triangles_node->getBound();
+  _texcoords_with_triangles_node->getBound();
 }
 
 osg::ref_ptr<osg::Geometry> DisplaySurfaceArbitraryGeometry::make_geom(bool texcoord_colors) const {
@@ -123,10 +130,38 @@ osg::ref_ptr<osg::Geometry> DisplaySurfaceArbitraryGeometry::make_geom(bool texc
 }
 
 
+unsigned int DisplaySurfaceArbitraryGeometry::get_num_triangles() const {
+  return _triangle_indices.size();
+}
+
+void DisplaySurfaceArbitraryGeometry::get_triangle_bounds( double &xmin, double &ymin, double &zmin,
+                                                           double &xmax, double &ymax, double &zmax ) const {
+  // bounding box of the triangle corners (not of all vertices)
+  osg::BoundingBox bb;
+  osg::Vec3Array *verts = dynamic_cast<osg::Vec3Array*>(_geom_with_triangles->getVertexArray());
+  if (verts) {
+    for (unsigned int i=0; i<_triangle_indices.size(); ++i) {
+      TriangleIndex tri_idxs = _triangle_indices.at(i);
+      bb.expandBy( verts->at(tri_idxs._p1) );
+      bb.expandBy( verts->at(tri_idxs._p2) );
+      bb.expandBy( verts->at(tri_idxs._p3) );
+    }
+  }
+  xmin = bb.xMin(); ymin = bb.yMin(); zmin = bb.zMin();
+  xmax = bb.xMax(); ymax = bb.yMax(); zmax = bb.zMax();
+}
+
 void DisplaySurfaceArbitraryGeometry::addTriangle(unsigned int p1,unsigned int p2,unsigned int p3) {
   _triangle_indices.push_back( TriangleIndex(p1,p2,p3) );
 }
 
+// Thread safety of texcoord2worldcoord, worldcoord2texcoord and
+// get_first_surface: each call creates its own LineSegmentIntersector
+// and IntersectionVisitor, which hold all state of the traversal. The
+// shared nodes and drawables are only read (their bounds were computed
+// in the constructor). The traversal takes references to the shared
+// drawables, and OSG's reference counts are atomic (OpenThreads::Atomic).
+
 int DisplaySurfaceArbitraryGeometry::texcoord2worldcoord( double u, double v, double& x, double &y, double &z) {
   return invert_coord( u, v, 0.0,    x, y, z, _texcoords_with_triangles_node, true);
 }
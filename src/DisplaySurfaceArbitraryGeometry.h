@@ -32,6 +32,10 @@ public:
 
   osg::ref_ptr<osg::Geometry> make_geom(bool texcoord_colors=false) const;
 
+  unsigned int get_num_triangles() const;
+  void get_triangle_bounds( double &xmin, double &ymin, double &zmin,
+                            double &xmax, double &ymax, double &zmax ) const;
+
 
   void addTriangle(unsigned int p1,unsigned int p2,unsigned int p3);
 private:
@@ -3,8 +3,11 @@ from libcpp.string cimport string
 cdef extern from "DisplaySurfaceArbitraryGeometry.h" namespace "flyvr":
     cdef cppclass DisplaySurfaceArbitraryGeometry:
         DisplaySurfaceArbitraryGeometry(string filename, double precision) nogil except +
-        int texcoord2worldcoord( double u, double v, double &x, double &y, double &z )
-        int worldcoord2texcoord( double x, double y, double z, double &u, double &v)
+        int texcoord2worldcoord( double u, double v, double &x, double &y, double &z ) nogil
+        int worldcoord2texcoord( double x, double y, double z, double &u, double &v) nogil
         int get_first_surface( double ax, double ay, double az,
                                double bx, double by, double bz,
-                               double &sx, double &sy, double &sz )
+                               double &sx, double &sy, double &sz ) nogil
+        unsigned int get_num_triangles()
+        void get_triangle_bounds( double &xmin, double &ymin, double &zmin,
+                                  double &xmax, double &ymax, double &zmax )
@@ -1,129 +1,250 @@
 from libcpp.string cimport string
 import flyvr
+import os
 import sys
 import flyvr.simple_geom
+import flyvr.mesh_geom
 
 import numpy as np
 cimport numpy as np
+cimport cython
+from cython.parallel cimport prange
 
 from DisplaySurfaceArbitraryGeometry_wrap cimport DisplaySurfaceArbitraryGeometry as cpp_DisplaySurfaceArbitraryGeometry
 
 cdef class DisplaySurfaceArbitraryGeometry:
+    """wrapper of the C++ class, evaluating many points per call
+
+    Each method takes 1D float64 arrays and returns 1D float64 arrays
+    plus an int32 status array, which is nonzero where the C++ method
+    failed. The input arrays may be read-only. The loops run without
+    the GIL. With num_threads > 1 they are distributed over OpenMP
+    threads (if compiled with OpenMP), otherwise they run serially.
+    The C++ methods may run concurrently: each call intersects the
+    scene graph with its own intersector and visitor, and only reads
+    the shared graph (see DisplaySurfaceArbitraryGeometry.cpp).
+    """
     cdef cpp_DisplaySurfaceArbitraryGeometry *thisptr
-    def __cinit__(self, string filename, double precision):
+    cdef int num_threads
+    def __cinit__(self, string filename, double precision, int num_threads=1):
         self.thisptr = new cpp_DisplaySurfaceArbitraryGeometry(filename,precision)
+        self.num_threads = num_threads
     def __dealloc__(self):
         del self.thisptr
-    def texcoord2worldcoord(self, np.ndarray[np.float_t] u, np.ndarray[np.float_t] v):
-        cdef np.ndarray[np.float_t] x = np.zeros( (u.shape[0],), dtype=np.float)
-        cdef np.ndarray[np.float_t] y = np.zeros( (u.shape[0],), dtype=np.float)
-        cdef np.ndarray[np.float_t] z = np.zeros( (u.shape[0],), dtype=np.float)
-        cdef double xi=0, yi=0, zi=0
-        cdef int err
-        for i in range( u.shape[0] ):
-            err = self.thisptr.texcoord2worldcoord( u[i], v[i], xi, yi, zi )
-            if err:
-                raise RuntimeError(
-                    'failed: self.thisptr.texcoord2worldcoord()=%d'%err)
-            x[i] = xi
-            y[i] = yi
-            z[i] = zi
-        return x,y,z
-    def worldcoord2texcoord(self, np.ndarray[np.float_t] x, np.ndarray[np.float_t] y, np.ndarray[np.float_t] z):
-        cdef np.ndarray[np.float_t] u = np.zeros( (x.shape[0],), dtype=np.float)
-        cdef np.ndarray[np.float_t] v = np.zeros( (x.shape[0],), dtype=np.float)
-        cdef double ui=0, vi=0
-        cdef int err
-        for i in range( x.shape[0] ):
-            err = self.thisptr.worldcoord2texcoord( x[i], y[i], z[i], ui, vi )
-            if err:
-                raise RuntimeError(
-                    'failed: self.thisptr.worldcoord2texcoord()=%d'%err)
-            u[i] = ui
-            v[i] = vi
-        return u,v
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def texcoord2worldcoord(self, const double[:] u, const double[:] v):
+        cdef Py_ssize_t n = u.shape[0]
+        x = np.empty( (n,), dtype=np.float64)
+        y = np.empty( (n,), dtype=np.float64)
+        z = np.empty( (n,), dtype=np.float64)
+        status = np.empty( (n,), dtype=np.intc)
+        cdef double[:] xv = x, yv = y, zv = z
+        cdef int[:] sv = status
+        cdef double xi, yi, zi
+        cdef Py_ssize_t i
+        for i in prange( n, nogil=True, num_threads=self.num_threads, schedule='dynamic' ):
+            xi = yi = zi = 0
+            sv[i] = self.thisptr.texcoord2worldcoord( u[i], v[i], xi, yi, zi )
+            xv[i] = xi
+            yv[i] = yi
+            zv[i] = zi
+        return x,y,z,status
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def worldcoord2texcoord(self, const double[:] x, const double[:] y, const double[:] z):
+        cdef Py_ssize_t n = x.shape[0]
+        u = np.empty( (n,), dtype=np.float64)
+        v = np.empty( (n,), dtype=np.float64)
+        status = np.empty( (n,), dtype=np.intc)
+        cdef double[:] uv = u, vv = v
+        cdef int[:] sv = status
+        cdef double ui, vi
+        cdef Py_ssize_t i
+        for i in prange( n, nogil=True, num_threads=self.num_threads, schedule='dynamic' ):
+            ui = vi = 0
+            sv[i] = self.thisptr.worldcoord2texcoord( x[i], y[i], z[i], ui, vi )
+            uv[i] = ui
+            vv[i] = vi
+        return u,v,status
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
     def get_first_surface(self,
-                          np.ndarray[np.float_t] ax,
-                          np.ndarray[np.float_t] ay,
-                          np.ndarray[np.float_t] az,
-                          np.ndarray[np.float_t] bx,
-                          np.ndarray[np.float_t] by,
-                          np.ndarray[np.float_t] bz):
-        cdef np.ndarray[np.float_t] sx = np.zeros( (ax.shape[0],), dtype=np.float)
-        cdef np.ndarray[np.float_t] sy = np.zeros( (ax.shape[0],), dtype=np.float)
-        cdef np.ndarray[np.float_t] sz = np.zeros( (ax.shape[0],), dtype=np.float)
-        cdef double sxi=0, syi=0, szi=0
-        cdef int err
-        for i in range( ax.shape[0] ):
-            err = self.thisptr.get_first_surface( ax[i], ay[i], az[i],
-                                                  bx[i], by[i], bz[i],
-                                                  sxi, syi, szi)
-            if err:
-                raise RuntimeError(
-                    'failed: self.thisptr.get_first_surface()=%d'%err)
-            sx[i] = sxi
-            sy[i] = syi
-            sz[i] = szi
-        return sx,sy,sz
+                          const double[:] ax,
+                          const double[:] ay,
+                          const double[:] az,
+                          const double[:] bx,
+                          const double[:] by,
+                          const double[:] bz):
+        cdef Py_ssize_t n = ax.shape[0]
+        sx = np.empty( (n,), dtype=np.float64)
+        sy = np.empty( (n,), dtype=np.float64)
+        sz = np.empty( (n,), dtype=np.float64)
+        status = np.empty( (n,), dtype=np.intc)
+        cdef double[:] sxv = sx, syv = sy, szv = sz
+        cdef int[:] sv = status
+        cdef double sxi, syi, szi
+        cdef Py_ssize_t i
+        for i in prange( n, nogil=True, num_threads=self.num_threads, schedule='dynamic' ):
+            sxi = syi = szi = 0
+            sv[i] = self.thisptr.get_first_surface( ax[i], ay[i], az[i],
+                                                    bx[i], by[i], bz[i],
+                                                    sxi, syi, szi )
+            sxv[i] = sxi
+            syv[i] = syi
+            szv[i] = szi
+        return sx,sy,sz,status
+    def get_num_triangles(self):
+        return self.thisptr.get_num_triangles()
+    def get_triangle_bounds(self):
+        """return (lo, hi), the corners of the bounding box of the triangles"""
+        cdef double xmin, ymin, zmin, xmax, ymax, zmax
+        self.thisptr.get_triangle_bounds( xmin, ymin, zmin, xmax, ymax, zmax )
+        return np.array([xmin,ymin,zmin]), np.array([xmax,ymax,zmax])
+
+def _check_status(status, name):
+    """raise RuntimeError if any element of status is nonzero"""
+    bad = np.nonzero(status)[0]
+    if len(bad):
+        raise RuntimeError(
+            'failed: self.thisptr.%s() for %d of %d elements (first %d=%d)'%(
+            name, len(bad), len(status), bad[0], status[bad[0]]))
 
 class ArbitraryGeometry(flyvr.simple_geom.ModelBase):
-    def __init__(self, string filename, double precision):
+    """display surface given by a mesh loaded with OpenSceneGraph
+
+    If use_cache is True, the texture coordinate index and center are
+    saved in (or loaded from) the directory given by
+    flyvr.mesh_geom.get_mesh_cache_dir().
+    """
+    def __init__(self, string filename, double precision, int num_threads=1,
+                 use_cache=True):
         self._filename = filename
         self._precision = precision
-        self.geom = DisplaySurfaceArbitraryGeometry(filename,precision)
-
-        u = np.expand_dims(np.linspace(0.0,1.0,20.),1)
-        v = np.expand_dims(np.linspace(0.0,1.0,20.),0)
-        U, V = np.broadcast_arrays(u,v)
-        tcs = np.vstack((U.flatten(),V.flatten())).T
-        wcs = self.texcoord2worldcoord(tcs)
-        self.center_arr = np.mean(wcs,axis=0)
+        self.geom = DisplaySurfaceArbitraryGeometry(filename,precision,num_threads)
+
+        arrays = None
+        if use_cache:
+            key = flyvr.mesh_geom.get_mesh_cache_key(filename, precision, 'ArbitraryGeometry')
+            arrays = flyvr.mesh_geom.load_mesh_cache(key)
+        if arrays is not None:
+            self._set_cache_arrays(arrays)
+        else:
+            self._init_texcoord_index()
+
+            u = np.expand_dims(np.linspace(0.0,1.0,20.),1)
+            v = np.expand_dims(np.linspace(0.0,1.0,20.),0)
+            U, V = np.broadcast_arrays(u,v)
+            tcs = np.vstack((U.flatten(),V.flatten())).T
+            wcs = self.texcoord2worldcoord(tcs)
+            self.center_arr = np.mean(wcs,axis=0)
+            if use_cache:
+                flyvr.mesh_geom.save_mesh_cache(key, self._get_cache_arrays())
         super(ArbitraryGeometry,self).__init__()
 
     def __repr__(self):
         return '<PyDisplaySurfaceArbitraryGeometry.ArbitraryGeometry filename=%r precision=%s>'%(
             self._filename,self._precision)
 
+    def _init_texcoord_index(self):
+        # For file types which flyvr.mesh_geom can read, worldcoord2texcoord
+        # uses a spatial index of the triangles instead of searching the
+        # whole scene graph for every point. The index is only used if
+        # the triangles loaded by flyvr.mesh_geom are those found by OSG,
+        # otherwise (or if loading fails for any reason) the C++ code is
+        # used.
+        self._grid = None
+        ext = os.path.splitext(self._filename)[1].lower()
+        if ext not in ('.osg','.obj'):
+            return
+        try:
+            verts, texcoords, triangles = flyvr.mesh_geom.load_mesh(self._filename)
+        except Exception:
+            return
+        if len(triangles) != self.geom.get_num_triangles():
+            return
+        lo, hi = self.geom.get_triangle_bounds()
+        tri_verts = verts[triangles]
+        # OSG stores single precision vertices
+        atol = self._precision + 1e-6*np.max(np.abs(np.append(lo,hi)))
+        if not (np.allclose(tri_verts.min(axis=(0,1)), lo, rtol=0, atol=atol) and
+                np.allclose(tri_verts.max(axis=(0,1)), hi, rtol=0, atol=atol)):
+            return
+        self._grid = flyvr.mesh_geom.TriangleGrid(tri_verts, self._precision)
+        self._texcoords = texcoords
+        self._triangles = triangles
+
+    def _get_cache_arrays(self):
+        arrays = dict(center_arr=self.center_arr)
+        if self._grid is not None:
+            arrays.update( self._grid.to_arrays('grid_') )
+            arrays['texcoords'] = self._texcoords
+            arrays['triangles'] = self._triangles
+        return arrays
+
+    def _set_cache_arrays(self, arrays):
+        self.center_arr = arrays['center_arr']
+        self._grid = None
+        if 'texcoords' in arrays:
+            self._grid = flyvr.mesh_geom.TriangleGrid.from_arrays(arrays, 'grid_')
+            self._texcoords = arrays['texcoords']
+            self._triangles = arrays['triangles']
+
     def texcoord2worldcoord(self,tc):
         # Parse inputs
-        tc = np.array(tc,copy=False)
+        tc = np.array(tc,dtype=np.float64,copy=False)
         assert tc.ndim==2
         assert tc.shape[1]==2
         tc = tc.T
 
         u, v = tc
-        x,y,z = self.geom.texcoord2worldcoord(u,v)
+        x,y,z,status = self.geom.texcoord2worldcoord(u,v)
+        _check_status(status,'texcoord2worldcoord')
         result = np.array( [x,y,z] ).T
         return result
 
     def worldcoord2texcoord(self,wc):
         # Parse inputs
-        wc = np.array(wc,copy=False)
+        wc = np.array(wc,dtype=np.float64,copy=False)
         assert wc.ndim==2
         assert wc.shape[1]==3
-        wc = wc.T
 
+        if self._grid is not None:
+            tri, bary = self._grid.locate(wc)
+            return flyvr.mesh_geom.interpolate_triangles(
+                self._texcoords, self._triangles, tri, bary)
+
+        wc = wc.T
         x,y,z = wc
-        u,v = self.geom.worldcoord2texcoord(x,y,z)
+        u,v,status = self.geom.worldcoord2texcoord(x,y,z)
+        _check_status(status,'worldcoord2texcoord')
         result = np.array( [u,v] ).T
         return result
 
     def get_first_surface(self,a,b):
         def split3(arr):
-            # Parse inputs
-            arr = np.array(arr,copy=False)
+            # Parse inputs (always computed in double precision)
+            arr = np.array(arr,dtype=np.float,copy=False)
             assert arr.ndim==2
             assert arr.shape[1]==3
             return arr.T
 
         ax,ay,az = split3(a)
         bx,by,bz = split3(b)
-        sx,sy,sz = self.geom.get_first_surface(ax,ay,az, bx,by,bz)
+        sx,sy,sz,status = self.geom.get_first_surface(ax,ay,az, bx,by,bz)
+        _check_status(status,'get_first_surface')
         result = np.array( [sx,sy,sz] ).T
         return result
 
     def get_relative_distance_to_first_surface(self,a,b):
         s = self.get_first_surface(a,b)
+        return self._get_relative_distance(a,b,s)
+
+    def get_first_surface_and_relative_distance(self,a,b):
+        s = self.get_first_surface(a,b)
+        return s, self._get_relative_distance(a,b,s)
+
+    def _get_relative_distance(self,a,b,s):
         bdist = np.sqrt(np.sum((b-a)**2,axis=1))
         sdist = np.sqrt(np.sum((s-a)**2,axis=1))
         return sdist/bdist
@@ -1,9 +1,11 @@
 import roslib
 roslib.load_manifest('sensor_msgs')
 roslib.load_manifest('dynamic_reconfigure')
+roslib.load_manifest('diagnostic_msgs')
 
 import rospy
 import sensor_msgs.msg
+import diagnostic_msgs.msg
 import dynamic_reconfigure.srv
 import dynamic_reconfigure.encoding
 
@@ -11,6 +13,211 @@ import numpy as np
 import time
 import os.path
 import Queue
+import collections
+import threading
+
+def image_to_array(msg):
+    """return a (read-only) HxW uint8 view of the data of a mono8 sensor_msgs/Image, without a copy"""
+    imarr = np.frombuffer(msg.data, dtype=np.uint8)
+    #rows may be padded to step bytes
+    return imarr.reshape((msg.height, msg.step))[:,:msg.width]
+
+class FrameStack(object):
+    """
+    preallocated ring buffer of the last capacity frames of one camera
+
+    the memory is reused for as long as the frame size does not change,
+    so collecting frames does not allocate. Frames are stored one after
+    the other (N x H x W), array returns them as a H x W x N view.
+    """
+    def __init__(self, capacity=1):
+        self._buf = np.empty((0,0,0),dtype=np.uint8)
+        self._n = 0
+        self.capacity = capacity
+
+    def __len__(self):
+        return min(self._n, self.capacity)
+
+    def reset(self, capacity):
+        """discard all frames, and hold up to capacity frames from now on"""
+        self.capacity = capacity
+        self._n = 0
+
+    def append(self, imarr):
+        """
+        copy imarr into the buffer, overwriting the oldest frame when full.
+        Returns the copy (a view of the buffer)
+        """
+        shape = imarr.shape
+        if self._buf.shape[1:] != shape or len(self._buf) < self.capacity:
+            if self._n:
+                raise ValueError("frame size changed from %s to %s" % (self._buf.shape[1:], shape))
+            self._buf = np.empty((self.capacity,)+shape, dtype=np.uint8)
+        frame = self._buf[self._n % self.capacity]
+        frame[:] = imarr
+        self._n += 1
+        return frame
+
+    @property
+    def array(self):
+        """
+        the frames as a H x W x N view (in arrival order unless more than
+        capacity frames were appended). The view is only valid until the
+        next reset()
+        """
+        return self._buf[:len(self)].transpose(1,2,0)
+
+class AcquisitionTimeout(Exception):
+    pass
+
+class FrameQueue(object):
+    """
+    bounded FIFO of the frames of several cameras
+
+    unlike Queue.Queue, get() without a deadline does not poll, it returns
+    as soon as a frame is put. Only get() with a deadline waits with a
+    timeout (which in python 2 sleeps in steps of up to 50ms).
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.closed = False
+        self._items = collections.deque()
+        self._cond = threading.Condition(threading.Lock())
+
+    def __len__(self):
+        with self._cond:
+            return len(self._items)
+
+    def put_nowait(self, item):
+        with self._cond:
+            if len(self._items) >= self.maxsize:
+                raise Queue.Full
+            self._items.append(item)
+            self._cond.notify()
+
+    def get_nowait(self):
+        with self._cond:
+            if not self._items:
+                raise Queue.Empty
+            return self._items.popleft()
+
+    def clear(self):
+        """discard all frames, return how many there were"""
+        with self._cond:
+            n = len(self._items)
+            self._items.clear()
+            return n
+
+    def close(self):
+        """wake all waiting threads, get() raises Queue.Empty from now on"""
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def get(self, deadline=None):
+        """
+        return the oldest frame, waiting for one if necessary until deadline
+        (time.time() seconds, None waits forever). Raises Queue.Empty after
+        deadline, or when closed
+        """
+        with self._cond:
+            while not self._items:
+                if self.closed:
+                    raise Queue.Empty
+                if deadline is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise Queue.Empty
+                    self._cond.wait(remaining)
+            return self._items.popleft()
+
+class FrameSynchronizer(object):
+    """
+    groups the frames of several cameras into sets taken at the same time
+
+    frames are queued per camera. A set is complete when every camera has
+    a frame whose header.stamp is within tolerance (seconds) of the newest
+    of them. Frames older than that can never be part of a set, and are
+    discarded (and counted in dropped). At most maxlen frames are queued per
+    camera, when full the oldest is discarded (and counted in dropped).
+    """
+    def __init__(self, cameras, tolerance, maxlen=20):
+        self.cameras = list(cameras)
+        self.tolerance = tolerance
+        self._queues = {cam:collections.deque(maxlen=maxlen) for cam in self.cameras}
+        self.dropped = {cam:0 for cam in self.cameras}
+
+    def reset(self):
+        """discard the queued frames (without counting them as dropped)"""
+        for q in self._queues.values():
+            q.clear()
+
+    def add(self, camera, stamp, item):
+        """
+        queue item of camera taken at stamp (seconds), return a (possibly
+        empty) list of the frame-sets completed by it. Each set is a dict
+        of camera:item
+        """
+        q = self._queues[camera]
+        if len(q) == q.maxlen:
+            self.dropped[camera] += 1
+        q.append( (stamp,item) )
+        sets = []
+        while all(self._queues.values()):
+            t_newest = max(q[0][0] for q in self._queues.values())
+            complete = True
+            for cam,q in self._queues.items():
+                while q and q[0][0] < t_newest - self.tolerance:
+                    q.popleft()
+                    self.dropped[cam] += 1
+                if not q:
+                    complete = False
+            if complete:
+                sets.append( {cam:q.popleft()[1] for cam,q in self._queues.items()} )
+        return sets
+
+class CameraStats(object):
+    """
+    arrival statistics of the frames of one camera
+
+    latency (arrival time - header.stamp), interval (between the stamps of
+    consecutive frames) and queue_depth (frames waiting in the queue when
+    the frame arrived) are kept for the last maxlen frames. received,
+    dropped (the queue was full) and used (taken by a runner) count all
+    frames.
+    """
+    def __init__(self, maxlen=500):
+        self.latency = collections.deque(maxlen=maxlen)
+        self.interval = collections.deque(maxlen=maxlen)
+        self.queue_depth = collections.deque(maxlen=maxlen)
+        self.received = 0
+        self.dropped = 0
+        self.used = 0
+        self._last_stamp = None
+
+    def frame_arrived(self, stamp, t_arrival, queue_depth):
+        if self._last_stamp is not None:
+            self.interval.append(stamp - self._last_stamp)
+        self._last_stamp = stamp
+        self.latency.append(t_arrival - stamp)
+        self.queue_depth.append(queue_depth)
+        self.received += 1
+
+    def summary(self, percentiles=(50,90,99)):
+        """
+        returns a dict of the counts and the percentiles of latency, interval
+        (both in seconds) and queue_depth, e.g. latency_p90 (nan without data)
+        """
+        res = dict(received=self.received, dropped=self.dropped, used=self.used)
+        for name in ("latency","interval","queue_depth"):
+            #copy, frames arrive in another thread
+            vals = list(getattr(self,name))
+            for p in percentiles:
+                res["%s_p%d" % (name,p)] = np.percentile(vals,p) if vals else np.nan
+        return res
 
 class CameraHandler(object):
     def __init__(self,topic_prefix='',debug=False,enable_dynamic_reconfigure=False):
@@ -21,6 +228,8 @@ class CameraHandler(object):
         self.pipeline_max_latency = 0.2
         self.last_image = None
         self.im_queue = None
+        self.frames = FrameStack()
+        self.stats = CameraStats()
 
         self.recon = None
         if enable_dynamic_reconfigure:
@@ -43,11 +252,7 @@ class CameraHandler(object):
                 self.recon(msg)
                 if self.im_queue is not None:
                     #clear the queue so we get a new image with the new settings
-                    while True:
-                        try:
-                            self.im_queue.get_nowait()
-                        except Queue.Empty:
-                            break
+                    self.im_queue.clear()
 
     def set_im_queue(self,q):
         self.im_queue = q
@@ -55,23 +260,37 @@ class CameraHandler(object):
     def get_image_callback(self,msg):
         if self.im_queue is None:
             return
+        t_arrival = time.time()
+        stamp = msg.header.stamp.to_sec()
+        self.stats.frame_arrived(stamp, t_arrival, len(self.im_queue))
         try:
             if self.debug:
-                print "%s got image: %f" % (self.topic_prefix, msg.header.stamp.to_sec())
-            self.im_queue.put_nowait((self.topic_prefix,msg))
+                print "%s got image: %f" % (self.topic_prefix, stamp)
+            self.im_queue.put_nowait((self.topic_prefix,msg,image_to_array(msg)))
         except Queue.Full:
+            self.stats.dropped += 1
             if self.debug:
                 print self.topic_prefix,"full"
 
 class _Runner(object):
-    def __init__(self,cam_handlers,ros_latency=0.2,queue_depth=20):
+    def __init__(self,cam_handlers,ros_latency=0.2,queue_depth=20,timeout=None):
+        """
+        get_images() raises AcquisitionTimeout if the images have not arrived
+        after timeout seconds (None waits forever)
+        """
         self.cam_handlers = cam_handlers
-        self.im_queue = Queue.Queue(len(cam_handlers)*queue_depth)
+        self.im_queue = FrameQueue(len(cam_handlers)*queue_depth)
+        rospy.on_shutdown(self.im_queue.close)
+        self._handlers = {}
         for ch in self.cam_handlers:
             ch.set_im_queue(self.im_queue)
+            self._handlers[ch.topic_prefix] = ch
         self.ros_latency = ros_latency
         self.max_cam_latency = max( [ch.pipeline_max_latency for ch in self.cam_handlers ])
+        self.timeout = timeout
         self._result = {}
+        self._n_per_camera = 0
+        self._missing = set()
 
     @property
     def result(self):
@@ -79,70 +298,152 @@ class _Runner(object):
 
     @property
     def result_as_nparray(self):
-        res = {}
-        for cam in self._result:
-            nimgs = len(self._result[cam])
-            tmpres = [0]*nimgs
-            for i in range(nimgs):
-                msg = self._result[cam][i]
-                shape = (msg.height, msg.width)
-                imarr = np.fromstring(msg.data,dtype=np.uint8)
-                imarr.shape = (msg.height, msg.width)
-                tmpres[i] = imarr
-            #sad to use dstack here, IMO res[cam][:,:,i] = imarr
-            #should have worked. 
-            res[cam] = np.dstack(tmpres)
-        return res
+        """
+        the images of the last get_images() as a dict of H x W x N uint8
+        arrays. These are views of the preallocated frame buffers, valid
+        until the next get_images()
+        """
+        return {cam:self._handlers[cam].frames.array for cam in self._result}
+
+    def _reset_result(self, n_per_camera):
+        self._result.clear()
+        self._n_per_camera = n_per_camera
+        self._missing = set()
+        for ch in self.cam_handlers:
+            self._result[ch.topic_prefix] = []
+            ch.frames.reset(n_per_camera)
+            if n_per_camera > 0:
+                self._missing.add(ch.topic_prefix)
+
+    def _add_result(self, topic_prefix, msg, imarr, verbose=False):
+        """
+        keep the image if topic_prefix needs more, return the kept copy
+        (or None)
+        """
+        if topic_prefix not in self._missing:
+            return None
+        self._result[topic_prefix].append( msg )
+        frame = self._handlers[topic_prefix].frames.append( imarr )
+        self._handlers[topic_prefix].stats.used += 1
+        if len(self._result[topic_prefix]) >= self._n_per_camera:
+            self._missing.discard(topic_prefix)
+        if verbose:
+            rospy.loginfo('  have %d frames for %r'%(len(self._result[topic_prefix]), topic_prefix))
+        return frame
+
+    def _get_deadline(self, timeout):
+        if timeout is None:
+            timeout = self.timeout
+        if timeout is None:
+            return None
+        return time.time() + timeout
+
+    def _get_frame(self, deadline):
+        try:
+            return self.im_queue.get(deadline)
+        except Queue.Empty:
+            if self.im_queue.closed:
+                raise rospy.ROSInterruptException("shutdown while waiting for images")
+            raise AcquisitionTimeout("timeout waiting for images, have %s of %d per camera" % (
+                ", ".join("%s:%d" % (cam,len(self._result[cam])) for cam in sorted(self._result)),
+                self._n_per_camera))
+
+    def get_stats(self, percentiles=(50,90,99)):
+        """returns a dict of camera:CameraStats.summary()"""
+        return {ch.topic_prefix:ch.stats.summary(percentiles) for ch in self.cam_handlers}
 
     def cycle_duration( self, dur ):
-        tstart = time.time()
-        while (time.time() - tstart) < dur:
-            time.sleep(0.05) # wait 50 msec
+        time.sleep(dur)
 
     def clear_queue(self):
-        q = self.im_queue
-        while 1:
-            try:
-                q.get_nowait()
-            except Queue.Empty:
-                break
-
-    def _is_done(self,rdict,n_per_camera,verbose=False):
-        done=True
-        for topic_prefix in rdict.keys():
-            if verbose:
-                rospy.loginfo('  _is_done() has %d frames for %r'%(len(rdict[topic_prefix]), topic_prefix))
-            if len(rdict[topic_prefix]) < n_per_camera:
-                done=False
-        return done
+        self.im_queue.clear()
 
 class SimultaneousCameraRunner(_Runner):
-    def __init__(self,cam_handlers,**kwargs):
+    def __init__(self,cam_handlers,sync_tolerance=None,**kwargs):
+        """
+        if sync_tolerance (seconds) is given, the Nth image of each camera
+        is from the same trigger (header.stamp within sync_tolerance), see
+        FrameSynchronizer
+        """
         _Runner.__init__(self, cam_handlers,**kwargs)
+        self.synchronizer = None
+        if sync_tolerance is not None:
+            self.synchronizer = FrameSynchronizer(
+                                    [ch.topic_prefix for ch in self.cam_handlers],
+                                    sync_tolerance,
+                                    maxlen=kwargs.get("queue_depth",20))
 
-    def get_images(self,n_per_camera, pre_func=None, pre_func_args=[], post_func=None, post_func_args=[], verbose=False):
-        self._result.clear()
-        for ch in self.cam_handlers:
-            self._result[ch.topic_prefix] = []
+    @property
+    def frames_dropped(self):
+        """the number of frames of each camera discarded by the synchronizer"""
+        if self.synchronizer is None:
+            return {}
+        return dict(self.synchronizer.dropped)
+
+    def get_stats(self, percentiles=(50,90,99)):
+        """
+        returns a dict of camera:CameraStats.summary(), which also counts the
+        frames discarded by the synchronizer (unmatched)
+        """
+        stats = _Runner.get_stats(self, percentiles)
+        dropped = self.frames_dropped
+        for cam in stats:
+            stats[cam]["unmatched"] = dropped.get(cam,0)
+        return stats
+
+    def get_images(self,n_per_camera, pre_func=None, pre_func_args=[], post_func=None, post_func_args=[], verbose=False, timeout=None):
+        for frame in self.iter_images(n_per_camera, pre_func, pre_func_args, post_func, post_func_args, verbose, timeout):
+            pass
+
+    def iter_images(self,n_per_camera, pre_func=None, pre_func_args=[], post_func=None, post_func_args=[], verbose=False, timeout=None):
+        """
+        like get_images(), but yields (camera, imarr, stamp) for each image as
+        soon as it arrives (or, with sync_tolerance, the images of each
+        frame-set as soon as the set is complete), so the caller can process
+        them while the others are acquired.
+
+        imarr is valid until the next get_images()/iter_images(). Frames are
+        only taken from the queue when the caller asks for the next one; the
+        queue holds queue_depth frames per camera, and the cameras drop frames
+        while it is full. post_func is called when all images have arrived,
+        or when the generator is closed.
+        """
+        self._reset_result(n_per_camera)
 
         #clear the queue
         self.clear_queue()
+        if self.synchronizer is not None:
+            self.synchronizer.reset()
+            dropped = sum(self.synchronizer.dropped.values())
 
         if pre_func: pre_func(*pre_func_args)
         t_latest = time.time() + (self.ros_latency + self.max_cam_latency)*n_per_camera
+        deadline = self._get_deadline(timeout)
 
         #wait for the images to arrive
-        while not self._is_done(self._result,n_per_camera,verbose=verbose):
-            try:
-                topic_prefix, msg = self.im_queue.get(1,10.0) # block, 10 second timeout
-            except Queue.Empty:
-                continue
-            t_image = msg.header.stamp.to_sec()
-            if t_image > t_latest:
-                rospy.logwarn("image from %s at t=%f was too slow (by %f)" % (topic_prefix, t_image, t_image - t_latest))
-            self._result[topic_prefix].append( msg )
+        try:
+            while self._missing:
+                topic_prefix, msg, imarr = self._get_frame(deadline)
+                t_image = msg.header.stamp.to_sec()
+                if t_image > t_latest:
+                    rospy.logwarn("image from %s at t=%f was too slow (by %f)" % (topic_prefix, t_image, t_image - t_latest))
+                if self.synchronizer is None:
+                    framesets = [ {topic_prefix:(msg,imarr)} ]
+                else:
+                    framesets = self.synchronizer.add(topic_prefix, t_image, (msg,imarr))
+                for frameset in framesets:
+                    for cam in sorted(frameset):
+                        msg,imarr = frameset[cam]
+                        frame = self._add_result(cam, msg, imarr, verbose)
+                        if frame is not None:
+                            yield cam, frame, msg.header.stamp.to_sec()
+        finally:
+            if post_func: post_func(*post_func_args)
 
-        if post_func: post_func(*post_func_args)
+            if self.synchronizer is not None:
+                dropped = sum(self.synchronizer.dropped.values()) - dropped
+                if dropped:
+                    rospy.logdebug("synchronizer dropped %d unmatched images" % dropped)
 
 class SequentialCameraRunner(_Runner):
     def __init__(self,cam_handlers,**kwargs):
@@ -151,20 +452,16 @@ class SequentialCameraRunner(_Runner):
         self.check_earliest = False
         self.check_latest = False
 
-    def get_images(self,n_per_camera,verbose=False):
-        self._result.clear()
-        for ch in self.cam_handlers:
-            self._result[ch.topic_prefix] = []
+    def get_images(self,n_per_camera,verbose=False,timeout=None):
+        self._reset_result(n_per_camera)
 
         t_earliest = time.time()
         self.clear_queue()
         t_latest = t_earliest + (self.ros_latency + self.max_cam_latency)
+        deadline = self._get_deadline(timeout)
 
-        while not self._is_done(self._result,n_per_camera,verbose=verbose):
-            try:
-                topic_prefix, msg = self.im_queue.get(1,10.0) # block, 10 second timeout
-            except Queue.Empty:
-                continue
+        while self._missing:
+            topic_prefix, msg, imarr = self._get_frame(deadline)
 
             t_image = msg.header.stamp.to_sec()
             if self.check_latest and t_image > t_latest:
@@ -173,5 +470,47 @@ class SequentialCameraRunner(_Runner):
                 rospy.logwarn("image from %s at t=%f was too early (by %f)" % (topic_prefix, t_image, t_earliest - t_image))
                 continue
 
-            self._result[topic_prefix].append( msg )
+            self._add_result(topic_prefix, msg, imarr, verbose)
+
+class AcquisitionDiagnostics(object):
+    """
+    publishes the get_stats() of runners every period seconds, as one
+    diagnostic_msgs/DiagnosticStatus per camera. The level is WARN when the
+    camera dropped frames since the last publication.
+    """
+    def __init__(self, runners, period=5.0, topic='/diagnostics'):
+        self.runners = list(runners)
+        self._pub = rospy.Publisher(topic, diagnostic_msgs.msg.DiagnosticArray)
+        self._last_dropped = {}
+        self._timer = rospy.Timer(rospy.Duration(period), self._publish)
+
+    def get_status(self):
+        """returns a list of DiagnosticStatus, one per camera"""
+        status = []
+        for runner in self.runners:
+            stats = runner.get_stats()
+            for cam in sorted(stats):
+                s = stats[cam]
+                dropped = s["dropped"] - self._last_dropped.get(cam,0)
+                self._last_dropped[cam] = s["dropped"]
+                st = diagnostic_msgs.msg.DiagnosticStatus(
+                        name="flyvr acquisition %s" % cam,
+                        hardware_id=cam)
+                if dropped:
+                    st.level = diagnostic_msgs.msg.DiagnosticStatus.WARN
+                    st.message = "dropped %d frames" % dropped
+                else:
+                    st.level = diagnostic_msgs.msg.DiagnosticStatus.OK
+                    st.message = "latency p90 %.1fms" % (s["latency_p90"]*1000)
+                st.values = [ diagnostic_msgs.msg.KeyValue(key=k, value="%g" % s[k])
+                              for k in sorted(s) ]
+                status.append(st)
+        return status
+
+    def _publish(self, event):
+        msg = diagnostic_msgs.msg.DiagnosticArray(status=self.get_status())
+        msg.header.stamp = rospy.Time.now()
+        self._pub.publish(msg)
 
+    def shutdown(self):
+        self._timer.shutdown()
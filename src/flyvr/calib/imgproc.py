@@ -5,6 +5,11 @@ import scipy.ndimage
 import cv2
 import traceback
 
+from flyvr.calib.imgwriter import get_image_writer
+
+#the default structuring element of scipy.ndimage binary morphology
+CROSS_3X3 = cv2.getStructuringElement(cv2.MORPH_CROSS, (3,3))
+
 class DotBGFeatureDetector:
     WIN_TYPES = {
         "I":"img",
@@ -16,11 +21,27 @@ class DotBGFeatureDetector:
         "med":"median filter, blob detect",
         "morphbinary":"binarize, morphological filter, blob detect"
     }
-    def __init__(self, name, method="med", show="DF"):
+    DETECT_BACKENDS = {
+        "scipy":"scipy.ndimage filters and label",
+        "opencv":"OpenCV filters and connectedComponentsWithStats (OpenCV >= 3)"
+    }
+    BUFFER_TYPES = {
+        "diff":np.uint8,
+        "filtered":np.uint8,
+        "valid":np.bool_,
+        "opened":np.bool_,
+        "vis":np.uint8,
+        "lbls":np.int32,
+    }
+    def __init__(self, name, method="med", show="DF", backend="scipy"):
         assert method in self.DETECT_METHODS
+        assert backend in self.DETECT_BACKENDS
+        if backend == "opencv" and not hasattr(cv2, "connectedComponentsWithStats"):
+            raise ValueError("the opencv backend needs OpenCV >= 3 (have %s)" % cv2.__version__)
         self._name = name
         self._safe_name = self._name.replace('/','')
         self._method = method
+        self._backend = backend
         self._show = show
         self._thresh = None
         self._debug = False
@@ -38,8 +59,17 @@ class DotBGFeatureDetector:
         self._mask = None
         self._n = 0
         self._debug_b = None
+        self._buffers = {}
+        self._bg_alpha = None
+        self._bg_acc = None
+        self.last_search = None
+        self._min_blob_area = None
+        self._max_blob_area = None
 
     @property
+    def has_windows(self):
+        return len(self._handles) > 0
+    @property
     def img_shape(self):
         return self._shape
     @property
@@ -49,15 +79,15 @@ class DotBGFeatureDetector:
     def img_height_px(self):
         return self._shape[0]   #swap from matrix semantics (row/col) to image coords
 
-    def _get_path(self, win_type):
+    def _get_path(self, win_type, suffix=""):
         return self._save_fmt % {
                             "imgn":self._n,
-                            "imgtype":win_type,
+                            "imgtype":win_type+suffix,
                             "name":self._safe_name,
                             "time":time.time()
         }
 
-    def _show_img(self, arr, win_type):
+    def _show_img(self, arr, win_type, suffix=""):
         img = arr
         if win_type in self._handles:
             if self._mask != None:
@@ -65,14 +95,17 @@ class DotBGFeatureDetector:
             cv2.imshow(self._handles[win_type], img)
 
         if self._save_fmt is not None:
-            fname = self._get_path(win_type)
+            fname = self._get_path(win_type, suffix)
             #print 'for win_type %s, saving to %s'%(win_type,fname)
-            cv2.imwrite(fname, arr)
+            get_image_writer().write(fname, arr)
 
-    def _show_features_and_diff(self, diff, dmax, features, sz=-1):
+    def _show_features_and_diff(self, diff, dmax, features, sz=-1, roi=None):
+        #images of the region of interest are saved as e.g. 12_cam_Froi.png,
+        #so the full image of the same frame (on fallback) does not replace them
+        suffix = "" if roi is None else "roi"
         if "F" in self._handles:
             if self._debug_b is not None:
-                b = self._debug_b
+                b = self._debug_b if roi is None else self._debug_b[roi]
             else:
                 b = np.zeros(diff.shape,dtype=np.uint8)
 
@@ -93,10 +126,10 @@ class DotBGFeatureDetector:
             cv2.imshow(self._handles["F"], img)
 
             if self._save_fmt is not None:
-                cv2.imwrite(self._get_path("F"), img)
+                get_image_writer().write(self._get_path("F", suffix), img)
         else:
             if self._save_fmt is not None:
-                cv2.imwrite(self._get_path("F"), diff)
+                get_image_writer().write(self._get_path("F", suffix), diff)
 
     def _detect_blobs_and_luminance(self, imarr, diff, validmask, exact_luminance=False, use_argmax=False):
         #note: we modify diff in place here, but it has already been saved to
@@ -119,26 +152,37 @@ class DotBGFeatureDetector:
         else:
             #ndimage.label treats non-zero as valid, so set all pixels below
             #the thresh (invalid) to zero
-            diff[~validmask] = 0
-            lbls,maxlabel = scipy.ndimage.measurements.label(diff)
-            slcs = scipy.ndimage.measurements.find_objects(lbls)
+            np.multiply(diff, validmask, out=diff)
+            lbls = self._get_buffer("lbls", diff.shape, np.int32)
+            if self._backend == "opencv":
+                #4-connected, like the default structure of ndimage.label
+                nlabels,lbls,stats,centroids = cv2.connectedComponentsWithStats(
+                                                    diff.view(np.uint8), labels=lbls,
+                                                    connectivity=4, ltype=cv2.CV_32S)
+                if diff.dtype == np.bool_ and not exact_luminance:
+                    #binary weights, the centre of mass is the centroid
+                    features.extend( component_statistics(imarr, stats, centroids,
+                                                          self._min_blob_area, self._max_blob_area) )
+                    return features
+                maxlabel = nlabels-1
+            else:
+                maxlabel = scipy.ndimage.measurements.label(diff, output=lbls)
 
-            #according to the implementation, the second return argument is actually
-            #the maximum label(integer), and not necessarily the number of returned
+            #according to the implementation, the returned number is actually
+            #the maximum label(integer), and not necessarily the number of
             #labelled objects, although for that is assumed by other parts of the
             #ndimage code.
-            for n in range(1,maxlabel+1): #0 is code for unlabelled
-                row,col = map(int,scipy.ndimage.measurements.center_of_mass(diff,lbls,n))
-                if exact_luminance:
-                    blob = imarr[slcs[n-1]]
-                    lum = blob.sum()/np.count_nonzero(blob)
-                else:
-                    lum = imarr[row,col]
-
-                features.append( (row,col,lum) )
+            features.extend( blob_statistics(imarr, diff, lbls, maxlabel,
+                                             self._min_blob_area, self._max_blob_area,
+                                             exact_luminance) )
 
         return features
 
+    def set_blob_area_limits(self, min_area=None, max_area=None):
+        """only report blobs with min_area <= area (in pixels) <= max_area"""
+        self._min_blob_area = min_area
+        self._max_blob_area = max_area
+
     def enable_debug_detection(self):
         self._debug = True
 
@@ -166,32 +210,120 @@ class DotBGFeatureDetector:
         shape = bgarr.shape
         assert len(shape) == 3
         self._shape = shape[0:2]
-        self._bg = np.min(bgarr,2)
+        self._bg = np.ascontiguousarray(np.min(bgarr,2), dtype=np.uint8)
+        self._bg_acc = None
         self._show_img(self._bg, "B")
+        #allocate the per-frame work buffers now, rather than on the first detect
+        for name,dtype in self.BUFFER_TYPES.items():
+            self._get_buffer(name, self._shape, dtype)
+
+    def enable_running_bg(self, alpha=0.02):
+        """
+        update the background with every frame passed to detect(), see
+        update_bg(). alpha is the fraction by which the background moves
+        towards the frame each time.
+        """
+        self._bg_alpha = alpha
+
+    def update_bg(self, imarr, thresh):
+        """
+        update the running background model with the frame imarr.
+
+        pixels darker than the background replace it at once (as the minimum
+        in compute_bg). The other pixels, except those more than thresh
+        brighter than the background (i.e. features), move towards the frame
+        by the fraction alpha, so the background follows slow changes in
+        ambient light. Uses O(H*W) memory, independent of the number of frames.
+        """
+        if self._bg is None:
+            self._shape = imarr.shape
+            self._bg = np.array(imarr, dtype=np.uint8)
+        if self._bg_acc is None:
+            self._bg_acc = self._bg.astype(np.float32)
+        acc = self._bg_acc
+
+        np.minimum(acc, imarr, out=acc)
+
+        diff = self._get_buffer("bgdiff", imarr.shape, np.uint8)
+        cv2.subtract(imarr, self._bg, dst=diff)
+        bgmask = self._get_buffer("bgmask", imarr.shape, np.uint8)
+        np.less_equal(diff, thresh, out=bgmask.view(np.bool_))
+        cv2.accumulateWeighted(imarr, acc, self._bg_alpha, mask=bgmask)
+
+        np.copyto(self._bg, acc, casting='unsafe')
 
-    def detect(self, imarr, thresh, exact_luminance=False):
+    def _get_buffer(self, name, shape, dtype):
+        """
+        returns a contiguous work array of shape, reusing the memory of
+        previous frames (so that detect() does not allocate per frame)
+        """
+        n = shape[0]*shape[1]
+        buf = self._buffers.get(name)
+        if buf is None or len(buf) < n:
+            buf = np.empty((n,), dtype=dtype)
+            self._buffers[name] = buf
+        return buf[:n].reshape(shape)
+
+    def detect(self, imarr, thresh, exact_luminance=False, predicted=None, window=None):
         """
         returns in matrix coordinates: [row, col], dmax
+
+        if predicted (row, col) and window (in pixels) are given, only the
+        region within window pixels of predicted is searched. If nothing is
+        found there, the full image is searched. last_search records which
+        path was taken: "full", "roi" or "roi+full" (the fallback). dmax is
+        the maximum background difference of the searched image, i.e. of the
+        window for "roi" and of the full image otherwise.
         """
         self._n += 1
 
         self._show_img(imarr, "I")
 
+        if (predicted is not None) and (window is not None):
+            row,col = predicted
+            window = int(window)
+            roi = (slice(max(0,int(row)-window),max(0,int(row)+window+1)),
+                   slice(max(0,int(col)-window),max(0,int(col)+window+1)))
+            features,dmax = self._detect(imarr, thresh, exact_luminance, roi)
+            if features:
+                self.last_search = "roi"
+            else:
+                self.last_search = "roi+full"
+                features,dmax = self._detect(imarr, thresh, exact_luminance, None)
+        else:
+            self.last_search = "full"
+            features,dmax = self._detect(imarr, thresh, exact_luminance, None)
+
+        #the whole frame updates the background, whichever region was searched
+        if self._bg_alpha is not None:
+            self.update_bg(imarr, thresh)
+        return features,dmax
+
+    def _detect(self, imarr, thresh, exact_luminance, roi):
         t1 = time.time()
 
-        if self._bg != None:
-            #prevent wrap-around unsiged subtraction (is there a better way to do this??)
-            diff = imarr.astype(np.int16) - self._bg
-            diff = diff.clip(0,255).astype(np.uint8)
+        bg = self._bg
+        mask = self._mask
+        if roi is not None:
+            imarr = imarr[roi]
+            if bg is not None:
+                bg = bg[roi]
+            if mask is not None:
+                mask = mask[roi]
+
+        diff = self._get_buffer("diff", imarr.shape, np.uint8)
+        if bg is not None:
+            #saturating subtraction (no wrap-around of unsigned values)
+            cv2.subtract(imarr, bg, dst=diff)
         else:
-            diff = imarr.astype(np.uint8)
+            np.copyto(diff, imarr, casting='unsafe')
 
-        if self._mask != None:
-            diff *= self._mask
+        if mask is not None:
+            np.multiply(diff, mask, out=diff)
 
-        dmax = diff.max()
+        dmax = diff.max() if diff.size else 0
 
-        self._show_img(diff, "D")
+        self._show_img(diff, "D", "" if roi is None else "roi")
 
         if self._debug:
             print "diff max: %d (thresh: %d) %s" % (dmax, thresh, self._name)
@@ -200,13 +332,33 @@ class DotBGFeatureDetector:
             features = []
             feature_detector_vis_diff = diff
         elif self._method == "morphbinary":
-            valid = diff > thresh
-            scipy.ndimage.binary_opening(valid, output=valid)
-            feature_detector_vis_diff = (valid*255).astype(np.uint8)
+            valid = self._get_buffer("valid", diff.shape, np.bool_)
+            np.greater(diff, thresh, out=valid)
+            #binary opening, with our own buffer for the intermediate result
+            opened = self._get_buffer("opened", diff.shape, np.bool_)
+            if self._backend == "opencv":
+                #same cross structure and zero border as scipy.ndimage
+                cv2.erode(valid.view(np.uint8), CROSS_3X3, dst=opened.view(np.uint8),
+                          borderType=cv2.BORDER_CONSTANT, borderValue=0)
+                cv2.dilate(opened.view(np.uint8), CROSS_3X3, dst=valid.view(np.uint8),
+                           borderType=cv2.BORDER_CONSTANT, borderValue=0)
+            else:
+                scipy.ndimage.binary_erosion(valid, output=opened)
+                scipy.ndimage.binary_dilation(opened, output=valid)
+            feature_detector_vis_diff = self._get_buffer("vis", diff.shape, np.uint8)
+            np.multiply(valid.view(np.uint8), 255, out=feature_detector_vis_diff)
             features = self._detect_blobs_and_luminance(imarr, valid, valid, exact_luminance)
         elif self._method == "med":
-            scipy.ndimage.median_filter(diff,3,output=diff)
-            valid = diff > thresh
+            filtered = self._get_buffer("filtered", diff.shape, np.uint8)
+            if self._backend == "opencv":
+                #the replicated border of medianBlur equals ndimage's
+                #'reflect' mode for a 3x3 window
+                cv2.medianBlur(diff, 3, dst=filtered)
+            else:
+                scipy.ndimage.median_filter(diff,3,output=filtered)
+            diff = filtered
+            valid = self._get_buffer("valid", diff.shape, np.bool_)
+            np.greater(diff, thresh, out=valid)
             feature_detector_vis_diff = diff
             features = self._detect_blobs_and_luminance(imarr, diff, valid, exact_luminance)
         else:
@@ -214,12 +366,77 @@ class DotBGFeatureDetector:
 
         t2 = time.time()
         if self._benchmark:
-            print "%s (%s) = %.1fms" % (self._method, self._name, (t2-t1)*1000)
+            print "%s/%s (%s, %s) = %.1fms" % (self._method, self._backend, self._name,
+                                            "full" if roi is None else "roi",
+                                            (t2-t1)*1000)
+
+        self._show_features_and_diff(feature_detector_vis_diff, dmax, features, roi=roi)
 
-        self._show_features_and_diff(feature_detector_vis_diff, dmax, features)
+        if roi is not None:
+            #back to full image coordinates
+            r0,c0 = roi[0].start,roi[1].start
+            features = [(row+r0,col+c0,lum) for row,col,lum in features]
 
         return features,dmax
 
+def blob_statistics(imarr, weights, lbls, maxlabel, min_area=None, max_area=None, exact_luminance=False):
+    """
+    returns a list of (row, col, lum) for labels 1..maxlabel of lbls
+
+    row, col is the centre of mass of weights in each blob, truncated
+    to int. lum is the luminance of imarr at that pixel, or the mean
+    luminance of the blob if exact_luminance. Blobs with an area
+    outside [min_area, max_area] are skipped. All labels are measured
+    in a single pass over the labelled pixels.
+    """
+    #only the labelled pixels are needed (0 is code for unlabelled)
+    idx = np.flatnonzero(lbls)
+    ncol = weights.shape[1]
+    n = maxlabel+1
+    lbl = lbls.ravel()[idx]
+    w = weights.ravel()[idx].astype(np.float64)
+
+    area = np.bincount(lbl, minlength=n)
+    mass = np.bincount(lbl, weights=w, minlength=n)
+    rows = np.bincount(lbl, weights=w*(idx // ncol), minlength=n)
+    cols = np.bincount(lbl, weights=w*(idx % ncol), minlength=n)
+
+    good = area > 0
+    good[0] = False #0 is code for unlabelled
+    if min_area is not None:
+        good &= area >= min_area
+    if max_area is not None:
+        good &= area <= max_area
+    labels = np.nonzero(good)[0]
+
+    rows = (rows[labels]/mass[labels]).astype(int)
+    cols = (cols[labels]/mass[labels]).astype(int)
+    if exact_luminance:
+        lums = np.bincount(lbl, weights=imarr.ravel()[idx].astype(np.float64), minlength=n)
+        lums = lums[labels]/area[labels]
+    else:
+        lums = imarr[rows,cols]
+    return zip(rows,cols,lums)
+
+def component_statistics(imarr, stats, centroids, min_area=None, max_area=None):
+    """
+    returns a list of (row, col, lum) from the stats and centroids of
+    cv2.connectedComponentsWithStats, as blob_statistics does for blobs
+    of uniform weight. Label 0 (the background) is skipped.
+    """
+    area = stats[1:,cv2.CC_STAT_AREA]
+    good = area > 0
+    if min_area is not None:
+        good &= area >= min_area
+    if max_area is not None:
+        good &= area <= max_area
+    centroids = centroids[1:][good]
+    #centroids are (x, y)
+    rows = centroids[:,1].astype(int)
+    cols = centroids[:,0].astype(int)
+    lums = imarr[rows,cols]
+    return zip(rows,cols,lums)
+
 def load_mask_image(mask_image_fname):
     """
     load the RGBA png image and return a numpy array of bools. Alpha
@@ -0,0 +1,104 @@
+import time
+import threading
+import collections
+import atexit
+import traceback
+
+import numpy as np
+import cv2
+
+class AsyncImageWriter:
+    """
+    writes images with cv2.imwrite in a background thread
+
+    at most maxlen images wait to be written. When the queue is full the
+    oldest waiting image is dropped, so write() never blocks the caller.
+    """
+    def __init__(self, maxlen=32):
+        self._queue = collections.deque()
+        self._maxlen = maxlen
+        self._cond = threading.Condition()
+        self._closed = False
+        self._busy = False
+        self._written = 0
+        self._dropped = 0
+        self._errors = 0
+        self._thread = threading.Thread(target=self._run, name="AsyncImageWriter")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, fname, arr):
+        """queue arr to be saved to fname. arr is copied, so the caller may reuse it"""
+        arr = np.array(arr, copy=True)
+        with self._cond:
+            if self._closed:
+                raise ValueError("writer is closed")
+            if len(self._queue) >= self._maxlen:
+                self._queue.popleft()
+                self._dropped += 1
+            self._queue.append( (fname,arr) )
+            self._cond.notify_all()
+
+    @property
+    def stats(self):
+        """returns a dict with the number of written, dropped, failed and queued images"""
+        with self._cond:
+            return dict(written=self._written,
+                        dropped=self._dropped,
+                        errors=self._errors,
+                        queued=len(self._queue))
+
+    def flush(self, timeout=None):
+        """wait until all queued images are written. returns False on timeout"""
+        with self._cond:
+            if timeout is None:
+                while self._queue or self._busy:
+                    self._cond.wait()
+            else:
+                #Condition.wait(timeout) does not say whether it timed out in python 2
+                t_end = time.time() + timeout
+                while (self._queue or self._busy) and time.time() < t_end:
+                    self._cond.wait(t_end - time.time())
+            return not (self._queue or self._busy)
+
+    def close(self, timeout=None):
+        """write the queued images and stop the thread"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._closed:
+                    self._cond.wait()
+                if not self._queue:
+                    #closed and nothing left to write
+                    return
+                fname,arr = self._queue.popleft()
+                self._busy = True
+            try:
+                ok = cv2.imwrite(fname, arr)
+            except Exception:
+                traceback.print_exc()
+                ok = False
+            with self._cond:
+                self._busy = False
+                if ok:
+                    self._written += 1
+                else:
+                    self._errors += 1
+                self._cond.notify_all()
+
+_writer = None
+_writer_lock = threading.Lock()
+
+def get_image_writer():
+    """returns the AsyncImageWriter shared by all calibration tools"""
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = AsyncImageWriter()
+            atexit.register(_writer.close)
+        return _writer
@@ -781,12 +781,15 @@ class UI(object):
             camera = row[VS_CAMERA_OBJECT]
             assert camera is not None
 
-            this_tcs = self.geom.compute_for_camera_view(camera,
-                                                         what='texture_coords')
-            this_dist = self.geom.compute_for_camera_view(camera,
-                                                          what='distance' )
-            this_angle = self.geom.compute_for_camera_view(camera,
-                                                           what='incidence_angle' )
+            # only compute the pixels inside the viewport
+            layers = self.geom.compute_for_camera_view(camera,
+                                                       what=['texture_coords',
+                                                             'distance',
+                                                             'incidence_angle'],
+                                                       mask=maskarr)
+            this_tcs = layers['texture_coords']
+            this_dist = layers['distance']
+            this_angle = layers['incidence_angle']
 
             this_tcs[ np.isnan(this_tcs) ] = -1.0 # nan -> -1
 
@@ -1163,19 +1166,7 @@ class UI(object):
                     print 'using flipped camera'
                     camera = c2
             elif 1:
-                farr = self.geom.compute_for_camera_view( c1,
-                                                          what='texture_coords' )
-
-                _pump_ui()
-
-                u = farr[:,:,0]
-                good = ~np.isnan( u )
-                npix=np.sum( np.nonzero( good ) )
-                if npix==0:
-                    print 'using flipped camera, otherwise npix = 0'
-                    camera = c1.get_flipped_camera()
-                else:
-                    camera = c1
+                camera = self._choose_camera_direction(c1)
             else:
                 camera = c1
         elif method in ['extrinsic only','iterative extrinsic only']:
@@ -1210,19 +1201,7 @@ class UI(object):
 
             c1 = result['cam']
             if 1:
-                farr = self.geom.compute_for_camera_view( c1,
-                                                          what='texture_coords' )
-
-                _pump_ui()
-
-                u = farr[:,:,0]
-                good = ~np.isnan( u )
-                npix=np.sum( np.nonzero( good ) )
-                if npix==0:
-                    print 'using flipped camera, otherwise npix = 0'
-                    camera = c1.get_flipped_camera()
-                else:
-                    camera = c1
+                camera = self._choose_camera_direction(c1)
             else:
                 camera = c1
             del result
@@ -1244,18 +1223,41 @@ class UI(object):
 
         self.update_bg_image()
 
+    def _choose_camera_direction(self, c1, step=8):
+        """return c1, or its flipped camera if c1 does not see the display surface
+
+        c1 is first checked on a grid of every step-th pixel. Only if it
+        sees nothing there, its full view is checked.
+        """
+        x = np.arange(0, c1.width, step)
+        y = np.arange(0, c1.height, step)
+        XX, YY = np.meshgrid(x, y)
+        pixel_xy = np.vstack((XX.ravel(), YY.ravel())).T
+        tc = self.geom.compute_for_pixels( c1, pixel_xy, what='texture_coords' )
+        npix = np.sum( ~np.isnan(tc[:,0]) )
+
+        _pump_ui()
+
+        if npix==0:
+            farr = self.geom.compute_for_camera_view( c1,
+                                                      what='texture_coords' )
+            npix = np.sum( ~np.isnan(farr[:,:,0]) )
+            _pump_ui()
+        if npix==0:
+            print 'using flipped camera, otherwise npix = 0'
+            return c1.get_flipped_camera()
+        return c1
+
     def update_bg_image(self):
         arr = np.zeros( (self.dsc.height,self.dsc.width,3), dtype=np.uint8 )
         di = self.dsc.get_display_info()
         # draw beachballs ----------------------
 
-        for row in self.vdisp_store:
-            if not row[VS_SHOW_BEACHBALL]:
-                continue
-            cam = row[VS_CAMERA_OBJECT]
-            if cam is None:
-                continue
-
+        rows = [ row for row in self.vdisp_store
+                 if row[VS_SHOW_BEACHBALL] and row[VS_CAMERA_OBJECT] is not None ]
+        farrs = self.geom.compute_for_cameras( [row[VS_CAMERA_OBJECT] for row in rows],
+                                               what='texture_coords' )
+        for row, farr in zip(rows, farrs):
             vdisp = row[VS_VDISP]
             for d in di['virtualDisplays']:
                 if d['id'] != vdisp:
@@ -1265,9 +1267,6 @@ class UI(object):
 
             assert d['id'] == vdisp
 
-            farr = self.geom.compute_for_camera_view( cam,
-                                                      what='texture_coords' )
-
             u = farr[:,:,0]
             good = ~np.isnan( u )
             print 'showing beachball for %r'%row[VS_VDISP]
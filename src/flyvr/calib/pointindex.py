@@ -0,0 +1,196 @@
+"""nearest neighbour index of calibration correspondences
+
+The coordinates are kept in a NumPy array and bulk loaded into a
+scipy.spatial.cKDTree.
+"""
+import numpy as np
+import scipy.spatial
+
+class PointIndex(object):
+    """k-d tree of items with coordinates
+
+    Each item is a tuple (e.g. a namedtuple) whose first `dimensions`
+    fields are its coordinates. Items added after construction go to
+    an append buffer, which is searched by brute force and merged into
+    the tree when it holds more than merge_size items or more than a
+    quarter of the items in the tree. Add many items with one call to
+    extend() rather than many calls to add().
+
+    The coordinates of all items are stored in one array, which grows
+    geometrically: the first _n_tree rows are in the tree, the others
+    are the append buffer. Small queries search the buffer by brute
+    force; larger batches (more than BRUTE_FORCE_SIZE point-buffer
+    pairs) use a tree of the buffer, built on demand, so memory use
+    does not grow with the product of both sizes.
+    """
+    BRUTE_FORCE_SIZE = 1<<16
+
+    def __init__(self, dimensions, items=(), merge_size=64):
+        self.dimensions = dimensions
+        self.merge_size = merge_size
+        self._items = []
+        self._tree = None
+        self._buffer_tree = None
+        self._n_tree = 0
+        self._coords = np.empty((0,dimensions))
+        self.extend(items)
+        self.rebuild()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def _get_coords(self, items):
+        coords = [ tuple(item)[:self.dimensions] for item in items ]
+        return np.array(coords,dtype=np.float64).reshape((-1,self.dimensions))
+
+    def add(self, item):
+        """add a single item"""
+        self.extend([item])
+
+    def extend(self, items):
+        """add several items"""
+        items = list(items)
+        if not len(items):
+            return
+        coords = self._get_coords(items)
+        n = len(self._items)
+        if n+len(items) > len(self._coords):
+            grown = np.empty((max(n+len(items), 2*len(self._coords)), self.dimensions))
+            grown[:n] = self._coords[:n]
+            self._coords = grown
+        self._coords[n:n+len(items)] = coords
+        self._items.extend(items)
+        if len(self._buffer) > max(self.merge_size, self._n_tree//4):
+            self.rebuild()
+
+    @property
+    def _tree_coords(self):
+        return self._coords[:self._n_tree]
+
+    @property
+    def _buffer(self):
+        return self._coords[self._n_tree:len(self._items)]
+
+    def rebuild(self):
+        """merge the append buffer into the tree"""
+        if not len(self._buffer):
+            return
+        self._n_tree = len(self._items)
+        # the tree keeps these rows, which are not written again
+        self._tree = scipy.spatial.cKDTree(self._tree_coords)
+        self._buffer_tree = None
+
+    def _get_buffer_tree(self):
+        """return a cKDTree of the append buffer"""
+        if self._buffer_tree is None or self._buffer_tree.n != len(self._buffer):
+            self._buffer_tree = scipy.spatial.cKDTree(self._buffer)
+        return self._buffer_tree
+
+    def _as_coords(self, points):
+        """return points as an Nx`dimensions` array
+
+        points is an array of locations or a sequence of tuples whose
+        first `dimensions` fields are locations.
+        """
+        if isinstance(points, np.ndarray) and points.dtype != object:
+            points = np.array(points,dtype=np.float64,copy=False)
+            assert points.ndim==2
+            return points[:,:self.dimensions]
+        return self._get_coords(points)
+
+    def query(self, points, k=1):
+        """find the k nearest items to each of N points
+
+        Return (dist, idx), NxK arrays of Euclidean distances and item
+        indices, sorted nearest first. If there are fewer than k items,
+        the missing neighbours have distance inf and index -1. k=0
+        gives Nx0 arrays.
+        """
+        if k < 0:
+            raise ValueError("k must not be negative")
+        coords = self._as_coords(points)
+        N = len(coords)
+        dist = np.empty((N,0))
+        idx = np.empty((N,0),dtype=np.int64)
+        n_tree = self._n_tree
+        if self._tree is not None and N and k:
+            k_tree = min(k,n_tree)
+            d, i = self._tree.query(coords, k=k_tree)
+            dist = np.hstack((dist, np.reshape(d,(N,k_tree))))
+            idx = np.hstack((idx, np.reshape(i,(N,k_tree))))
+        n_buffer = len(self._buffer)
+        if n_buffer and N*n_buffer <= self.BRUTE_FORCE_SIZE:
+            d = np.sqrt(np.sum((coords[:,np.newaxis,:]-self._buffer[np.newaxis,:,:])**2,axis=2))
+            i = np.tile(np.arange(n_tree, n_tree+n_buffer), (N,1))
+            dist = np.hstack((dist, d))
+            idx = np.hstack((idx, i))
+        elif n_buffer and N and k:
+            k_buffer = min(k,n_buffer)
+            d, i = self._get_buffer_tree().query(coords, k=k_buffer)
+            dist = np.hstack((dist, np.reshape(d,(N,k_buffer))))
+            idx = np.hstack((idx, n_tree + np.reshape(i,(N,k_buffer))))
+
+        # nearest k of tree and buffer, padded to k columns
+        dist = np.hstack((dist, np.inf*np.ones((N,k))))
+        idx = np.hstack((idx, -np.ones((N,k),dtype=np.int64)))
+        dist[~np.isfinite(dist)] = np.inf
+        order = np.argsort(dist, axis=1, kind='mergesort')[:,:k]
+        rows = np.arange(N)[:,np.newaxis]
+        dist, idx = dist[rows,order], idx[rows,order]
+        idx[~np.isfinite(dist)] = -1
+        return dist, idx
+
+    def query_radius(self, points, r):
+        """find the items within distance r of each of N points
+
+        Return a list of N arrays of item indices, sorted nearest first.
+        """
+        coords = self._as_coords(points)
+        n_tree = self._n_tree
+        if self._tree is not None:
+            in_tree = self._tree.query_ball_point(coords, r)
+        else:
+            in_tree = [ [] for c in coords ]
+        n_buffer = len(self._buffer)
+        if n_buffer and len(coords)*n_buffer > self.BRUTE_FORCE_SIZE:
+            in_buffer = self._get_buffer_tree().query_ball_point(coords, r)
+        else:
+            in_buffer = [ None for c in coords ]
+        result = []
+        for c, i, j in zip(coords, in_tree, in_buffer):
+            if j is None and n_buffer:
+                d = np.sqrt(np.sum((self._buffer-c)**2,axis=1))
+                j = np.nonzero(d <= r)[0]
+            elif j is None:
+                j = []
+            i = np.concatenate((np.array(i,dtype=np.int64),
+                                n_tree + np.array(j,dtype=np.int64)))
+            d = np.sqrt(np.sum((self._coords[i]-c)**2,axis=1))
+            result.append( i[np.argsort(d, kind='mergesort')] )
+        return result
+
+    def get_items(self, idx):
+        """return the items at indices idx (as returned by query), None for -1"""
+        return [ self._items[i] if i >= 0 else None for i in idx ]
+
+    def search_nn(self, point):
+        """return the item nearest to point, or None if there are no items
+
+        point is a location with at least `dimensions` fields, not an
+        item index. If point is the location of an item, that item is
+        returned.
+        """
+        dist, idx = self.query([point], k=1)
+        return self.get_items(idx[0])[0]
+
+    def search_knn(self, points, k):
+        """return a list with the (up to) k nearest items of each point"""
+        dist, idx = self.query(points, k=k)
+        return [ [self._items[i] for i in row if i >= 0] for row in idx ]
+
+    def search_radius(self, points, r):
+        """return a list with the items within distance r of each point, nearest first"""
+        return [ [self._items[i] for i in row] for row in self.query_radius(points, r) ]
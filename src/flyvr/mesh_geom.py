@@ -0,0 +1,799 @@
+# -*- Mode: python; tab-width: 4; indent-tabs-mode: nil -*-
+"""triangle mesh display surface geometry in pure Python/NumPy
+
+MeshModel is a drop-in replacement for
+PyDisplaySurfaceArbitraryGeometry.ArbitraryGeometry which does not
+need OpenSceneGraph. Rays are intersected with the mesh in batches
+using a bounding volume hierarchy (BVH).
+"""
+import os
+import re
+import shutil
+import hashlib
+import tempfile
+import warnings
+import numpy as np
+
+from flyvr.simple_geom import ModelBase, _parse_rays, _ray_points
+
+# ---------------------------------------------------------------------
+# mesh loading
+
+def load_mesh(filename):
+    """load a triangle mesh from an .osg or .obj file
+
+    return (verts, texcoords, triangles), an Nx3 array of vertices, an
+    Nx2 array of texture coordinates and an Mx3 array of vertex
+    indices.
+    """
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == '.osg':
+        return load_osg_mesh(filename)
+    elif ext == '.obj':
+        return load_obj_mesh(filename)
+    raise ValueError("unknown mesh file type: %r"%filename)
+
+re_osg_vertex_array = re.compile(r'^VertexArray\s+(?:UniqueID\s+(\S+)\s+)?(?:Vec3d?Array\s+)?(\d+)\s*\{$')
+re_osg_vertex_use = re.compile(r'^VertexArray\s+Use\s+(\S+)$')
+re_osg_texcoord_array = re.compile(r'^TexCoordArray\s+(\d+)\s+(?:UniqueID\s+(\S+)\s+)?Vec2d?Array\s+(\d+)\s*\{$')
+re_osg_texcoord_use = re.compile(r'^TexCoordArray\s+(\d+)\s+Use\s+(\S+)$')
+re_osg_draw_elements = re.compile(r'^DrawElements(?:UInt|UShort|UByte)\s+(?:UniqueID\s+\S+\s+)?(\w+)\s+\d+\s*\{$')
+re_osg_draw_arrays = re.compile(r'^DrawArrays\s+(?:UniqueID\s+\S+\s+)?(\w+)\s+(\d+)\s+(\d+)$')
+re_osg_draw_array_lengths = re.compile(r'^DrawArrayLengths\s+(?:UniqueID\s+\S+\s+)?(\w+)\s+(\d+)\s+(\d+)\s*(\{?)$')
+
+def _primitive_to_triangles(mode, idx):
+    """convert OpenGL primitive indices to triangles like osg::TriangleIndexFunctor"""
+    idx = np.array(idx,dtype=np.int64)
+    n = len(idx)
+    if mode == 'TRIANGLES':
+        return idx[:3*(n//3)].reshape((-1,3))
+    elif mode == 'QUADS':
+        q = idx[:4*(n//4)].reshape((-1,4))
+        return np.vstack((q[:,[0,1,2]], q[:,[0,2,3]]))
+    elif mode == 'TRIANGLE_STRIP':
+        tris = [ (idx[i],idx[i+2],idx[i+1]) if i%2 else (idx[i],idx[i+1],idx[i+2])
+                 for i in range(n-2) ]
+    elif mode in ('TRIANGLE_FAN','POLYGON'):
+        tris = [ (idx[0],idx[i+1],idx[i+2]) for i in range(n-2) ]
+    elif mode == 'QUAD_STRIP':
+        tris = []
+        for i in range(0,n-3,2):
+            tris.append( (idx[i],idx[i+1],idx[i+2]) )
+            tris.append( (idx[i+1],idx[i+3],idx[i+2]) )
+    else:
+        # points and lines have no triangles
+        tris = []
+    return np.array(tris,dtype=np.int64).reshape((-1,3))
+
+def _read_osg_array(lines, i, n, ncols):
+    """return the n rows of ncols numbers starting at lines[i]"""
+    rows = [ [float(x) for x in l.split()] for l in lines[i:i+n] ]
+    if len(rows) != n or any(len(r) != ncols for r in rows):
+        raise ValueError("invalid array at line %d"%i)
+    return np.array(rows).reshape((n,ncols))
+
+def load_osg_mesh(filename):
+    """load the triangles of an OpenSceneGraph ASCII (.osg) file
+
+    Like DisplaySurfaceArbitraryGeometry.cpp, the file must contain
+    exactly one geometry with triangles and exactly one texture
+    coordinate array, and coordinates are those of the geometry
+    (transforms above it are ignored). Arrays shared with "UniqueID"
+    and "Use" are supported.
+    """
+    lines = [line.strip() for line in open(filename).readlines()]
+
+    geoms = [] # one dict per Geometry block
+    shared = {} # UniqueID -> array
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        i += 1
+
+        if line == 'Geometry {':
+            geoms.append( dict(verts=None, texcoords=None, n_texcoords=0, triangles=[]) )
+            continue
+        if not len(geoms):
+            continue
+        geom = geoms[-1]
+
+        match = re_osg_vertex_array.match(line)
+        if match is not None:
+            n = int(match.group(2))
+            geom['verts'] = _read_osg_array(lines, i, n, 3)
+            if match.group(1) is not None:
+                shared[match.group(1)] = geom['verts']
+            i += n
+            continue
+
+        match = re_osg_vertex_use.match(line)
+        if match is not None:
+            geom['verts'] = shared[match.group(1)]
+            continue
+
+        match = re_osg_texcoord_array.match(line)
+        if match is not None:
+            n = int(match.group(3))
+            texcoords = _read_osg_array(lines, i, n, 2)
+            if match.group(2) is not None:
+                shared[match.group(2)] = texcoords
+            if int(match.group(1)) == 0:
+                geom['texcoords'] = texcoords
+            geom['n_texcoords'] += 1
+            i += n
+            continue
+
+        match = re_osg_texcoord_use.match(line)
+        if match is not None:
+            if int(match.group(1)) == 0:
+                geom['texcoords'] = shared[match.group(2)]
+            geom['n_texcoords'] += 1
+            continue
+
+        match = re_osg_draw_elements.match(line)
+        if match is not None:
+            idx = []
+            while lines[i] != '}':
+                idx.extend( int(x) for x in lines[i].split() )
+                i += 1
+            geom['triangles'].append( _primitive_to_triangles(match.group(1), idx) )
+            continue
+
+        match = re_osg_draw_arrays.match(line)
+        if match is not None:
+            first = int(match.group(2))
+            count = int(match.group(3))
+            idx = np.arange(first, first+count)
+            geom['triangles'].append( _primitive_to_triangles(match.group(1), idx) )
+            continue
+
+        match = re_osg_draw_array_lengths.match(line)
+        if match is not None:
+            first = int(match.group(2))
+            n = int(match.group(3))
+            if not match.group(4):
+                if lines[i] != '{':
+                    raise ValueError("invalid DrawArrayLengths at line %d"%i)
+                i += 1
+            lengths = []
+            while lines[i] != '}':
+                lengths.extend( int(x) for x in lines[i].split() )
+                i += 1
+            if len(lengths) != n:
+                raise ValueError("invalid DrawArrayLengths at line %d"%i)
+            for count in lengths:
+                idx = np.arange(first, first+count)
+                geom['triangles'].append( _primitive_to_triangles(match.group(1), idx) )
+                first += count
+            continue
+
+    geoms = [ g for g in geoms if sum(len(t) for t in g['triangles']) ]
+    if not len(geoms):
+        raise ValueError("No geometry was found.")
+    if len(geoms) > 1:
+        raise NotImplementedError("This model has more than one drawable with triangles")
+    geom = geoms[0]
+    if geom['texcoords'] is None or geom['n_texcoords'] != 1:
+        raise ValueError("Need exactly one texture coordinate array. Does your model have a texture?")
+    if geom['verts'] is None or len(geom['verts']) != len(geom['texcoords']):
+        raise ValueError("The vertex and texture coordinate arrays do not match.")
+    triangles = np.vstack(geom['triangles'])
+    if np.any(triangles >= len(geom['verts'])):
+        raise ValueError("Triangle vertex index out of range.")
+    return geom['verts'], geom['texcoords'], triangles
+
+def load_obj_mesh(filename):
+    """load the triangles of a Wavefront .obj file
+
+    Every face must have texture coordinates. Polygons are split into
+    triangle fans.
+    """
+    obj_verts = []
+    obj_texcoords = []
+    vert_ids = {} # (vertex index, texcoord index) -> mesh vertex index
+    triangles = []
+
+    def get_index(idx, n):
+        idx = int(idx)
+        if idx < 0:
+            return n+idx
+        return idx-1
+
+    for line in open(filename):
+        parts = line.split()
+        if not len(parts):
+            continue
+        if parts[0]=='v':
+            obj_verts.append( [float(x) for x in parts[1:4]] )
+        elif parts[0]=='vt':
+            obj_texcoords.append( [float(x) for x in parts[1:3]] )
+        elif parts[0]=='f':
+            face = []
+            for corner in parts[1:]:
+                fields = corner.split('/')
+                if len(fields) < 2 or fields[1]=='':
+                    raise ValueError("face without texture coordinates in %r"%filename)
+                key = (get_index(fields[0],len(obj_verts)),
+                       get_index(fields[1],len(obj_texcoords)))
+                face.append( vert_ids.setdefault(key,len(vert_ids)) )
+            for j in range(len(face)-2):
+                triangles.append( (face[0],face[j+1],face[j+2]) )
+
+    if not len(triangles):
+        raise ValueError("No geometry was found.")
+
+    obj_verts = np.array(obj_verts)
+    obj_texcoords = np.array(obj_texcoords)
+    keys = sorted(vert_ids, key=vert_ids.get)
+    verts = obj_verts[[k[0] for k in keys]]
+    texcoords = obj_texcoords[[k[1] for k in keys]]
+    return verts, texcoords, np.array(triangles,dtype=np.int64)
+
+# ---------------------------------------------------------------------
+# ray casting
+
+def _intersect_triangles(o, d, v):
+    """Moller-Trumbore intersection of rays o + t*d with triangles v
+
+    o and d are Nx3 arrays and v is an Nx3x3 array of triangle
+    corners. Return (t, u, w), where u and w are the barycentric
+    coordinates of corners 1 and 2. Degenerate cases give nan or inf.
+    """
+    e1 = v[:,1]-v[:,0]
+    e2 = v[:,2]-v[:,0]
+    p = np.cross(d,e2)
+    inv_det = 1.0/np.sum(e1*p,axis=1)
+    tvec = o-v[:,0]
+    u = np.sum(tvec*p,axis=1)*inv_det
+    q = np.cross(tvec,e1)
+    w = np.sum(d*q,axis=1)*inv_det
+    t = np.sum(e2*q,axis=1)*inv_det
+    return t, u, w
+
+def interpolate_triangles(arr, triangles, tri, bary):
+    """interpolate per-vertex arr at barycentric coordinates in triangles
+
+    tri is a length N array of indices into triangles (-1 gives nan)
+    and bary is an Nx3 array of barycentric coordinates.
+    """
+    result = np.empty( (len(tri), arr.shape[1]) )
+    result.fill(np.nan)
+    good = tri >= 0
+    corners = triangles[tri[good]]
+    b = bary[good]
+    result[good] = (arr[corners[:,0]]*b[:,0,np.newaxis] +
+                    arr[corners[:,1]]*b[:,1,np.newaxis] +
+                    arr[corners[:,2]]*b[:,2,np.newaxis])
+    return result
+
+class BVH(object):
+    """bounding volume hierarchy of triangles for batched ray casting
+
+    tri_verts is an Mx3x3 array (triangle, corner, xyz). The tree is
+    stored in flat arrays. Node i is a leaf if node_count[i] > 0, in
+    which case it holds triangles order[node_start[i]:node_start[i]+
+    node_count[i]]. Otherwise its children are node_left[i] and
+    node_left[i]+1.
+    """
+    _cache_arrays = ('tri_verts','order','node_lo','node_hi',
+                     'node_left','node_start','node_count')
+    _cache_scalars = ('leaf_size',)
+
+    def __init__(self, tri_verts, leaf_size=8):
+        self.tri_verts = np.array(tri_verts,dtype=np.float64)
+        assert self.tri_verts.ndim==3
+        assert self.tri_verts.shape[1:]==(3,3)
+        self.leaf_size = leaf_size
+        self._build()
+
+    def to_arrays(self, prefix=''):
+        """return a dict of the arrays needed by from_arrays()"""
+        return _get_cache_arrays(self, prefix)
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix=''):
+        """create an instance from the dict returned by to_arrays()"""
+        return _set_cache_arrays(cls.__new__(cls), arrays, prefix)
+
+    def _build(self):
+        tri_lo = self.tri_verts.min(axis=1)
+        tri_hi = self.tri_verts.max(axis=1)
+        centroids = self.tri_verts.mean(axis=1)
+
+        M = len(self.tri_verts)
+        order = np.arange(M)
+        node_lo = []
+        node_hi = []
+        node_left = []
+        node_start = []
+        node_count = []
+
+        def add_node(start, stop):
+            ids = order[start:stop]
+            node_lo.append( tri_lo[ids].min(axis=0) )
+            node_hi.append( tri_hi[ids].max(axis=0) )
+            node_left.append( -1 )
+            node_start.append( start )
+            node_count.append( stop-start )
+            return len(node_count)-1
+
+        stack = [ add_node(0, M) ]
+        while len(stack):
+            node = stack.pop()
+            start = node_start[node]
+            count = node_count[node]
+            if count <= self.leaf_size:
+                continue
+
+            # split at the median centroid along the longest axis
+            ids = order[start:start+count]
+            c = centroids[ids]
+            axis = np.argmax( c.max(axis=0) - c.min(axis=0) )
+            half = count//2
+            part = np.argpartition( c[:,axis], half )
+            order[start:start+count] = ids[part]
+
+            node_count[node] = 0 # internal node
+            node_left[node] = add_node(start, start+half)
+            add_node(start+half, start+count)
+            stack.append( node_left[node] )
+            stack.append( node_left[node]+1 )
+
+        self.order = order
+        self.node_lo = np.array(node_lo)
+        self.node_hi = np.array(node_hi)
+        self.node_left = np.array(node_left,dtype=np.int64)
+        self.node_start = np.array(node_start,dtype=np.int64)
+        self.node_count = np.array(node_count,dtype=np.int64)
+
+    def intersect(self, origins, directions, batch_size=65536):
+        """find the first triangle hit by each ray origin + t*direction, t > 0
+
+        origins and directions are Nx3 arrays. Return (t, tri, bary)
+        where t is length N (nan for misses), tri is the length N
+        triangle index (-1 for misses) and bary is Nx3 barycentric
+        coordinates of the hit point in its triangle.
+        """
+        origins = np.array(origins,dtype=np.float64,copy=False)
+        directions = np.array(directions,dtype=np.float64,copy=False)
+        assert origins.ndim==2
+        assert origins.shape[1]==3
+        assert directions.shape==origins.shape
+
+        N = len(origins)
+        t = np.empty((N,))
+        t.fill(np.nan)
+        tri = -np.ones((N,),dtype=np.int64)
+        bary = np.empty((N,3))
+        bary.fill(np.nan)
+        for start in range(0,N,batch_size):
+            stop = min(start+batch_size,N)
+            self._intersect_batch(origins[start:stop], directions[start:stop],
+                                  t[start:stop], tri[start:stop], bary[start:stop])
+        return t, tri, bary
+
+    def _intersect_batch(self, o, d, best_t, best_tri, best_bary):
+        n = len(o)
+        old_settings = np.seterr(invalid='ignore',divide='ignore') # we expect some nans below
+        try:
+            inv_d = 1.0/d
+            t_max_found = np.empty((n,))
+            t_max_found.fill(np.inf)
+
+            # breadth-first traversal of (ray, node) pairs
+            rays = np.arange(n)
+            rays = rays[ ~np.any(np.isnan(o),axis=1) & ~np.any(np.isnan(d),axis=1) ]
+            nodes = np.zeros(rays.shape,dtype=np.int64)
+            while len(rays):
+                # slab test against node bounding boxes
+                t1 = (self.node_lo[nodes] - o[rays]) * inv_d[rays]
+                t2 = (self.node_hi[nodes] - o[rays]) * inv_d[rays]
+                # nan (ray in slab plane) does not constrain
+                t_near = np.fmax.reduce(np.fmin(t1,t2),axis=1)
+                t_far = np.fmin.reduce(np.fmax(t1,t2),axis=1)
+                hit = (t_far >= np.fmax(t_near,0)) & (t_near <= t_max_found[rays])
+                rays = rays[hit]
+                nodes = nodes[hit]
+
+                is_leaf = self.node_count[nodes] > 0
+                if np.any(is_leaf):
+                    self._intersect_leaves(o, d, rays[is_leaf], nodes[is_leaf],
+                                           t_max_found, best_tri, best_bary)
+
+                internal = ~is_leaf
+                left = self.node_left[nodes[internal]]
+                rays = np.concatenate((rays[internal],rays[internal]))
+                nodes = np.concatenate((left,left+1))
+        finally:
+            np.seterr(**old_settings)
+
+        hit = best_tri >= 0
+        best_t[hit] = t_max_found[hit]
+
+    def _intersect_leaves(self, o, d, rays, nodes, t_max_found, best_tri, best_bary):
+        # expand (ray, leaf) pairs to (ray, triangle) pairs
+        counts = self.node_count[nodes]
+        rays = np.repeat(rays, counts)
+        first = np.repeat(np.cumsum(counts)-counts, counts)
+        tris = self.order[ np.repeat(self.node_start[nodes], counts) +
+                           np.arange(len(rays)) - first ]
+
+        t, u, w = _intersect_triangles(o[rays], d[rays], self.tri_verts[tris])
+        good = (u >= 0) & (w >= 0) & (u+w <= 1) & (t > 0) & (t < t_max_found[rays])
+        if not np.any(good):
+            return
+        rays, tris, u, w, t = rays[good], tris[good], u[good], w[good], t[good]
+
+        # keep the closest hit of each ray
+        idx = np.lexsort((t,rays))
+        rays, first = np.unique(rays[idx], return_index=True)
+        idx = idx[first]
+        t_max_found[rays] = t[idx]
+        best_tri[rays] = tris[idx]
+        best_bary[rays,0] = 1.0-u[idx]-w[idx]
+        best_bary[rays,1] = u[idx]
+        best_bary[rays,2] = w[idx]
+
+class TriangleGrid(object):
+    """uniform grid of triangles for finding the triangle at a point
+
+    tri_verts is an Mx3x3 array (triangle, corner, xyz). Each triangle
+    is listed in every cell overlapped by its bounding box padded by
+    precision. Only non-empty cells are stored: cell_keys is the
+    sorted array of their linear indices and the triangles in cell
+    cell_keys[i] are tris[cell_start[i]:cell_start[i+1]].
+    """
+    _cache_arrays = ('tri_verts','tris','cell_keys','cell_start','lo','dims')
+    _cache_scalars = ('precision','cell_size')
+
+    def __init__(self, tri_verts, precision, cell_size=None):
+        self.tri_verts = np.array(tri_verts,dtype=np.float64)
+        assert self.tri_verts.ndim==3
+        assert self.tri_verts.shape[1:]==(3,3)
+        self.precision = precision
+
+        tri_lo = self.tri_verts.min(axis=1) - precision
+        tri_hi = self.tri_verts.max(axis=1) + precision
+        if cell_size is None:
+            # about the size of a typical triangle
+            cell_size = np.median(np.max(tri_hi-tri_lo,axis=1))
+        if not cell_size > 0:
+            cell_size = 1.0
+        self.cell_size = float(cell_size)
+        self.lo = tri_lo.min(axis=0)
+        self.dims = (np.floor((tri_hi.max(axis=0)-self.lo)/self.cell_size)+1).astype(np.int64)
+        self._build(tri_lo, tri_hi)
+
+    def _build(self, tri_lo, tri_hi):
+        # expand triangles to (triangle, cell) pairs
+        c_lo = self._cell_coords(tri_lo)
+        extent = self._cell_coords(tri_hi) - c_lo + 1
+        counts = np.prod(extent,axis=1)
+        tris = np.repeat(np.arange(len(counts)), counts)
+        offset = np.arange(len(tris)) - np.repeat(np.cumsum(counts)-counts, counts)
+        extent = extent[tris]
+        coords = np.empty( (len(tris),3), dtype=np.int64 )
+        for axis in (2,1,0):
+            coords[:,axis] = offset % extent[:,axis]
+            offset //= extent[:,axis]
+        coords += c_lo[tris]
+
+        keys = self._keys(coords)
+        idx = np.argsort(keys, kind='mergesort')
+        keys = keys[idx]
+        self.tris = tris[idx]
+        self.cell_keys, first = np.unique(keys, return_index=True)
+        self.cell_start = np.append(first, len(keys))
+
+    def to_arrays(self, prefix=''):
+        """return a dict of the arrays needed by from_arrays()"""
+        return _get_cache_arrays(self, prefix)
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix=''):
+        """create an instance from the dict returned by to_arrays()"""
+        return _set_cache_arrays(cls.__new__(cls), arrays, prefix)
+
+    def _cell_coords(self, pts):
+        coords = np.floor((pts-self.lo)/self.cell_size).astype(np.int64)
+        return np.clip(coords, 0, self.dims-1)
+
+    def _keys(self, coords):
+        return (coords[:,0]*self.dims[1] + coords[:,1])*self.dims[2] + coords[:,2]
+
+    def locate(self, points, batch_size=65536):
+        """find the triangle at each point
+
+        Like DisplaySurfaceArbitraryGeometry::invert_coord, segments
+        of length 2*precision along the z and the x axis through each
+        point are intersected with the triangles and the hit closest
+        to the point is used. (So a point on a triangle parallel to
+        both axes is not found.) Only the triangles in the cell of a point are
+        tested.
+
+        points is an Nx3 array. Return (tri, bary) where tri is the
+        length N triangle index (-1 if not on the surface) and bary is
+        Nx3 barycentric coordinates in that triangle.
+        """
+        points = np.array(points,dtype=np.float64,copy=False)
+        assert points.ndim==2
+        assert points.shape[1]==3
+
+        N = len(points)
+        tri = -np.ones((N,),dtype=np.int64)
+        bary = np.empty((N,3))
+        bary.fill(np.nan)
+        for start in range(0,N,batch_size):
+            stop = min(start+batch_size,N)
+            self._locate_batch(points[start:stop], tri[start:stop], bary[start:stop])
+        return tri, bary
+
+    def _locate_batch(self, p, best_tri, best_bary):
+        # look up the cell of each point
+        pts = np.nonzero( ~np.any(np.isnan(p),axis=1) )[0]
+        hi = self.lo + self.dims*self.cell_size
+        pts = pts[ np.all((p[pts] >= self.lo) & (p[pts] < hi),axis=1) ]
+        keys = self._keys(self._cell_coords(p[pts]))
+        cell = np.minimum( np.searchsorted(self.cell_keys, keys), len(self.cell_keys)-1 )
+        found = self.cell_keys[cell] == keys
+        pts, cell = pts[found], cell[found]
+
+        # expand to (point, triangle) pairs
+        counts = self.cell_start[cell+1] - self.cell_start[cell]
+        first = np.repeat(np.cumsum(counts)-counts, counts)
+        tris = self.tris[ np.repeat(self.cell_start[cell], counts) +
+                          np.arange(np.sum(counts)) - first ]
+        pts = np.repeat(pts, counts)
+        v = self.tri_verts[tris]
+
+        best_dist = np.empty((len(p),))
+        best_dist.fill(np.inf)
+        old_settings = np.seterr(invalid='ignore',divide='ignore') # we expect some nans below
+        try:
+            for axis in (2,0): # the order of _lineseg_starters in the C++ code
+                o = p[pts]
+                o[:,axis] -= self.precision
+                d = np.zeros_like(o)
+                d[:,axis] = 2*self.precision
+                t, u, w = _intersect_triangles(o, d, v)
+                good = (u >= 0) & (w >= 0) & (u+w <= 1) & (t >= 0) & (t <= 1)
+                dist = np.abs(t-0.5)*2*self.precision
+
+                # keep the closest hit of each point
+                idx = np.nonzero(good)[0]
+                idx = idx[ np.lexsort((dist[idx],pts[idx])) ]
+                rays, first = np.unique(pts[idx], return_index=True)
+                idx = idx[first]
+                better = dist[idx] < best_dist[rays]
+                rays, idx = rays[better], idx[better]
+                best_dist[rays] = dist[idx]
+                best_tri[rays] = tris[idx]
+                best_bary[rays,0] = 1.0-u[idx]-w[idx]
+                best_bary[rays,1] = u[idx]
+                best_bary[rays,2] = w[idx]
+        finally:
+            np.seterr(**old_settings)
+
+# ---------------------------------------------------------------------
+# on-disk cache of acceleration structures
+
+MESH_CACHE_VERSION = 2 # increment when the cached arrays change
+
+def get_mesh_cache_dir():
+    """return the directory for cached mesh acceleration structures
+
+    This is $FLYVR_MESH_CACHE if set, otherwise flyvr_mesh_cache in
+    $ROS_HOME (default ~/.ros).
+    """
+    cache_dir = os.environ.get('FLYVR_MESH_CACHE')
+    if cache_dir is None:
+        ros_home = os.environ.get('ROS_HOME', os.path.expanduser('~/.ros'))
+        cache_dir = os.path.join(ros_home, 'flyvr_mesh_cache')
+    return cache_dir
+
+def get_mesh_cache_key(filename, precision, kind):
+    """return a hash of the contents of filename, precision and kind
+
+    kind names what is cached (e.g. the model class), so that
+    different models of the same file do not share a cache entry.
+    """
+    h = hashlib.sha1()
+    h.update(('%s %d %r\n'%(kind, MESH_CACHE_VERSION, float(precision))).encode('ascii'))
+    with open(filename,mode='rb') as fd:
+        while True:
+            buf = fd.read(1<<20)
+            if not len(buf):
+                break
+            h.update(buf)
+    return h.hexdigest()
+
+def load_mesh_cache(key, cache_dir=None):
+    """return a dict of the arrays cached under key, or None
+
+    The arrays are memory-mapped read-only.
+    """
+    if cache_dir is None:
+        cache_dir = get_mesh_cache_dir()
+    dirname = os.path.join(cache_dir, key)
+    if not os.path.isdir(dirname):
+        return None
+    arrays = {}
+    try:
+        for fname in os.listdir(dirname):
+            name, ext = os.path.splitext(fname)
+            if ext=='.npy':
+                arrays[name] = np.load(os.path.join(dirname,fname), mmap_mode='r')
+    except (IOError, OSError, ValueError):
+        warnings.warn('ignoring unreadable mesh cache %r'%dirname)
+        return None
+    return arrays
+
+def save_mesh_cache(key, arrays, cache_dir=None):
+    """save a dict of arrays under key, one .npy file per array
+
+    The files are written to a temporary directory which is then
+    renamed, so a partially written cache is never loaded. If the
+    cache cannot be written, a warning is issued.
+    """
+    if cache_dir is None:
+        cache_dir = get_mesh_cache_dir()
+    dirname = os.path.join(cache_dir, key)
+    tmpdir = None
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        tmpdir = tempfile.mkdtemp(prefix='.tmp-', dir=cache_dir)
+        for name, arr in arrays.items():
+            np.save(os.path.join(tmpdir,name+'.npy'), np.asarray(arr))
+        os.rename(tmpdir, dirname)
+    except (IOError, OSError):
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        if not os.path.isdir(dirname): # else saved by someone else meanwhile
+            warnings.warn('could not save mesh cache %r'%dirname)
+
+def _get_cache_arrays(obj, prefix):
+    arrays = {}
+    for name in obj._cache_arrays + obj._cache_scalars:
+        arrays[prefix+name] = np.asarray(getattr(obj,name))
+    return arrays
+
+def _set_cache_arrays(obj, arrays, prefix):
+    for name in obj._cache_arrays:
+        setattr(obj, name, arrays[prefix+name])
+    for name in obj._cache_scalars:
+        setattr(obj, name, arrays[prefix+name][()])
+    return obj
+
+# ---------------------------------------------------------------------
+# display surface model
+
+class MeshModel(ModelBase):
+    """display surface given by a triangle mesh with texture coordinates
+
+    Loads the same .osg files as ArbitraryGeometry (and .obj files)
+    with the same meaning of precision, but does not need
+    OpenSceneGraph.
+
+    If use_cache is True, the loaded mesh and its acceleration
+    structures are saved in (or loaded from) the directory given by
+    get_mesh_cache_dir().
+    """
+    _cache_arrays = ('_verts','_texcoords','_triangles','_normals','center_arr')
+    _cache_scalars = ()
+
+    def __init__(self, filename, precision=1e-6, use_cache=True):
+        self._filename = filename
+        self._precision = precision
+
+        arrays = None
+        if use_cache:
+            key = get_mesh_cache_key(filename, precision, 'MeshModel')
+            arrays = load_mesh_cache(key)
+        if arrays is not None:
+            _set_cache_arrays(self, arrays, '')
+            self._bvh = BVH.from_arrays(arrays, 'bvh_')
+            self._tc_bvh = BVH.from_arrays(arrays, 'tc_bvh_')
+            self._grid = TriangleGrid.from_arrays(arrays, 'grid_')
+        else:
+            verts, texcoords, triangles = load_mesh(filename)
+            self._init_mesh(verts, texcoords, triangles)
+            if use_cache:
+                arrays = _get_cache_arrays(self, '')
+                arrays.update( self._bvh.to_arrays('bvh_') )
+                arrays.update( self._tc_bvh.to_arrays('tc_bvh_') )
+                arrays.update( self._grid.to_arrays('grid_') )
+                save_mesh_cache(key, arrays)
+        super(MeshModel,self).__init__()
+
+    def _init_mesh(self, verts, texcoords, triangles):
+        self._verts = verts
+        self._texcoords = texcoords
+        self._triangles = triangles
+
+        self._bvh = BVH(verts[triangles])
+        self._grid = TriangleGrid(self._bvh.tri_verts, self._precision)
+        tc3 = np.zeros( (len(texcoords),3) )
+        tc3[:,:2] = texcoords
+        self._tc_bvh = BVH(tc3[triangles])
+
+        normals = np.cross( self._bvh.tri_verts[:,1]-self._bvh.tri_verts[:,0],
+                            self._bvh.tri_verts[:,2]-self._bvh.tri_verts[:,0] )
+        self._normals = normals/np.sqrt(np.sum(normals**2,axis=1))[:,np.newaxis]
+
+        # same as ArbitraryGeometry
+        u = np.expand_dims(np.linspace(0.0,1.0,20),1)
+        v = np.expand_dims(np.linspace(0.0,1.0,20),0)
+        U, V = np.broadcast_arrays(u,v)
+        tcs = np.vstack((U.flatten(),V.flatten())).T
+        wcs = self.texcoord2worldcoord(tcs)
+        wcs = wcs[~np.isnan(wcs[:,0])]
+        self.center_arr = np.mean(wcs,axis=0)
+
+    def __repr__(self):
+        return '<flyvr.mesh_geom.MeshModel filename=%r precision=%s>'%(
+            self._filename,self._precision)
+
+    def to_geom_dict(self):
+        return dict(
+            filename=self._filename,
+            precision=float(self._precision),
+            backend='numpy',
+            model="from_file")
+
+    def _interpolate(self, arr, tri, bary):
+        return interpolate_triangles(arr, self._triangles, tri, bary)
+
+    def _locate(self, wc):
+        """return (triangle index, barycentric coords) of points on the surface"""
+        return self._grid.locate(wc)
+
+    def texcoord2worldcoord(self,tc):
+        # Parse inputs
+        tc = np.array(tc,dtype=np.float64,copy=False)
+        assert tc.ndim==2
+        assert tc.shape[1]==2
+
+        # cast rays in texture space from z=1 down to z=0
+        origins = np.ones( (len(tc),3) )
+        origins[:,:2] = tc
+        directions = np.zeros( (len(tc),3) )
+        directions[:,2] = -1.0
+        t, tri, bary = self._tc_bvh.intersect(origins, directions)
+        return self._interpolate(self._verts, tri, bary)
+
+    def worldcoord2texcoord(self,wc):
+        # Parse inputs
+        wc = np.array(wc,dtype=np.float64,copy=False)
+        assert wc.ndim==2
+        assert wc.shape[1]==3
+        tri, bary = self._locate(wc)
+        return self._interpolate(self._texcoords, tri, bary)
+
+    def worldcoord2normal(self,wc):
+        wc = np.array(wc,dtype=np.float64,copy=False)
+        assert wc.ndim==2
+        assert wc.shape[1]==3
+        tri, bary = self._locate(wc)
+        result = np.empty( (len(wc),3) )
+        result.fill(np.nan)
+        good = tri >= 0
+        result[good] = self._normals[tri[good]]
+        return result
+
+    def get_relative_distance_to_first_surface(self, a, b):
+        # See ModelBase.get_relative_distance_to_first_surface for docstring
+        return self.get_first_surface_and_relative_distance(a,b)[1]
+    get_relative_distance_to_first_surface.__doc__ = ModelBase.get_relative_distance_to_first_surface.__doc__ # inherit docstring
+
+    def get_first_surface(self,a,b):
+        # See ModelBase.get_first_surface for docstring
+        return self.get_first_surface_and_relative_distance(a,b)[0]
+    get_first_surface.__doc__ = ModelBase.get_first_surface.__doc__ # inherit docstring
+
+    def get_first_surface_and_relative_distance(self, a, b):
+        # See ModelBase.get_first_surface_and_relative_distance for docstring
+        a, s = _parse_rays(a, b, np.float64)
+        t, tri, bary = self._bvh.intersect(a, s)
+        return _ray_points(a, s, t), t
+    get_first_surface_and_relative_distance.__doc__ = ModelBase.get_first_surface_and_relative_distance.__doc__ # inherit docstring
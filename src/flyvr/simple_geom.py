@@ -6,6 +6,8 @@ import rosbag
 
 # standard Python stuff
 import json
+import hashlib
+import collections
 import numpy as np
 
 class Vec3:
@@ -28,7 +30,52 @@ def range_0_2pi(angle):
     pi2 = 2*np.pi
     return np.fmod((np.fmod(angle,pi2) + pi2),pi2)
 
+def _parse_rays(a, b, dtype):
+    """return a and s=b-a as Nx3 arrays of dtype"""
+    a = np.array(a,dtype=dtype,copy=False)
+    assert a.ndim==2
+    assert a.shape[1]==3
+
+    b = np.array(b,dtype=dtype,copy=False)
+    assert b.shape==a.shape
+    return a, b-a
+
+def _solve_ray_quadratic(A, B, disc, tmp):
+    """solve A*t**2 + 2*B*t + C = 0 for the rays of a quadric surface
+
+    disc is the (quarter) discriminant B**2 - A*C. A, B, disc and tmp
+    are length N buffers, which are overwritten. Return (t_near,
+    t_far), the roots with t > 0, in buffers B and tmp. Invalid roots
+    are nan.
+
+    See sympy_line_circle.py and sympy_line_sphere.py for the math.
+    """
+    disc[~(disc >= 0)] = np.nan # no intersection (without a warning from sqrt)
+    sq = np.sqrt(disc,out=disc)
+
+    A[A==0] = np.nan # degenerate ray (avoid dividing by zero)
+    np.negative(B,out=B)
+    t_far = np.add(B,sq,out=tmp)
+    t_far /= A
+    t_near = np.subtract(B,sq,out=B)
+    t_near /= A
+
+    # We want t to be > 0 (in direction from camera center to
+    # point) but the closest one.
+    t_near[~(t_near > 0)] = np.nan # behind camera - invalid
+    t_far[~(t_far > 0)] = np.nan
+    return t_near, t_far
+
+def _ray_points(a, s, t):
+    """return a + t*s, computed in the buffer of s"""
+    s *= t[:,np.newaxis]
+    s += a
+    return s
+
 class ModelBase(object):
+    # floating point type used for all computations, see Geometry
+    dtype = np.float64
+
     def get_relative_distance_to_first_surface(self, a, b):
         """return relative distance to surface from point a in direction of point b.
 
@@ -54,6 +101,24 @@ class ModelBase(object):
         raise NotImplementedError(
             'derived class must provide implementation in %r'%self)
 
+    def get_first_surface_and_relative_distance(self, a, b):
+        """return point on surface and relative distance to it.
+
+        a is Nx3 array of points
+        b is Nx3 array of points
+
+        This is equivalent to calling both get_first_surface() and
+        get_relative_distance_to_first_surface(), but the intersection
+        is only computed once.
+
+        return (Nx3 array of points, length N vector of relative distances)
+        """
+        a = np.array(a,dtype=self.dtype,copy=False)
+        b = np.array(b,dtype=self.dtype,copy=False)
+        d = self.get_relative_distance_to_first_surface(a,b)
+        pt = a + d[:,np.newaxis]*(b-a)
+        return pt, d
+
     def to_geom_dict(self):
         raise NotImplementedError(
             'derived class must provide implementation in %r'%self)
@@ -62,7 +127,8 @@ class ModelBase(object):
         return self.center_arr
 
 class Cylinder(ModelBase):
-    def __init__(self, base=None, axis=None, radius=None):
+    def __init__(self, base=None, axis=None, radius=None, dtype=np.float64):
+        self.dtype = dtype
         self.base = point_dict_to_vec(base)
         self.axis = point_dict_to_vec(axis)
         self.radius = radius
@@ -76,10 +142,10 @@ class Cylinder(ModelBase):
 
         # keep in sync with DisplaySurfaceGeometry.cpp
         self._radius = radius
-        self._matrix = np.eye(3) # currently we're forcing vertical cylinder, so this is OK
+        self._matrix = np.eye(3, dtype=self.dtype) # currently we're forcing vertical cylinder, so this is OK
         self._height = self.axis.z - self.base.z
-        self._base = np.expand_dims(np.array( (self.base.x, self.base.y, self.base.z) ),1)
-        self.center_arr = self._base[:,0] + np.array((0,0,self._height*0.5))
+        self._base = np.expand_dims(np.array( (self.base.x, self.base.y, self.base.z), dtype=self.dtype ),1)
+        self.center_arr = self._base[:,0] + np.array((0,0,self._height*0.5), dtype=self.dtype)
         super(Cylinder,self).__init__()
 
     def __repr__(self):
@@ -94,7 +160,7 @@ class Cylinder(ModelBase):
 
     def texcoord2worldcoord(self,tc):
         # Parse inputs
-        tc = np.array(tc,copy=False)
+        tc = np.array(tc,dtype=self.dtype,copy=False)
         assert tc.ndim==2
         assert tc.shape[1]==2
         tc = tc.T
@@ -114,7 +180,7 @@ class Cylinder(ModelBase):
 
     def worldcoord2texcoord(self,wc):
         # Parse inputs
-        wc = np.array(wc,copy=False)
+        wc = np.array(wc,dtype=self.dtype,copy=False)
         assert wc.ndim==2
         assert wc.shape[1]==3
         wc = wc.T
@@ -133,7 +199,7 @@ class Cylinder(ModelBase):
         return result.T
 
     def worldcoord2normal(self,wc):
-        wc = np.array(wc,copy=False)
+        wc = np.array(wc,dtype=self.dtype,copy=False)
         assert wc.ndim==2
         assert wc.shape[1]==3
         wc = wc.T
@@ -148,107 +214,65 @@ class Cylinder(ModelBase):
 
     def get_relative_distance_to_first_surface(self, a, b):
         # See ModelBase.get_relative_distance_to_first_surface for docstring
-        a = np.array(a,copy=False)
-        assert a.ndim==2
-        assert a.shape[1]==3
-        inshape = a.shape
-
-        b = np.array(b,copy=False)
-        assert b.ndim==2
-        assert b.shape[1]==3
-        assert b.shape==inshape
-
-        # Since our cylinder is upright, we project our line into 2D,
-        # solve for the intersection with the circle.
-
-        a = a.T
-        b = b.T
-
-        # Move so that cylinder base is at (0,0).
-        ax = a[0] - self.base.x
-        ay = a[1] - self.base.y
-        az = a[2] - self.base.z
-
-        bx = b[0] - self.base.x
-        by = b[1] - self.base.y
-        bz = b[2] - self.base.z
-
-        del a, b
-
-        # Now create vector between points a and b
-        sx = bx-ax
-        sy = by-ay
-        sz = bz-az
-        r = self.radius
-
-        old_settings = np.seterr(invalid='ignore') # we expect some nans below
-        # Solve for the intersections between line and circle (see sympy_line_circle.py for math)
-        t0 = (-ax*sx - ay*sy + (-ax**2*sy**2 + 2*ax*ay*sx*sy - ay**2*sx**2 + r**2*sx**2 + r**2*sy**2)**(0.5))/(sx**2 + sy**2)
-        t1 = (ax*sx + ay*sy + (-ax**2*sy**2 + 2*ax*ay*sx*sy - ay**2*sx**2 + r**2*sx**2 + r**2*sy**2)**(0.5))/(-sx**2 - sy**2)
-        tt = np.vstack((t0,t1))
-        np.seterr(**old_settings)
-
-        # We want t to be > 0 (in direction from camera center to
-        # point) but the closest one, so the smallest value meeting
-        # this criterion.
-
-        tt[tt <= 0] = np.nan # behind camera - invalid
-
-        # find Z coordinate of each intersection
-        zz = az+sz*tt
-
-        # intersections not on cylinder are invalid
-        tt[zz < 0] = np.nan
-        tt[zz > self.axis.z] = np.nan
-
-        tmin = np.nanmin(tt, axis=0) # find closest to camera
-        return tmin
+        return self.get_first_surface_and_relative_distance(a,b)[1]
     get_relative_distance_to_first_surface.__doc__ = ModelBase.get_relative_distance_to_first_surface.__doc__ # inherit docstring
 
     def get_first_surface(self,a,b):
         # See ModelBase.get_first_surface for docstring
-        tmin = self.get_relative_distance_to_first_surface(a,b)
-
-        a = np.array(a,copy=False)
-        b = np.array(b,copy=False)
-        inshape = a.shape
-
-        a = a.T
-        b = b.T
-
-        # Move so that cylinder base is at (0,0).
-        ax = a[0] - self.base.x
-        ay = a[1] - self.base.y
-        az = a[2] - self.base.z
+        return self.get_first_surface_and_relative_distance(a,b)[0]
+    get_first_surface.__doc__ = ModelBase.get_first_surface.__doc__ # inherit docstring
 
-        bx = b[0] - self.base.x
-        by = b[1] - self.base.y
-        bz = b[2] - self.base.z
+    def get_first_surface_and_relative_distance(self, a, b):
+        # See ModelBase.get_first_surface_and_relative_distance for docstring
+        a, s = _parse_rays(a, b, self.dtype)
+        N = len(a)
 
-        del a, b
+        # Since our cylinder is upright, we project our line into 2D,
+        # solve for the intersection with the circle.
+        o = a - self._base[:,0] # move so that cylinder base is at (0,0)
+        ox, oy, oz = o.T
+        sx, sy, sz = s.T
+
+        A = np.empty((N,),dtype=self.dtype)
+        B = np.empty((N,),dtype=self.dtype)
+        C = np.empty((N,),dtype=self.dtype)
+        tmp = np.empty((N,),dtype=self.dtype)
+
+        np.multiply(sx,sx,out=A)
+        A += np.multiply(sy,sy,out=tmp)
+        np.multiply(ox,sx,out=B)
+        B += np.multiply(oy,sy,out=tmp)
+
+        # The discriminant B**2-A*C equals r**2*A - (o x s)**2, which
+        # does not suffer from cancellation for distant ray origins.
+        disc = np.multiply(ox,sy,out=C)
+        disc -= np.multiply(oy,sx,out=tmp)
+        disc *= disc
+        np.subtract(np.multiply(A,self.radius**2,out=tmp), disc, out=disc)
+
+        t_near, t_far = _solve_ray_quadratic(A,B,disc,tmp)
+        del A, disc
 
-        # Now create vector between points a and b
-        sx = bx-ax
-        sy = by-ay
-        sz = bz-az
+        # intersections not on cylinder are invalid
+        for t in (t_near, t_far):
+            z = np.multiply(sz,t,out=C)
+            z += oz
+            t[(z < 0) | (z > self.axis.z)] = np.nan
+        del o, ox, oy, oz
 
-        x = ax+sx*tmin
-        y = ay+sy*tmin
-        z = az+sz*tmin
-
-        result = np.vstack((x,y,z)).T
-        assert result.shape==inshape
-        return result
-    get_first_surface.__doc__ = ModelBase.get_first_surface.__doc__ # inherit docstring
+        tmin = np.fmin(t_near, t_far, out=t_near) # find closest to camera
+        return _ray_points(a, s, tmin), tmin
+    get_first_surface_and_relative_distance.__doc__ = ModelBase.get_first_surface_and_relative_distance.__doc__ # inherit docstring
 
 class Sphere(ModelBase):
-    def __init__(self, center=None, radius=None):
+    def __init__(self, center=None, radius=None, dtype=np.float64):
+        self.dtype = dtype
         self.center = point_dict_to_vec(center)
         self.radius = radius
 
         # keep in sync with DisplaySurfaceGeometry.cpp
         self._radius = radius
-        self._center = np.expand_dims(np.array( (self.center.x, self.center.y, self.center.z) ),1)
+        self._center = np.expand_dims(np.array( (self.center.x, self.center.y, self.center.z), dtype=self.dtype ),1)
         self.center_arr = self._center[:,0]
         super(Sphere,self).__init__()
 
@@ -263,7 +287,7 @@ class Sphere(ModelBase):
 
     def texcoord2worldcoord(self,tc):
         # Parse inputs
-        tc = np.array(tc,copy=False)
+        tc = np.array(tc,dtype=self.dtype,copy=False)
         assert tc.ndim==2
         assert tc.shape[1]==2
         tc = tc.T
@@ -289,7 +313,7 @@ class Sphere(ModelBase):
 
     def worldcoord2texcoord(self,wc):
         # Parse inputs
-        wc = np.array(wc,copy=False)
+        wc = np.array(wc,dtype=self.dtype,copy=False)
         assert wc.ndim==2
         assert wc.shape[1]==3
         wc = wc.T
@@ -310,7 +334,7 @@ class Sphere(ModelBase):
         return result.T
 
     def worldcoord2normal(self,wc):
-        wc = np.array(wc,copy=False)
+        wc = np.array(wc,dtype=self.dtype,copy=False)
         assert wc.ndim==2
         assert wc.shape[1]==3
         wc = wc.T
@@ -326,92 +350,54 @@ class Sphere(ModelBase):
 
     def get_relative_distance_to_first_surface(self, a, b):
         # See ModelBase.get_relative_distance_to_first_surface for docstring
-        a = np.array(a,copy=False)
-        assert a.ndim==2
-        assert a.shape[1]==3
-        inshape = a.shape
-
-        b = np.array(b,copy=False)
-        assert b.ndim==2
-        assert b.shape[1]==3
-        assert b.shape==inshape
-
-        a = a.T
-        b = b.T
-
-        # Move so that sphere center is at (0,0).
-        ax = a[0] - self.center.x
-        ay = a[1] - self.center.y
-        az = a[2] - self.center.z
-
-        bx = b[0] - self.center.x
-        by = b[1] - self.center.y
-        bz = b[2] - self.center.z
-
-        del a, b
-
-        # Now create vector between points a and b
-        sx = bx-ax
-        sy = by-ay
-        sz = bz-az
-        r = self.radius
-
-
-        old_settings = np.seterr(invalid='ignore') # we expect some nans below
-        # Solve for the intersections between line and sphere (see sympy_line_sphere.py for math)
-        t0,t1 = [(ax*sx + ay*sy + az*sz + (-ax**2*sy**2 - ax**2*sz**2 + 2*ax*ay*sx*sy + 2*ax*az*sx*sz - ay**2*sx**2 - ay**2*sz**2 + 2*ay*az*sy*sz - az**2*sx**2 - az**2*sy**2 + r**2*sx**2 + r**2*sy**2 + r**2*sz**2)**(0.5))/(-sx**2 - sy**2 - sz**2), (-ax*sx - ay*sy - az*sz + (-ax**2*sy**2 - ax**2*sz**2 + 2*ax*ay*sx*sy + 2*ax*az*sx*sz - ay**2*sx**2 - ay**2*sz**2 + 2*ay*az*sy*sz - az**2*sx**2 - az**2*sy**2 + r**2*sx**2 + r**2*sy**2 + r**2*sz**2)**(0.5))/(sx**2 + sy**2 + sz**2)]
-        np.seterr(**old_settings)
-
-        tt = np.vstack((t0,t1))
-
-        # We want t to be > 0 (in direction from camera center to
-        # point) but the closest one, so the smallest value meeting
-        # this criterion.
-
-        tt[tt <= 0] = np.nan # behind camera - invalid
-
-        tmin = np.nanmin(tt, axis=0) # find closest to camera
-        return tmin
+        return self.get_first_surface_and_relative_distance(a,b)[1]
     get_relative_distance_to_first_surface.__doc__ = ModelBase.get_relative_distance_to_first_surface.__doc__ # inherit docstring
 
     def get_first_surface(self,a,b):
         # See ModelBase.get_first_surface for docstring
-        tmin = self.get_relative_distance_to_first_surface(a,b)
-
-        a = np.array(a,copy=False)
-        inshape = a.shape
-        b = np.array(b,copy=False)
-
-        a = a.T
-        b = b.T
-
-        # Move so that sphere center is at (0,0).
-        ax = a[0] - self.center.x
-        ay = a[1] - self.center.y
-        az = a[2] - self.center.z
-
-        bx = b[0] - self.center.x
-        by = b[1] - self.center.y
-        bz = b[2] - self.center.z
-
-        del a, b
-
-        # Now create vector between points a and b
-        sx = bx-ax
-        sy = by-ay
-        sz = bz-az
-
-        x = ax+sx*tmin
-        y = ay+sy*tmin
-        z = az+sz*tmin
-
-        result = np.vstack((x+self.center.x,y+self.center.y,z+self.center.z)).T
-        assert result.shape==inshape
-        return result
+        return self.get_first_surface_and_relative_distance(a,b)[0]
     get_first_surface.__doc__ = ModelBase.get_first_surface.__doc__ # inherit docstring
 
+    def get_first_surface_and_relative_distance(self, a, b):
+        # See ModelBase.get_first_surface_and_relative_distance for docstring
+        a, s = _parse_rays(a, b, self.dtype)
+        N = len(a)
+
+        o = a - self._center[:,0] # move so that sphere center is at (0,0)
+
+        A = np.empty((N,),dtype=self.dtype)
+        B = np.empty((N,),dtype=self.dtype)
+        C = np.empty((N,),dtype=self.dtype)
+        tmp = np.empty((N,),dtype=self.dtype)
+
+        A.fill(0)
+        B.fill(0)
+        C.fill(0)
+        for i in range(3):
+            A += np.multiply(s[:,i],s[:,i],out=tmp)
+            B += np.multiply(o[:,i],s[:,i],out=tmp)
+
+            # The discriminant B**2-A*C equals r**2*A - (o x s)**2,
+            # which does not suffer from cancellation for distant ray
+            # origins.
+            j = (i+1)%3
+            k = (i+2)%3
+            cross = np.multiply(o[:,j],s[:,k],out=tmp)
+            cross -= o[:,k]*s[:,j]
+            C += np.multiply(cross,cross,out=tmp)
+        del o
+        disc = np.subtract(np.multiply(A,self.radius**2,out=tmp), C, out=C)
+
+        t_near, t_far = _solve_ray_quadratic(A,B,disc,tmp)
+        del A, disc
+
+        tmin = np.fmin(t_near, t_far, out=t_near) # find closest to camera
+        return _ray_points(a, s, tmin), tmin
+    get_first_surface_and_relative_distance.__doc__ = ModelBase.get_first_surface_and_relative_distance.__doc__ # inherit docstring
+
 class PlanarRectangle(ModelBase):
-    def __init__(self, lowerleft=None, upperleft=None, lowerright=None):
+    def __init__(self, lowerleft=None, upperleft=None, lowerright=None, dtype=np.float64):
+        self.dtype = dtype
         self.left_lower_corner = point_dict_to_vec(lowerleft)
         self.left_upper_corner = point_dict_to_vec(upperleft)
         self.right_lower_corner = point_dict_to_vec(lowerright)
@@ -420,15 +406,15 @@ class PlanarRectangle(ModelBase):
         self._left_lower_corner = np.array( (self.left_lower_corner.x,
                                              self.left_lower_corner.y,
                                              self.left_lower_corner.z),
-                                            dtype=np.float )
+                                            dtype=self.dtype )
         self._left_upper_corner = np.array( (self.left_upper_corner.x,
                                              self.left_upper_corner.y,
                                              self.left_upper_corner.z),
-                                            dtype=np.float )
+                                            dtype=self.dtype )
         self._right_lower_corner = np.array( (self.right_lower_corner.x,
                                               self.right_lower_corner.y,
                                               self.right_lower_corner.z),
-                                             dtype=np.float )
+                                             dtype=self.dtype )
 
         self._dir_u = self._right_lower_corner - self._left_lower_corner
         self._dir_v = self._left_upper_corner - self._left_lower_corner
@@ -452,7 +438,7 @@ class PlanarRectangle(ModelBase):
 
     def texcoord2worldcoord(self,tc):
         # Parse inputs
-        tc = np.array(tc,copy=False)
+        tc = np.array(tc,dtype=self.dtype,copy=False)
         assert tc.ndim==2
         assert tc.shape[1]==2
         tex_u,tex_v = tc.T
@@ -468,7 +454,7 @@ class PlanarRectangle(ModelBase):
 
     def worldcoord2texcoord(self,wc):
         # Parse inputs
-        wc = np.array(wc,copy=False)
+        wc = np.array(wc,dtype=self.dtype,copy=False)
         assert wc.ndim==2
         assert wc.shape[1]==3
         wc = wc.T
@@ -484,12 +470,12 @@ class PlanarRectangle(ModelBase):
         return result.T
 
     def worldcoord2normal(self,wc):
-        wc = np.array(wc,copy=False)
+        wc = np.array(wc,dtype=self.dtype,copy=False)
         assert wc.ndim==2
         assert wc.shape[1]==3
         N = wc.shape[0]
 
-        one_sz = np.ones((1,N))
+        one_sz = np.ones((1,N),dtype=self.dtype)
         bad = np.isnan(wc[:,0])
         result = (self._normal[:,np.newaxis]*one_sz).T
         result[bad] = np.nan
@@ -497,12 +483,12 @@ class PlanarRectangle(ModelBase):
 
     def get_relative_distance_to_first_surface(self, a, b):
         # See ModelBase.get_relative_distance_to_first_surface for docstring
-        a = np.array(a,copy=False)
+        a = np.array(a,dtype=self.dtype,copy=False)
         assert a.ndim==2
         assert a.shape[1]==3
         inshape = a.shape
 
-        b = np.array(b,copy=False)
+        b = np.array(b,dtype=self.dtype,copy=False)
         assert b.ndim==2
         assert b.shape[1]==3
         assert b.shape==inshape
@@ -517,7 +503,7 @@ class PlanarRectangle(ModelBase):
         p0 = np.array( [self.left_lower_corner.x,
                         self.left_lower_corner.y,
                         self.left_lower_corner.z],
-                       dtype=np.float)
+                       dtype=self.dtype)
 
         # Now, do the math...
 
@@ -533,12 +519,12 @@ class PlanarRectangle(ModelBase):
         # See ModelBase.get_first_surface for docstring
         d = self.get_relative_distance_to_first_surface(a,b)
 
-        a = np.array(a,copy=False)
+        a = np.array(a,dtype=self.dtype,copy=False)
         assert a.ndim==2
         assert a.shape[1]==3
         inshape = a.shape
 
-        b = np.array(b,copy=False)
+        b = np.array(b,dtype=self.dtype,copy=False)
         assert b.ndim==2
         assert b.shape[1]==3
         assert b.shape==inshape
@@ -608,8 +594,141 @@ def get_distance_between_point_and_ray( c, a, b ):
     dist = np.sqrt(np.sum((verts-c)**2,axis=0))
     return dist
 
+def get_pixel_rays(camera, pixel_xy, dtype=np.float64):
+    """return (camcenter, ray) Nx3 arrays for the given pixels of camera
+
+    pixel_xy is Nx2 array of (distorted) pixel coordinates. ray is the
+    point at distance 1.0 from the camera center along the
+    (undistorted) ray of each pixel. The undistortion is always done in
+    double precision, the results are converted to dtype.
+    """
+    pixel_xy = np.array(pixel_xy,copy=False)
+    assert pixel_xy.ndim==2
+    assert pixel_xy.shape[1]==2
+
+    ray = camera.project_pixel_to_3d_ray(pixel_xy,
+                                         distorted=True,
+                                         distance=1.0 )
+
+    camcenter = camera.camcenter_like(ray)
+    return camcenter.astype(dtype,copy=False), ray.astype(dtype,copy=False)
+
+def get_camera_rays(camera, row_start=0, row_stop=None, dtype=np.float64):
+    """return (camcenter, ray) Nx3 arrays for every pixel of camera
+
+    Pixels are in row-major order. Only image rows row_start to
+    row_stop are included. See get_pixel_rays().
+    """
+    if row_stop is None:
+        row_stop = camera.height
+    y = np.expand_dims(np.arange(row_start,row_stop),1)
+    x = np.expand_dims(np.arange(camera.width),0)
+
+    XX, YY = np.broadcast_arrays(x, y)
+    assert XX.shape == (row_stop-row_start, camera.width)
+
+    distorted = np.vstack((XX.flatten(),YY.flatten())).T
+    return get_pixel_rays(camera, distorted, dtype=dtype)
+
+def get_camera_key(camera):
+    """return a hash of the intrinsics, distortion and pose of camera"""
+    h = hashlib.sha1()
+    h.update(np.array([camera.width, camera.height], dtype=np.float64))
+    for arr in (camera.K, camera.distortion, camera.rect, camera.P,
+                camera.get_Q(), camera.get_camcenter()):
+        if arr is None:
+            arr = np.array([np.nan])
+        h.update(np.ascontiguousarray(arr, dtype=np.float64))
+    return h.hexdigest()
+
+class CameraRayCache(object):
+    """bounded LRU cache of the per-pixel rays of cameras
+
+    The arrays returned by get() are shared between callers and must
+    not be modified in place. Each entry for a WxH camera holds two
+    (W*H)x3 float64 arrays, so keep maxsize small.
+    """
+    def __init__(self, maxsize=2, dtype=np.float64):
+        self.maxsize = maxsize
+        self.dtype = dtype
+        self.hits = 0
+        self.misses = 0
+        self._cache = collections.OrderedDict()
+
+    def get(self, camera):
+        """return (camcenter, ray) for camera, see get_camera_rays()"""
+        key = get_camera_key(camera)
+        try:
+            result = self._cache.pop(key)
+        except KeyError:
+            self.misses += 1
+            result = get_camera_rays(camera, dtype=self.dtype)
+        else:
+            self.hits += 1
+        if self.maxsize > 0:
+            self._cache[key] = result # most recently used goes last
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return result
+
+    def clear(self):
+        self._cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def get_stats(self):
+        return dict(hits=self.hits, misses=self.misses,
+                    size=len(self._cache), maxsize=self.maxsize)
+
+CAMERA_VIEW_LAYERS = ('world_coords','texture_coords','distance','incidence_angle')
+# per-pixel shape of each layer
+CAMERA_VIEW_LAYER_SHAPES = {'world_coords':(3,),
+                            'texture_coords':(2,),
+                            'distance':(),
+                            'incidence_angle':(),
+                            }
+
+def _parse_layers(what):
+    """return (list of layers, True if what is a single layer)"""
+    if isinstance(what, (list, tuple)):
+        layers = list(what)
+        single = False
+    else:
+        layers = [what]
+        single = True
+    for layer in layers:
+        if layer not in CAMERA_VIEW_LAYERS:
+            raise ValueError("unknown layer: %r"%layer)
+    return layers, single
+
 class Geometry:
-    def __init__(self, filename=None, geom_dict=None):
+    """display surface geometry
+
+    dtype is the floating point type used to compute rays, surface
+    intersections and texture coordinates with the cylinder, sphere and
+    planar rectangle models. Arbitrary (mesh) geometries always compute
+    in double precision. With np.float32, memory use is halved.
+
+    Error budget of np.float32 compared to np.float64, for a display
+    surface of about 1 m size viewed from within a few m (the
+    undistortion of pixels is always done in double precision):
+
+      texture_coords   1e-5 absolute
+      world_coords     2e-5 m absolute
+      distance         1e-5 relative
+      incidence_angle  1e-4 radians
+
+    Rays nearly tangent to the surface may hit or miss differently.
+
+    Models of type 'from_file' (triangle meshes) are loaded with
+    OpenSceneGraph by default. With 'backend':'numpy' in the geometry
+    dict, flyvr.mesh_geom.MeshModel is used instead, which does not
+    need OpenSceneGraph and intersects rays in large batches. With the
+    default OpenSceneGraph backend, 'num_threads' in the geometry dict
+    sets the number of OpenMP threads used per batch.
+    """
+    def __init__(self, filename=None, geom_dict=None, ray_cache_size=2,
+                 dtype=np.float64):
         if filename and not geom_dict:
             geom_dict = json.loads( open(filename).read() )
         elif geom_dict and not filename:
@@ -617,82 +736,260 @@ class Geometry:
         else:
             raise Exception("must supply filename OR geometry dict (but not both)")
 
+        self.dtype = dtype
+
         if geom_dict['model']=='cylinder':
             self.model = Cylinder(base=geom_dict['base'],
                                   axis=geom_dict['axis'],
-                                  radius=geom_dict['radius'])
+                                  radius=geom_dict['radius'],
+                                  dtype=dtype)
         elif geom_dict['model']=='sphere':
             self.model = Sphere(center=geom_dict['center'],
-                                radius=geom_dict['radius'])
+                                radius=geom_dict['radius'],
+                                dtype=dtype)
         elif geom_dict['model']=='planar_rectangle':
             kwargs = geom_dict.copy()
             del kwargs['model']
-            self.model = PlanarRectangle(**kwargs)
+            self.model = PlanarRectangle(dtype=dtype, **kwargs)
         elif geom_dict['model']=='from_file':
-            import PyDisplaySurfaceArbitraryGeometry as pdsag
             import flyvr.rosmsg2json as rosmsg2json
-            self.model = pdsag.ArbitraryGeometry(
+            backend = geom_dict.get('backend','osg')
+            kwargs = {}
+            if backend=='osg':
+                import PyDisplaySurfaceArbitraryGeometry as pdsag
+                klass = pdsag.ArbitraryGeometry
+                kwargs['num_threads'] = geom_dict.get('num_threads',1)
+            elif backend=='numpy':
+                import flyvr.mesh_geom as mesh_geom
+                klass = mesh_geom.MeshModel
+            else:
+                raise ValueError("unknown mesh backend: %s"%backend)
+            self.model = klass(
                 filename=rosmsg2json.fixup_path( geom_dict['filename'] ),
-                precision=geom_dict.get('precision',1e-6))
+                precision=geom_dict.get('precision',1e-6),
+                **kwargs)
         else:
             raise ValueError("unknown model type: %s"%geom_dict['model'])
 
-    def compute_for_camera_view(self, camera, what='world_coords'):
+        if ray_cache_size:
+            self.ray_cache = CameraRayCache(maxsize=ray_cache_size, dtype=dtype)
+        else:
+            self.ray_cache = None
+
+    def compute_for_camera_view(self, camera, what='world_coords', tile_rows=None,
+                                mask=None):
+        """compute per-pixel quantities for the view of a camera.
+
+        what is one of CAMERA_VIEW_LAYERS or a list of them. If a
+        list is given, the rays are generated and intersected with the
+        model only once and a dict of the requested layers is returned.
+
+        If tile_rows is given, the image is processed in blocks of
+        tile_rows rows which are written into preallocated outputs, so
+        that peak memory use depends on the tile size rather than on
+        the camera resolution. The ray cache is not used in this mode.
+
+        If mask (an array of the camera's shape) is given, only pixels
+        where mask is non-zero are computed. All other pixels are nan.
+        """
+        layers, single = _parse_layers(what)
+
+        if tile_rows is not None or mask is not None:
+            if tile_rows is None:
+                tile_rows = camera.height
+            output = self._compute_tiled(camera, layers, tile_rows, mask=mask)
+            if single:
+                return output[what]
+            return output
+
+        camcenter, ray = self._get_camera_rays(camera)
+        results = self._compute_layers(camcenter, ray, layers)
+
         shape = (camera.height, camera.width)
-        y = np.expand_dims(np.arange(camera.height),1)
-        x = np.expand_dims(np.arange(camera.width),0)
-
-        XX, YY = np.broadcast_arrays(x, y)
-        assert XX.shape == shape
-        assert YY.shape == shape
-
-        XX = XX.flatten()
-        YY = YY.flatten()
-
-        distorted = np.vstack((XX,YY)).T
-
-        ray = camera.project_pixel_to_3d_ray(distorted,
-                                             distorted=True,
-                                             distance=1.0 )
-
-        camcenter = camera.camcenter_like(ray)
-
-        if what=='world_coords':
-            world_coords = self.model.get_first_surface(camcenter,ray)
-            rx, ry, rz = world_coords.T
-            # reshape into image-sized arrays
-            rx.shape = (camera.height, camera.width, 1)
-            ry.shape = (camera.height, camera.width, 1)
-            rz.shape = (camera.height, camera.width, 1)
-            output = np.concatenate((rx,ry,rz),axis=2)
-            assert output.shape == (camera.height, camera.width, 3)
-
-        elif what == 'texture_coords':
-            world_coords = self.model.get_first_surface(camcenter,ray)
-            texcoords = self.model.worldcoord2texcoord(world_coords)
-            tc0, tc1 = texcoords.T
-            # reshape into image-sized arrays
-            tc0.shape = (camera.height, camera.width, 1)
-            tc1.shape = (camera.height, camera.width, 1)
-            output = np.concatenate((tc0,tc1),axis=2)
-            assert output.shape == (camera.height, camera.width, 2)
-
-        elif what == 'distance':
-            distance = self.model.get_relative_distance_to_first_surface(camcenter,ray)
-            distance.shape = (camera.height, camera.width)
-            output = distance
-
-        elif what == 'incidence_angle':
-            world_coords = self.model.get_first_surface(camcenter,ray)
-            surface_normal = self.model.worldcoord2normal(world_coords)
-            projector_dir = -ray
-            dot_product = np.sum(projector_dir*surface_normal,axis=1)
-            angle = np.arccos(dot_product)
-            angle.shape = (camera.height, camera.width)
-            output = angle
+        output = {}
+        for layer in layers:
+            arr = results[layer]
+            if arr.ndim == 2:
+                arr = arr.reshape(shape + (arr.shape[1],))
+            else:
+                arr = arr.reshape(shape)
+            output[layer] = arr
+
+        if single:
+            return output[what]
+        return output
 
+    def compute_all_for_camera_view(self, camera):
+        """compute all of CAMERA_VIEW_LAYERS in a single pass, return dict"""
+        return self.compute_for_camera_view(camera, what=CAMERA_VIEW_LAYERS)
+
+    def _compute_tiled(self, camera, layers, tile_rows, mask=None):
+        tile_rows = int(tile_rows)
+        if tile_rows < 1:
+            raise ValueError("tile_rows must be positive")
+        if mask is not None:
+            mask = np.array(mask,copy=False)
+            if mask.shape != (camera.height, camera.width):
+                raise ValueError("mask shape %r does not match camera"%(mask.shape,))
+
+        output = {}
+        for layer in layers:
+            shape = (camera.height, camera.width) + CAMERA_VIEW_LAYER_SHAPES[layer]
+            output[layer] = np.empty(shape, dtype=self.dtype)
+            if mask is not None:
+                output[layer].fill(np.nan)
+
+        for row_start in range(0, camera.height, tile_rows):
+            row_stop = min(row_start + tile_rows, camera.height)
+            if mask is None:
+                camcenter, ray = get_camera_rays(camera, row_start, row_stop,
+                                                 dtype=self.dtype)
+            else:
+                ys, xs = np.nonzero(mask[row_start:row_stop])
+                if len(ys)==0:
+                    continue
+                ys += row_start
+                camcenter, ray = get_pixel_rays(camera, np.vstack((xs,ys)).T,
+                                                dtype=self.dtype)
+            results = self._compute_layers(camcenter, ray, layers)
+            del camcenter, ray
+            for layer in layers:
+                arr = results[layer]
+                if mask is None:
+                    output[layer][row_start:row_stop] = arr.reshape(
+                        (row_stop-row_start, camera.width) + arr.shape[1:])
+                else:
+                    output[layer][ys, xs] = arr
         return output
 
+    def compute_for_pixels(self, camera, pixel_xy, what='world_coords'):
+        """compute quantities for the given pixels of a camera view.
+
+        pixel_xy is Nx2 array of (distorted) pixel coordinates. Like
+        compute_for_camera_view(), but only the given pixels are
+        undistorted and intersected with the model. Results are N or
+        NxM arrays, or a dict of them if what is a list.
+        """
+        layers, single = _parse_layers(what)
+
+        camcenter, ray = get_pixel_rays(camera, pixel_xy, dtype=self.dtype)
+        results = self._compute_layers(camcenter, ray, layers)
+        if single:
+            return results[what]
+        return results
+
+    def compute_for_cameras(self, cameras, what='world_coords', pixel_xy=None,
+                            max_batch_rays=1<<20):
+        """compute quantities for the views of several cameras at once.
+
+        Return a list with one result per camera, each like the result
+        of compute_for_camera_view(). If pixel_xy (Nx2 array) is given,
+        only these pixels are computed for each camera, as in
+        compute_for_pixels(). This is useful to quickly score many
+        candidate cameras on a coarse pixel grid.
+
+        The rays of consecutive cameras are stacked and intersected
+        with the model in batches of at most max_batch_rays rays. A
+        camera with more pixels than that is computed on its own, in
+        tiles of rows (as with tile_rows) or in chunks of pixel_xy,
+        so memory use does not grow with the number of cameras.
+        """
+        layers, single = _parse_layers(what)
+
+        outputs = [None]*len(cameras)
+        batch = []
+        n_batch = 0
+        for i, camera in enumerate(cameras):
+            if pixel_xy is None:
+                n_rays = camera.width*camera.height
+            else:
+                n_rays = len(pixel_xy)
+            if n_rays > max_batch_rays:
+                if pixel_xy is None:
+                    tile_rows = max(1, max_batch_rays//camera.width)
+                    outputs[i] = self.compute_for_camera_view(camera, layers,
+                                                              tile_rows=tile_rows)
+                else:
+                    chunks = [ self.compute_for_pixels(camera, pixel_xy[start:start+max_batch_rays], layers)
+                               for start in range(0, n_rays, max_batch_rays) ]
+                    outputs[i] = dict( (layer, np.concatenate([c[layer] for c in chunks]))
+                                       for layer in layers )
+                continue
+            if n_batch + n_rays > max_batch_rays:
+                self._compute_batch(cameras, batch, layers, pixel_xy, outputs)
+                batch = []
+                n_batch = 0
+            batch.append(i)
+            n_batch += n_rays
+        self._compute_batch(cameras, batch, layers, pixel_xy, outputs)
+
+        if single:
+            outputs = [output[what] for output in outputs]
+        return outputs
+
+    def _compute_batch(self, cameras, batch, layers, pixel_xy, outputs):
+        """compute the layers of cameras[i] for i in batch into outputs[i]"""
+        if not len(batch):
+            return
+        camcenters = []
+        rays = []
+        for i in batch:
+            if pixel_xy is None:
+                camcenter, ray = self._get_camera_rays(cameras[i])
+            else:
+                camcenter, ray = get_pixel_rays(cameras[i], pixel_xy, dtype=self.dtype)
+            camcenters.append(camcenter)
+            rays.append(ray)
+        n_rays = [len(ray) for ray in rays]
+        if len(batch) == 1:
+            camcenters, rays = camcenters[0], rays[0]
+        else:
+            camcenters, rays = np.concatenate(camcenters), np.concatenate(rays)
+        results = self._compute_layers(camcenters, rays, layers)
+        del camcenters, rays
+
+        splits = np.cumsum(n_rays)[:-1]
+        per_layer = dict( (layer, np.split(results[layer], splits)) for layer in layers )
+        for j, i in enumerate(batch):
+            camera = cameras[i]
+            output = {}
+            for layer in layers:
+                arr = per_layer[layer][j]
+                if pixel_xy is None:
+                    arr = arr.reshape((camera.height, camera.width) + arr.shape[1:])
+                output[layer] = arr
+            outputs[i] = output
+
+    def _get_camera_rays(self, camera):
+        """return (camcenter, ray) Nx3 arrays for every pixel of camera"""
+        if self.ray_cache is None:
+            return get_camera_rays(camera, dtype=self.dtype)
+        return self.ray_cache.get(camera)
+
+    def _compute_layers(self, camcenter, ray, layers):
+        """compute the requested layers (as N or NxM arrays) for given rays"""
+        results = {}
+        if layers == ['distance']:
+            # no need to find the surface points
+            results['distance'] = self.model.get_relative_distance_to_first_surface(camcenter,ray)
+            return results
+
+        world_coords, distance = self.model.get_first_surface_and_relative_distance(camcenter,ray)
+
+        for layer in layers:
+            if layer == 'world_coords':
+                results[layer] = world_coords
+            elif layer == 'texture_coords':
+                results[layer] = self.model.worldcoord2texcoord(world_coords)
+            elif layer == 'distance':
+                results[layer] = distance
+            elif layer == 'incidence_angle':
+                surface_normal = self.model.worldcoord2normal(world_coords)
+                projector_dir = -ray
+                dot_product = np.sum(projector_dir*surface_normal,axis=1)
+                results[layer] = np.arccos(dot_product)
+        return results
+
 def angle_between_vectors(v1, v2):
     dot = np.dot(v1, v2)
     len_a = np.sqrt(np.dot(v1, v1))
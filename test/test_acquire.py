@@ -0,0 +1,187 @@
+import time
+import threading
+import Queue
+import numpy as np
+
+# ROS imports
+import roslib; roslib.load_manifest('flyvr')
+import rospy
+import sensor_msgs.msg
+
+from flyvr.calib.acquire import CameraStats, FrameQueue, FrameStack, FrameSynchronizer, SimultaneousCameraRunner, image_to_array
+
+def _image_msg(arr, step=None, stamp=0.0):
+    h,w = arr.shape
+    step = w if step is None else step
+    padded = np.zeros((h,step),dtype=np.uint8)
+    padded[:,:w] = arr
+    msg = sensor_msgs.msg.Image(height=h, width=w, step=step, encoding='mono8')
+    msg.header.stamp = rospy.Time.from_sec(stamp)
+    msg.data = padded.tostring()
+    return msg
+
+class _Handler(object):
+    # a CameraHandler without the ROS subscription
+    def __init__(self, topic_prefix):
+        self.topic_prefix = topic_prefix
+        self.pipeline_max_latency = 0.2
+        self.frames = FrameStack()
+        self.stats = CameraStats()
+    def set_im_queue(self, q):
+        self.im_queue = q
+    def publish(self, value, stamp):
+        msg = _image_msg(np.zeros((4,3),dtype=np.uint8)+value, stamp=stamp)
+        self.im_queue.put_nowait((self.topic_prefix, msg, image_to_array(msg)))
+
+def test_image_to_array():
+    arr = np.arange(12*7,dtype=np.uint8).reshape((12,7))
+    for step in (7,8):
+        imarr = image_to_array(_image_msg(arr, step))
+        assert imarr.shape == arr.shape
+        assert np.all(imarr == arr)
+
+def test_frame_stack():
+    frames = [ np.zeros((6,5),dtype=np.uint8)+i for i in range(4) ]
+    fs = FrameStack()
+    fs.reset(3)
+    for f in frames[:3]:
+        fs.append(f)
+    arr = fs.array
+    assert arr.shape == (6,5,3)
+    for i in range(3):
+        assert np.all(arr[:,:,i] == i)
+        assert arr[:,:,i].flags.c_contiguous
+
+    # the memory is reused
+    buf = fs._buf
+    fs.reset(2)
+    fs.append(frames[3])
+    assert fs._buf is buf
+    assert fs.array.shape == (6,5,1)
+    assert np.all(fs.array == 3)
+
+    # the oldest frame is overwritten
+    fs.append(frames[1])
+    fs.append(frames[2])
+    assert len(fs) == 2
+    assert sorted(fs.array[0,0,:]) == [1,2]
+
+def test_frame_synchronizer():
+    sync = FrameSynchronizer(["a","b","c"], tolerance=0.01)
+    assert sync.add("a", 1.0, "a1") == []
+    assert sync.add("b", 1.002, "b1") == []
+    # c missed the first trigger
+    assert sync.add("a", 1.2, "a2") == []
+    assert sync.add("c", 1.201, "c2") == []
+    assert sync.dropped == {"a":1,"b":1,"c":0}
+    assert sync.add("b", 1.199, "b2") == [{"a":"a2","b":"b2","c":"c2"}]
+    assert sync.dropped == {"a":1,"b":1,"c":0}
+
+    # sets are completed in trigger order
+    for t in (1.4,1.6):
+        sync.add("a", t, "a%.1f" % t)
+        sync.add("b", t, "b%.1f" % t)
+    assert [s["a"] for s in sync.add("c", 1.4, "c1.4")] == ["a1.4"]
+    assert [s["a"] for s in sync.add("c", 1.6, "c1.6")] == ["a1.6"]
+
+    sync.reset()
+    assert sync.add("a", 2.0, "a") == []
+
+    # a camera whose partner stalls does not queue frames without bound
+    sync = FrameSynchronizer(["a","b"], tolerance=0.01, maxlen=3)
+    for i in range(5):
+        assert sync.add("a", 1.0+0.2*i, "a%d" % i) == []
+    assert sync.dropped == {"a":2,"b":0}
+    assert sync.add("b", 1.4, "b2") == [{"a":"a2","b":"b2"}]
+
+def test_frame_queue():
+    q = FrameQueue(2)
+    q.put_nowait(1)
+    q.put_nowait(2)
+    try:
+        q.put_nowait(3)
+    except Queue.Full:
+        pass
+    else:
+        assert False, "queue should be full"
+    assert q.get() == 1
+    assert q.clear() == 1
+
+    # returns when the frame arrives, not at the next poll
+    t = threading.Timer(0.2, q.put_nowait, (4,))
+    t.start()
+    t0 = time.time()
+    assert q.get(deadline=t0+5.0) == 4
+    assert time.time()-t0 < 1.0
+
+    t0 = time.time()
+    try:
+        q.get(deadline=t0+0.2)
+    except Queue.Empty:
+        assert 0.15 < time.time()-t0 < 1.0
+    else:
+        assert False, "get should time out"
+
+    # waits do not start threads
+    n_threads = threading.active_count()
+    for i in range(20):
+        try:
+            q.get(deadline=time.time()+0.01)
+        except Queue.Empty:
+            pass
+    assert threading.active_count() == n_threads
+
+    threading.Timer(0.2, q.close).start()
+    try:
+        q.get()
+    except Queue.Empty:
+        assert q.closed
+    else:
+        assert False, "get should fail when closed"
+
+def test_runner_iter_images():
+    handlers = [_Handler("a"), _Handler("b")]
+    runner = SimultaneousCameraRunner(handlers, sync_tolerance=0.01, timeout=5.0)
+    t = time.time()
+    def trigger():
+        # b misses the first trigger
+        handlers[0].publish(1, t)
+        handlers[0].publish(2, t+0.2)
+        handlers[1].publish(2, t+0.2)
+        handlers[1].publish(3, t+0.4)
+        handlers[0].publish(3, t+0.4)
+    stopped = []
+
+    frames = runner.iter_images(2, trigger, [], stopped.append, [True])
+    got = [ (cam,int(img[0,0])) for cam,img,stamp in frames ]
+    assert got == [("a",2),("b",2),("a",3),("b",3)]
+    assert stopped == [True]
+    assert runner.frames_dropped == {"a":1,"b":0}
+    imgs = runner.result_as_nparray
+    assert imgs["a"].shape == (4,3,2)
+    assert list(imgs["b"][0,0,:]) == [2,3]
+    stats = runner.get_stats()
+    assert stats["a"]["used"] == 2
+    assert stats["a"]["unmatched"] == 1
+
+    # closing the generator early still calls post_func
+    frames = runner.iter_images(2, trigger, [], stopped.append, [True])
+    frames.next()
+    frames.close()
+    assert stopped == [True,True]
+
+def test_camera_stats():
+    stats = CameraStats(maxlen=10)
+    s = stats.summary()
+    assert s["received"] == 0
+    assert np.isnan(s["latency_p50"])
+
+    for i in range(20):
+        stats.frame_arrived(stamp=i*0.2, t_arrival=i*0.2+0.01*(i%2), queue_depth=i%3)
+    stats.dropped += 2
+    s = stats.summary(percentiles=(0,100))
+    assert s["received"] == 20
+    assert s["dropped"] == 2
+    assert np.allclose([s["interval_p0"],s["interval_p100"]], 0.2)
+    assert np.allclose([s["latency_p0"],s["latency_p100"]], [0,0.01])
+    assert (s["queue_depth_p0"],s["queue_depth_p100"]) == (0,2)
@@ -1,11 +1,18 @@
 import os
+import shutil
+import tempfile
 import numpy as np
-from test_simple_geom import nan_shape_allclose
+from test_simple_geom import nan_shape_allclose, setup_mesh_cache, teardown_mesh_cache
+from test_mesh_geom import write_planar_obj, write_shared_pyramid_osg
 
 # ROS imports
 import roslib; roslib.load_manifest('flyvr')
 import PyDisplaySurfaceArbitraryGeometry
 import flyvr.rosmsg2json as rosmsg2json
+import flyvr.mesh_geom as mesh_geom
+
+setup_module = setup_mesh_cache
+teardown_module = teardown_mesh_cache
 
 def test_arbitrary_geom():
     filename = rosmsg2json.fixup_path( '$(find flyvr)/data/pyramid.osg' )
@@ -25,3 +32,100 @@ def test_arbitrary_geom():
     wc2 = model.texcoord2worldcoord(tc2)
     assert nan_shape_allclose( tc1, tc2)
     assert nan_shape_allclose( wc1, wc2 )
+
+def test_arbitrary_geom_no_cache():
+    filename = rosmsg2json.fixup_path( '$(find flyvr)/data/pyramid.osg' )
+    cache_dir = mesh_geom.get_mesh_cache_dir()
+    before = os.listdir(cache_dir)
+    # a precision not used by other tests, so that nothing is cached yet
+    model1 = PyDisplaySurfaceArbitraryGeometry.ArbitraryGeometry(filename=filename,precision=2e-6,
+                                                                use_cache=False)
+    assert os.listdir(cache_dir) == before
+    model2 = PyDisplaySurfaceArbitraryGeometry.ArbitraryGeometry(filename=filename,precision=2e-6)
+    assert len(os.listdir(cache_dir)) == len(before)+1
+
+    assert nan_shape_allclose( model1.get_center(), model2.get_center() )
+    tc = np.array( [[0.1, 0.1],
+                    [0.2, 0.1],
+                    [np.nan, np.nan]] )
+    wc = model1.texcoord2worldcoord(tc)
+    assert nan_shape_allclose( model1.worldcoord2texcoord(wc),
+                               model2.worldcoord2texcoord(wc) )
+
+def test_texcoord_index_vs_osg():
+    # the Python index of the triangles gives the C++ results
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir,'pyramid.osg')
+        write_shared_pyramid_osg(filename)
+        model = PyDisplaySurfaceArbitraryGeometry.ArbitraryGeometry(filename=filename,precision=1e-6,
+                                                                   use_cache=False)
+    finally:
+        shutil.rmtree(tmpdir)
+    assert model._grid is not None
+
+    rng = np.random.RandomState(6)
+    tc = rng.uniform(0,0.5,size=(200,2))
+    wc = model.texcoord2worldcoord(tc)
+    wc[::5] += 1e-3 # off the surface
+    x,y,z = wc.T.copy()
+    u,v,status = model.geom.worldcoord2texcoord(x,y,z)
+    assert np.all(status==0)
+    assert nan_shape_allclose( model.worldcoord2texcoord(wc), np.array([u,v]).T )
+
+def test_arbitrary_geom_threads():
+    filename = rosmsg2json.fixup_path( '$(find flyvr)/data/pyramid.osg' )
+    serial = PyDisplaySurfaceArbitraryGeometry.ArbitraryGeometry(filename=filename,precision=1e-6)
+    threaded = PyDisplaySurfaceArbitraryGeometry.ArbitraryGeometry(filename=filename,precision=1e-6,
+                                                                   num_threads=4)
+
+    rng = np.random.RandomState(3)
+    tc = rng.uniform(0,0.5,size=(200,2))
+    tc[::7] = np.nan
+    wc1 = serial.texcoord2worldcoord(tc)
+    wc2 = threaded.texcoord2worldcoord(tc)
+    assert nan_shape_allclose( wc1, wc2 )
+    assert nan_shape_allclose( serial.worldcoord2texcoord(wc1),
+                               threaded.worldcoord2texcoord(wc1) )
+
+    a = np.tile( serial.get_center()+(0,0,20), (len(tc),1) )
+    assert nan_shape_allclose( serial.get_first_surface(a,wc1),
+                               threaded.get_first_surface(a,wc1) )
+
+    # the low level wrapper reports per-element status
+    u, v = tc.T.copy()
+    x,y,z,status = threaded.geom.texcoord2worldcoord(u,v)
+    assert status.shape == u.shape
+    assert np.all(status==0)
+
+    # read-only inputs (e.g. memmapped arrays) are accepted
+    u.setflags(write=False)
+    v.setflags(write=False)
+    x2,y2,z2,status2 = threaded.geom.texcoord2worldcoord(u,v)
+    assert nan_shape_allclose( np.array([x,y,z]), np.array([x2,y2,z2]) )
+
+def test_arbitrary_geom_threads_many_triangles():
+    # enough triangles and points that the threads intersect concurrently
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir,'plane.obj')
+        write_planar_obj(filename, n=60)
+        serial = PyDisplaySurfaceArbitraryGeometry.ArbitraryGeometry(filename=filename,precision=1e-6,
+                                                                     use_cache=False)
+        threaded = PyDisplaySurfaceArbitraryGeometry.ArbitraryGeometry(filename=filename,precision=1e-6,
+                                                                       num_threads=4,use_cache=False)
+        rng = np.random.RandomState(5)
+        tc = rng.uniform(0.01,0.99,size=(20000,2))
+        x,y,z = tc[:,0].copy(), tc[:,1].copy(), np.zeros(len(tc))
+        u1,v1,status1 = serial.geom.worldcoord2texcoord(x,y,z)
+        u2,v2,status2 = threaded.geom.worldcoord2texcoord(x,y,z)
+        assert np.all(status1==status2)
+        assert nan_shape_allclose( np.array([u1,v1]), np.array([u2,v2]) )
+
+        wc = np.array([x,y,z]).T
+        a = wc + (0,0,1)
+        b = wc - (0,0,1)
+        assert nan_shape_allclose( serial.get_first_surface(a,b),
+                                   threaded.get_first_surface(a,b) )
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,103 @@
+import numpy as np
+import scipy.ndimage
+import cv2
+from nose.plugins.skip import SkipTest
+
+# ROS imports
+import roslib; roslib.load_manifest('flyvr')
+from flyvr.calib.imgproc import blob_statistics, DotBGFeatureDetector
+
+def test_blob_statistics():
+    rng = np.random.RandomState(7)
+    imarr = rng.randint(0,256,size=(60,80)).astype(np.uint8)
+    diff = imarr.copy()
+    diff[diff < 200] = 0
+    lbls,maxlabel = scipy.ndimage.measurements.label(diff)
+    assert maxlabel > 10
+
+    stats = blob_statistics(imarr, diff, lbls, maxlabel, exact_luminance=True)
+    assert len(stats) == maxlabel
+    for n,(row,col,lum) in enumerate(stats):
+        r,c = map(int,scipy.ndimage.measurements.center_of_mass(diff,lbls,n+1))
+        assert (row,col) == (r,c)
+        assert np.allclose(lum, imarr[lbls==n+1].mean())
+
+    areas = np.bincount(lbls.ravel())[1:]
+    stats = blob_statistics(imarr, diff, lbls, maxlabel, min_area=2, max_area=3)
+    assert len(stats) == np.sum((areas >= 2) & (areas <= 3))
+    for row,col,lum in stats:
+        assert lum == imarr[row,col]
+
+def _dot_image(row, col, shape=(120,160)):
+    imarr = np.zeros(shape,dtype=np.uint8)
+    imarr[row-2:row+3,col-2:col+3] = 200
+    return imarr
+
+def test_detect_roi():
+    for method in DotBGFeatureDetector.DETECT_METHODS:
+        fd = DotBGFeatureDetector("test", method=method, show="")
+        fd.compute_bg(np.zeros((120,160,3),dtype=np.uint8))
+        imarr = _dot_image(50,70)
+
+        full,dmax = fd.detect(imarr, 100)
+        assert fd.last_search == "full"
+        assert len(full) == 1
+
+        features,dmax = fd.detect(imarr, 100, predicted=(45,75), window=20)
+        assert fd.last_search == "roi"
+        assert features == full
+
+        features,dmax = fd.detect(imarr, 100, predicted=(100,10), window=20)
+        assert fd.last_search == "roi+full"
+        assert features == full
+
+def test_detect_backends():
+    if not hasattr(cv2, "connectedComponentsWithStats"):
+        raise SkipTest("needs OpenCV >= 3")
+    rng = np.random.RandomState(3)
+    bg = rng.randint(0,40,size=(120,160)).astype(np.uint8)
+    imarr = bg + rng.randint(0,20,size=bg.shape).astype(np.uint8)
+    for row,col in ((30,40),(80,120),(1,1),(100,60)):
+        imarr[max(0,row-2):row+3,max(0,col-2):col+3] = 220
+    for method in DotBGFeatureDetector.DETECT_METHODS:
+        results = []
+        for backend in DotBGFeatureDetector.DETECT_BACKENDS:
+            fd = DotBGFeatureDetector("test", method=method, show="", backend=backend)
+            fd.compute_bg(bg[:,:,np.newaxis])
+            for exact_luminance in (False, True):
+                features,dmax = fd.detect(imarr, 100, exact_luminance=exact_luminance)
+                results.append( (exact_luminance,sorted(features)) )
+        n = len(results)//2
+        assert len(results[0][1]) == 4
+        for a,b in zip(results[:n],results[n:]):
+            assert a[0] == b[0]
+            assert len(a[1]) == len(b[1])
+            for fa,fb in zip(a[1],b[1]):
+                assert fa[:2] == fb[:2]
+                assert np.allclose(fa[2], fb[2])
+
+def test_running_bg():
+    fd = DotBGFeatureDetector("test", method="med", show="")
+    fd.compute_bg(np.zeros((120,160,3),dtype=np.uint8) + 50)
+    fd.enable_running_bg(alpha=0.5)
+
+    # ambient light rises slowly, a dot is present all the time
+    for i in range(20):
+        imarr = _dot_image(50,70).astype(int) + 60
+        imarr = imarr.clip(0,255).astype(np.uint8)
+        features,dmax = fd.detect(imarr, 100)
+        assert len(features) == 1
+
+    bg = fd._bg
+    assert abs(int(bg[10,10]) - 60) <= 1  # followed the ambient light
+    assert bg[50,70] < 100                # did not absorb the dot
+
+    # darker pixels replace the background at once
+    fd.update_bg(np.zeros((120,160),dtype=np.uint8) + 30, 100)
+    assert np.all(fd._bg == 30)
+
+    # frames found within the region of interest update it too
+    imarr = _dot_image(50,70) + 10
+    features,dmax = fd.detect(imarr, 100, predicted=(50,70), window=20)
+    assert fd.last_search == "roi"
+    assert np.all(fd._bg[:20,:20] == 10)
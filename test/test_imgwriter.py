@@ -0,0 +1,33 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+
+# ROS imports
+import roslib; roslib.load_manifest('flyvr')
+from flyvr.calib.imgwriter import AsyncImageWriter
+
+def test_async_image_writer():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        writer = AsyncImageWriter(maxlen=4)
+        arr = np.zeros((10,20),dtype=np.uint8)
+        fnames = [ os.path.join(tmpdir,"%d.png"%i) for i in range(50) ]
+        for i,fname in enumerate(fnames):
+            arr[:] = i # the writer must copy
+            writer.write(fname, arr)
+        assert writer.flush(timeout=10)
+        writer.close()
+
+        stats = writer.stats
+        assert stats['queued'] == 0
+        assert stats['errors'] == 0
+        assert stats['written'] + stats['dropped'] == len(fnames)
+        assert stats['written'] == len(os.listdir(tmpdir))
+
+        # the newest image is never dropped
+        import cv2
+        last = cv2.imread(fnames[-1], 0)
+        assert np.all(last == len(fnames)-1)
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,219 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+from test_simple_geom import nan_shape_allclose, get_sample_camera, \
+     setup_mesh_cache, teardown_mesh_cache
+
+# ROS imports
+import roslib; roslib.load_manifest('flyvr')
+import flyvr.mesh_geom as mesh_geom
+import flyvr.simple_geom as simple_geom
+import flyvr.rosmsg2json as rosmsg2json
+
+setup_module = setup_mesh_cache
+teardown_module = teardown_mesh_cache
+
+def write_planar_obj(fname, n=10):
+    # unit square in the z=0 plane, texcoords equal to x,y
+    with open(fname,mode='w') as fd:
+        for j in range(n+1):
+            for i in range(n+1):
+                fd.write('v %r %r 0.0\n'%(i/float(n), j/float(n)))
+                fd.write('vt %r %r\n'%(i/float(n), j/float(n)))
+        for j in range(n):
+            for i in range(n):
+                a = j*(n+1)+i+1
+                idx = (a, a+1, a+n+2, a+n+1)
+                fd.write('f %s\n'%' '.join('%d/%d'%(k,k) for k in idx))
+
+def write_shared_pyramid_osg(fname):
+    # data/pyramid.osg with shared arrays, its triangles given as a
+    # strip and a second geometry (without triangles) using its arrays
+    filename = rosmsg2json.fixup_path( '$(find flyvr)/data/pyramid.osg' )
+    txt = open(filename).read()
+    txt = txt.replace('VertexArray 6 {',
+                      'VertexArray UniqueID Vec3Array_1 Vec3Array 6 {')
+    txt = txt.replace('TexCoordArray 0 Vec2Array 6 {',
+                      'TexCoordArray 0 UniqueID Vec2Array_2 Vec2Array 6 {')
+    start = txt.index('DrawElementsUInt')
+    stop = txt.index('}',start)+1
+    txt = txt[:start] + 'DrawArrayLengths TRIANGLE_STRIP 0 1\n{\n6\n}' + txt[stop:]
+    txt = txt.replace('num_drawables 1','num_drawables 2')
+    start = txt.index('\n      }\n',txt.index('TexCoordArray'))+len('\n      }\n')
+    txt = txt[:start] + """      Geometry {
+        VertexArray Use Vec3Array_1
+        PrimitiveSets 1 {
+          DrawArrays LINES 0 2
+        }
+        TexCoordArray 0 Use Vec2Array_2
+      }
+""" + txt[start:]
+    with open(fname,mode='w') as fd:
+        fd.write(txt)
+
+def test_osg_shared_arrays():
+    filename = rosmsg2json.fixup_path( '$(find flyvr)/data/pyramid.osg' )
+    expected = mesh_geom.load_mesh(filename)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(tmpdir,'pyramid.osg')
+        write_shared_pyramid_osg(fname)
+        actual = mesh_geom.load_mesh(fname)
+    finally:
+        shutil.rmtree(tmpdir)
+    for a,e in zip(actual,expected):
+        assert np.all( a == e )
+
+def test_pyramid_roundtrip():
+    filename = rosmsg2json.fixup_path( '$(find flyvr)/data/pyramid.osg' )
+    model = mesh_geom.MeshModel(filename=filename,precision=1e-6)
+
+    eps = 1e-5;
+    tc1 = np.array( [[eps,eps],
+                     [0.1, 0.1],
+                     [0.2, 0.1],
+                     [0.4, 0.2],
+                     [np.nan, np.nan],
+                     ] )
+    wc1 = model.texcoord2worldcoord(tc1)
+    tc2 = model.worldcoord2texcoord(wc1)
+    wc2 = model.texcoord2worldcoord(tc2)
+    assert nan_shape_allclose( tc1, tc2)
+    assert nan_shape_allclose( wc1, wc2 )
+    assert np.allclose( wc1[1], (0.1*10/0.4, 0.1*8.66/0.34641, 0) )
+
+def test_quads_loaded():
+    filename = rosmsg2json.fixup_path( '$(find flyvr)/data/flycube.osg' )
+    verts, texcoords, triangles = mesh_geom.load_mesh(filename)
+    assert verts.shape == (20,3)
+    assert texcoords.shape == (20,2)
+    assert triangles.shape == (10,3)
+
+def test_bvh_vs_brute_force():
+    rng = np.random.RandomState(1)
+    M = 200
+    tri_verts = rng.uniform(size=(M,1,3)) + 0.1*rng.normal(size=(M,3,3))
+    bvh = mesh_geom.BVH(tri_verts, leaf_size=2)
+    brute = mesh_geom.BVH(tri_verts, leaf_size=M) # a single leaf
+
+    N = 1000
+    origins = rng.uniform(-1,2,size=(N,3))
+    directions = rng.normal(size=(N,3))
+    t1, tri1, bary1 = bvh.intersect(origins, directions, batch_size=300)
+    t2, tri2, bary2 = brute.intersect(origins, directions)
+    assert np.sum(tri1 >= 0) > 10
+    assert np.all( tri1 == tri2 )
+    assert nan_shape_allclose( t1, t2 )
+    assert nan_shape_allclose( bary1, bary2 )
+
+def test_planar_mesh_vs_planar_rectangle():
+    tmpdir = tempfile.mkdtemp()
+    fname = os.path.join(tmpdir,'plane.obj')
+    write_planar_obj(fname)
+    try:
+        mesh = mesh_geom.MeshModel(filename=fname,precision=1e-6)
+    finally:
+        os.unlink(fname)
+        os.rmdir(tmpdir)
+
+    ll = {'x':0, 'y':0, 'z':0}
+    lr = {'x':1, 'y':0, 'z':0}
+    ul = {'x':0, 'y':1, 'z':0}
+    rect = simple_geom.PlanarRectangle(lowerleft=ll, upperleft=ul, lowerright=lr)
+
+    rng = np.random.RandomState(2)
+    N = 500
+    a = np.zeros((N,3))
+    a[:,2] = 1.0
+    b = np.zeros((N,3))
+    b[:,:2] = rng.uniform(-0.5,1.5,size=(N,2))
+    expected = rect.get_first_surface(a,b)
+    outside = np.any((expected[:,:2] < 0) | (expected[:,:2] > 1), axis=1)
+    expected[outside] = np.nan
+
+    actual, dist = mesh.get_first_surface_and_relative_distance(a,b)
+    assert nan_shape_allclose( actual, expected )
+    assert nan_shape_allclose( dist[~outside], np.ones((np.sum(~outside),)) )
+    assert nan_shape_allclose( mesh.worldcoord2texcoord(actual), expected[:,:2] )
+    assert nan_shape_allclose( mesh.texcoord2worldcoord(expected[:,:2]), expected )
+
+def test_geom_class_numpy_backend():
+    d = {'model':'from_file',
+         'filename':'$(find flyvr)/data/pyramid.osg',
+         'backend':'numpy'}
+    geom = simple_geom.Geometry(geom_dict=d)
+    assert isinstance(geom.model, mesh_geom.MeshModel)
+
+    center = geom.model.get_center()
+    cam = get_sample_camera().get_view_camera( center+(0,-20,5), center, (0,0,1) )
+    tcs = geom.compute_for_camera_view(cam, 'texture_coords')
+    assert tcs.shape == (cam.height, cam.width, 2)
+    assert np.sum(~np.isnan(tcs[:,:,0])) > 0
+
+def test_triangle_grid_vs_single_cell():
+    rng = np.random.RandomState(4)
+    M = 300
+    tri_verts = rng.uniform(size=(M,1,3)) + 0.05*rng.normal(size=(M,3,3))
+    precision = 1e-3
+    grid = mesh_geom.TriangleGrid(tri_verts, precision)
+    single = mesh_geom.TriangleGrid(tri_verts, precision, cell_size=100.0)
+    assert len(grid.cell_keys) > 1
+    assert len(single.cell_keys) == 1
+
+    # points on (and slightly off) random triangles
+    N = 1000
+    tri = rng.randint(0,M,size=(N,))
+    bary = rng.dirichlet((1,1,1),size=(N,))
+    points = np.sum(tri_verts[tri]*bary[:,:,np.newaxis],axis=1)
+    points += rng.normal(scale=precision/4,size=points.shape)
+    points[::10] = np.nan
+
+    tri1, bary1 = grid.locate(points, batch_size=300)
+    tri2, bary2 = single.locate(points)
+    assert np.sum(tri1 >= 0) > N/2
+    assert np.all( tri1 == tri2 )
+    assert nan_shape_allclose( bary1, bary2 )
+
+def test_mesh_cache():
+    filename = rosmsg2json.fixup_path( '$(find flyvr)/data/pyramid.osg' )
+    tmpdir = tempfile.mkdtemp()
+    old_env = os.environ.get('FLYVR_MESH_CACHE')
+    os.environ['FLYVR_MESH_CACHE'] = tmpdir
+    try:
+        model1 = mesh_geom.MeshModel(filename=filename,precision=1e-6)
+        assert len(os.listdir(tmpdir)) == 1
+        model2 = mesh_geom.MeshModel(filename=filename,precision=1e-6)
+        assert len(os.listdir(tmpdir)) == 1
+        model3 = mesh_geom.MeshModel(filename=filename,precision=1e-5)
+        assert len(os.listdir(tmpdir)) == 2
+    finally:
+        if old_env is None:
+            del os.environ['FLYVR_MESH_CACHE']
+        else:
+            os.environ['FLYVR_MESH_CACHE'] = old_env
+        shutil.rmtree(tmpdir)
+
+    check_same_model( model1, model2 )
+
+def test_mesh_no_cache():
+    filename = rosmsg2json.fixup_path( '$(find flyvr)/data/pyramid.osg' )
+    cache_dir = mesh_geom.get_mesh_cache_dir()
+    before = os.listdir(cache_dir)
+    model1 = mesh_geom.MeshModel(filename=filename,precision=1e-6,use_cache=False)
+    assert os.listdir(cache_dir) == before
+    model2 = mesh_geom.MeshModel(filename=filename,precision=1e-6)
+    check_same_model( model1, model2 )
+
+def check_same_model( model1, model2 ):
+    assert nan_shape_allclose( model1.get_center(), model2.get_center() )
+    tc = np.array( [[0.1, 0.1],
+                    [0.2, 0.1],
+                    [np.nan, np.nan]] )
+    wc = model1.texcoord2worldcoord(tc)
+    assert nan_shape_allclose( wc, model2.texcoord2worldcoord(tc) )
+    assert nan_shape_allclose( model1.worldcoord2texcoord(wc),
+                               model2.worldcoord2texcoord(wc) )
+    a = np.tile( model1.get_center()+(0,0,20), (len(wc),1) )
+    assert nan_shape_allclose( model1.get_first_surface(a,wc),
+                               model2.get_first_surface(a,wc) )
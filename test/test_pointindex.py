@@ -0,0 +1,113 @@
+import collections
+import numpy as np
+
+# ROS imports
+import roslib; roslib.load_manifest('flyvr')
+from flyvr.calib.pointindex import PointIndex
+
+Corr = collections.namedtuple("Corr", ["col","row","name"])
+
+def brute_force_nn(items, point):
+    d2 = [ (item[0]-point[0])**2 + (item[1]-point[1])**2 for item in items ]
+    return items[int(np.argmin(d2))]
+
+def test_empty():
+    index = PointIndex(dimensions=2)
+    assert len(index) == 0
+    assert index.search_nn(Corr(1,2,"")) is None
+
+def test_search_nn_with_append_buffer():
+    rng = np.random.RandomState(5)
+    items = [ Corr(c,r,"%d"%i) for i,(c,r) in enumerate(rng.uniform(0,100,size=(50,2))) ]
+    index = PointIndex(dimensions=2, items=items[:20], merge_size=8)
+
+    # interleave adds (some merged into the tree, some buffered) and queries
+    for i in range(20,len(items)):
+        index.add(items[i])
+        for point in rng.uniform(-10,110,size=(5,2)):
+            assert index.search_nn(Corr(point[0],point[1],"")) == brute_force_nn(items[:i+1], point)
+    assert len(index) == len(items)
+
+    # the location of an item finds that item
+    for item in items:
+        assert index.search_nn(item) == item
+
+    index.rebuild()
+    for point in rng.uniform(-10,110,size=(20,2)):
+        assert index.search_nn(point) == brute_force_nn(items, point)
+
+def test_knn_and_radius_queries():
+    rng = np.random.RandomState(6)
+    coords = rng.uniform(0,100,size=(200,2))
+    items = [ Corr(c,r,"%d"%i) for i,(c,r) in enumerate(coords) ]
+    index = PointIndex(dimensions=2, items=items[:150])
+    for item in items[150:]:
+        index.add(item) # some remain in the append buffer
+
+    points = rng.uniform(-10,110,size=(30,2))
+    d_all = np.sqrt(np.sum((points[:,np.newaxis,:]-coords[np.newaxis,:,:])**2,axis=2))
+
+    k = 5
+    dist, idx = index.query(points, k=k)
+    assert dist.shape == (len(points),k)
+    assert np.allclose( dist, np.sort(d_all,axis=1)[:,:k] )
+    assert np.allclose( d_all[np.arange(len(points))[:,np.newaxis],idx], dist )
+
+    r = 12.0
+    within = index.query_radius(points, r)
+    neighbours = index.search_radius(points, r)
+    for i in range(len(points)):
+        expected = np.nonzero(d_all[i] <= r)[0]
+        assert sorted(within[i]) == sorted(expected)
+        assert np.all( np.diff(d_all[i][within[i]]) >= 0 )
+        assert [n.name for n in neighbours[i]] == ["%d"%j for j in within[i]]
+
+def test_large_batch_queries():
+    # the append buffer is searched with a tree for large batches
+    rng = np.random.RandomState(8)
+    coords = rng.uniform(0,100,size=(400,2))
+    items = [ Corr(c,r,"%d"%i) for i,(c,r) in enumerate(coords) ]
+    index = PointIndex(dimensions=2, items=items[:300], merge_size=1000)
+    index.extend(items[300:])
+    assert len(index._buffer) == 100
+    points = rng.uniform(-10,110,size=(2000,2))
+    assert len(points)*len(index._buffer) > index.BRUTE_FORCE_SIZE
+
+    dist, idx = index.query(points, k=3)
+    d_all = np.sqrt(np.sum((points[:,np.newaxis,:]-coords[np.newaxis,:,:])**2,axis=2))
+    assert np.allclose( dist, np.sort(d_all,axis=1)[:,:3] )
+    assert np.allclose( d_all[np.arange(len(points))[:,np.newaxis],idx], dist )
+
+    within = index.query_radius(points, 5.0)
+    for i in range(len(points)):
+        assert sorted(within[i]) == sorted(np.nonzero(d_all[i] <= 5.0)[0])
+
+def test_knn_more_than_available():
+    items = [ Corr(0,0,"a"), Corr(1,0,"b") ]
+    index = PointIndex(dimensions=2, items=items)
+    dist, idx = index.query(np.array([[0.1,0.0]]), k=4)
+    assert list(idx[0]) == [0,1,-1,-1]
+    assert np.all(np.isinf(dist[0,2:]))
+    assert index.search_knn(np.array([[0.9,0.0]]), 4) == [[items[1],items[0]]]
+
+def test_knn_zero():
+    items = [ Corr(0,0,"a"), Corr(1,0,"b") ]
+    index = PointIndex(dimensions=2, items=items)
+    index.add(Corr(2,0,"c")) # in the append buffer
+    dist, idx = index.query(np.array([[0.1,0.0],[1.0,1.0]]), k=0)
+    assert dist.shape == (2,0)
+    assert idx.shape == (2,0)
+    assert index.search_knn(np.array([[0.1,0.0]]), 0) == [[]]
+
+def test_extend_grows_storage():
+    rng = np.random.RandomState(7)
+    coords = rng.uniform(0,100,size=(1000,2))
+    items = [ Corr(c,r,"%d"%i) for i,(c,r) in enumerate(coords) ]
+    index = PointIndex(dimensions=2)
+    index.extend(items[:500]) # one bulk load
+    for item in items[500:]:
+        index.add(item)
+    assert len(index) == len(items)
+    assert len(index._coords) < 2*len(items)
+    for point in rng.uniform(-10,110,size=(20,2)):
+        assert index.search_nn(point) == brute_force_nn(items, point)
@@ -1,3 +1,6 @@
+import os
+import shutil
+import tempfile
 import numpy as np
 import yaml
 
@@ -5,6 +8,7 @@ import yaml
 import roslib; roslib.load_manifest('flyvr')
 import flyvr.simple_geom as simple_geom
 import PyDisplaySurfaceArbitraryGeometry as pdsag
+import flyvr.mesh_geom as mesh_geom
 from pymvg.camera_model import CameraModel
 import flyvr.rosmsg2json as rosmsg2json
 
@@ -75,6 +79,24 @@ roi:
 
     return cam
 
+_mesh_cache_env = []
+
+def setup_mesh_cache():
+    # keep the mesh caches written by the tests out of $ROS_HOME
+    _mesh_cache_env.append( os.environ.get('FLYVR_MESH_CACHE') )
+    os.environ['FLYVR_MESH_CACHE'] = tempfile.mkdtemp()
+
+def teardown_mesh_cache():
+    shutil.rmtree( os.environ['FLYVR_MESH_CACHE'] )
+    old_env = _mesh_cache_env.pop()
+    if old_env is None:
+        del os.environ['FLYVR_MESH_CACHE']
+    else:
+        os.environ['FLYVR_MESH_CACHE'] = old_env
+
+setup_module = setup_mesh_cache
+teardown_module = teardown_mesh_cache
+
 def nan_shape_allclose( a,b, **kwargs):
     if a.shape != b.shape:
         return False
@@ -108,6 +130,7 @@ def _get_inputs():
                (simple_geom.Cylinder, dict(base=base, axis=axis, radius=radius)),
                (simple_geom.Sphere, dict(center=center, radius=radius)),
                (pdsag.ArbitraryGeometry, dict(filename=filename, precision=1e-5)),
+               (mesh_geom.MeshModel, dict(filename=filename, precision=1e-5)),
                ]
     return inputs
 
@@ -312,3 +335,140 @@ def test_geom_class():
     tcs = geom.compute_for_camera_view(cam,'texture_coords')
     dist = geom.compute_for_camera_view(cam,'distance')
     angle = geom.compute_for_camera_view(cam,'incidence_angle')
+
+def _inside_cylinder_geom_and_camera():
+    # a unit cylinder and a camera looking at its inside wall
+    d = {'model':'cylinder',
+         'base':{'x':0,'y':0,'z':0},
+         'axis':{'x':0,'y':0,'z':1},
+         'radius':1.0}
+    cam = get_sample_camera().get_view_camera( (0.5,0,0.5), (0,0.3,0.5), (0,0,1) )
+    return d, cam
+
+def test_geom_class_fused():
+    d, cam = _inside_cylinder_geom_and_camera()
+    geom = simple_geom.Geometry(geom_dict=d)
+    layers = geom.compute_for_camera_view(cam,
+                                          what=['texture_coords','distance','incidence_angle'])
+    assert sorted(layers.keys()) == ['distance','incidence_angle','texture_coords']
+    for what in layers:
+        expected = geom.compute_for_camera_view(cam,what)
+        assert nan_shape_allclose( layers[what], expected )
+
+    all_layers = geom.compute_all_for_camera_view(cam)
+    assert sorted(all_layers.keys()) == sorted(simple_geom.CAMERA_VIEW_LAYERS)
+
+def test_ray_cache():
+    d, cam = _inside_cylinder_geom_and_camera()
+    cam2 = cam.get_view_camera( (0.5,0,0.5), (0,-0.3,0.5), (0,0,1) )
+    geom = simple_geom.Geometry(geom_dict=d, ray_cache_size=1)
+    uncached = simple_geom.Geometry(geom_dict=d, ray_cache_size=0)
+    assert uncached.ray_cache is None
+
+    tcs1 = geom.compute_for_camera_view(cam,'texture_coords')
+    tcs2 = geom.compute_for_camera_view(cam,'texture_coords')
+    assert geom.ray_cache.get_stats() == dict(hits=1, misses=1, size=1, maxsize=1)
+    assert nan_shape_allclose( tcs1, tcs2 )
+    assert nan_shape_allclose( tcs1, uncached.compute_for_camera_view(cam,'texture_coords') )
+
+    # a different pose is a miss and evicts the first camera
+    geom.compute_for_camera_view(cam2,'texture_coords')
+    geom.compute_for_camera_view(cam,'texture_coords')
+    stats = geom.ray_cache.get_stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 3
+
+def test_geom_class_tiled():
+    d, cam = _inside_cylinder_geom_and_camera()
+    geom = simple_geom.Geometry(geom_dict=d)
+    expected = geom.compute_all_for_camera_view(cam)
+    # 494 rows is not a multiple of the tile size
+    actual = geom.compute_for_camera_view(cam, what=simple_geom.CAMERA_VIEW_LAYERS,
+                                          tile_rows=64)
+    for what in simple_geom.CAMERA_VIEW_LAYERS:
+        assert actual[what].shape == expected[what].shape
+        assert np.array_equal( np.isnan(actual[what]), np.isnan(expected[what]) )
+        good = ~np.isnan(expected[what])
+        assert np.all( actual[what][good] == expected[what][good] )
+
+    wcs = geom.compute_for_camera_view(cam, 'world_coords', tile_rows=100)
+    assert wcs.shape == (cam.height, cam.width, 3)
+
+def test_geom_class_masked():
+    d, cam = _inside_cylinder_geom_and_camera()
+    geom = simple_geom.Geometry(geom_dict=d)
+    expected = geom.compute_for_camera_view(cam, 'texture_coords')
+
+    mask = np.zeros( (cam.height, cam.width), dtype=np.uint8 )
+    mask[100:200, 50:300] = 1
+    mask[400:, 600:] = 1
+    inside = mask.astype(np.bool)
+
+    for tile_rows in (None, 64):
+        actual = geom.compute_for_camera_view(cam, 'texture_coords',
+                                              mask=mask, tile_rows=tile_rows)
+        assert actual.shape == expected.shape
+        assert nan_shape_allclose( actual[inside], expected[inside] )
+        assert np.all( np.isnan( actual[~inside] ) )
+
+    pixel_xy = np.array( [[50,100],[299,199],[658,493]] )
+    actual = geom.compute_for_pixels(cam, pixel_xy, what=['texture_coords','distance'])
+    assert nan_shape_allclose( actual['texture_coords'],
+                               expected[pixel_xy[:,1],pixel_xy[:,0]] )
+    assert actual['distance'].shape == (3,)
+
+def test_geom_class_float32():
+    # see the error budget in the simple_geom.Geometry docstring
+    d, cam = _inside_cylinder_geom_and_camera()
+    geom64 = simple_geom.Geometry(geom_dict=d)
+    geom32 = simple_geom.Geometry(geom_dict=d, dtype=np.float32)
+    expected = geom64.compute_all_for_camera_view(cam)
+    actual = geom32.compute_all_for_camera_view(cam)
+    tiled = geom32.compute_for_camera_view(cam, what=simple_geom.CAMERA_VIEW_LAYERS,
+                                           tile_rows=100)
+    atol = {'texture_coords':1e-5,
+            'world_coords':2e-5,
+            'distance':1e-5,
+            'incidence_angle':1e-4}
+    for what in simple_geom.CAMERA_VIEW_LAYERS:
+        assert actual[what].dtype == np.float32
+        assert tiled[what].dtype == np.float32
+        assert nan_shape_allclose( actual[what], expected[what], rtol=0, atol=atol[what] )
+        assert nan_shape_allclose( tiled[what], actual[what], rtol=0, atol=0 )
+
+def test_geom_class_batch():
+    d, cam = _inside_cylinder_geom_and_camera()
+    base_cam = get_sample_camera()
+    cams = [ cam,
+             base_cam.get_view_camera( (0.1,0.2,0.3), (1,0,0.5), (0,0,1) ),
+             base_cam,
+             ]
+    geom = simple_geom.Geometry(geom_dict=d)
+
+    batch = geom.compute_for_cameras(cams, what=['texture_coords','distance'])
+    assert len(batch) == len(cams)
+    for cam, actual in zip(cams, batch):
+        expected = geom.compute_for_camera_view(cam, what=['texture_coords','distance'])
+        for what in expected:
+            assert nan_shape_allclose( actual[what], expected[what] )
+
+    pixel_xy = np.array( [[0,0],[10,20],[300,200]] )
+    batch = geom.compute_for_cameras(cams, what='texture_coords', pixel_xy=pixel_xy)
+    for cam, actual in zip(cams, batch):
+        expected = geom.compute_for_pixels(cam, pixel_xy, what='texture_coords')
+        assert nan_shape_allclose( actual, expected )
+
+    assert geom.compute_for_cameras([]) == []
+
+    # small batches (pixel_xy split into chunks if larger than a batch),
+    # and full views computed in tiles
+    for max_batch_rays in (1, 2, len(pixel_xy), 2*len(pixel_xy), 1000):
+        batch = geom.compute_for_cameras(cams, what='texture_coords', pixel_xy=pixel_xy,
+                                         max_batch_rays=max_batch_rays)
+        for cam, actual in zip(cams, batch):
+            expected = geom.compute_for_pixels(cam, pixel_xy, what='texture_coords')
+            assert actual.shape == (len(pixel_xy),2)
+            assert nan_shape_allclose( actual, expected )
+    batch = geom.compute_for_cameras(cams, what='distance', max_batch_rays=1000)
+    for cam, actual in zip(cams, batch):
+        assert nan_shape_allclose( actual, geom.compute_for_camera_view(cam, what='distance') )